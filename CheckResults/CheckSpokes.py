@@ -1,18 +1,13 @@
 import vtk
 
+# mesh_io 在仓库根目录（运行时把仓库根目录加入 PYTHONPATH）；.vtk 和 .vtp 都能读取
+from mesh_io import read_mesh, read_points
+
 def read_vtk_points(file_path):
     """
     读取 VTK 文件并返回点数据（numpy 格式）。
     """
-    reader = vtk.vtkPolyDataReader()
-    reader.SetFileName(file_path)
-    reader.Update()
-    poly_data = reader.GetOutput()
-    points = poly_data.GetPoints()
-    point_list = []
-    for i in range(points.GetNumberOfPoints()):
-        point_list.append(points.GetPoint(i))
-    return point_list
+    return read_points(file_path)
 
 def main():
     # 输入文件路径
@@ -21,10 +16,7 @@ def main():
     pt_file = "CA1_pt_refined.vtk"
 
     # 读取曲面
-    surface_reader = vtk.vtkPolyDataReader()
-    surface_reader.SetFileName(surface_file)
-    surface_reader.Update()
-    surface = surface_reader.GetOutput()
+    surface = read_mesh(surface_file)
 
     # 设置曲面属性
     surface_mapper = vtk.vtkPolyDataMapper()
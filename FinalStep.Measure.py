@@ -3,17 +3,14 @@ import numpy as np
 import pandas as pd
 from scipy.spatial.distance import cdist
 import vtk
-from vtk.util import numpy_support
-import scipy.io
+import argparse
+from template_index import get_template_index, POINT_ORDER_NAME
+from spoke_archive import read_entry_points, entry_exists
 
 # 读取vtk文件中的点数据
 def read_vtk_points(vtk_file):
-    reader = vtk.vtkPolyDataReader()
-    reader.SetFileName(vtk_file)
-    reader.Update()
-    polydata = reader.GetOutput()
-    points = polydata.GetPoints()
-    points_np = numpy_support.vtk_to_numpy(points.GetData())
+    # 来自 VTK 文件（.vtk / .vtp）或扫描的 spokes.npz 归档
+    points_np = read_entry_points(vtk_file)
     
     # 处理nan值
     points_np = np.nan_to_num(points_np)
@@ -92,26 +89,14 @@ def compute_length(SkelPt, skeletonPt_order, crest_spoke_length):
 
     return Sub_length1, Sub_length2
     
-def load_point_order(mat_file_path):
-    """
-    读取 .mat 文件并返回 'point_order' 数据
-    """
-    # 使用 scipy.io.loadmat 读取 .mat 文件
-    mat_data = scipy.io.loadmat(mat_file_path)
-    
-    # 输出所有键值，查看文件中包含的变量名（可以根据需要删除）
-    # print("Keys in the loaded .mat file:", mat_data.keys())
-    
-    # 获取 'point_order' 数据并返回
-    return mat_data['point_order']
-
 # 计算亚区的测量指标（厚度、宽度、长度）
 def compute_subfield_measures(scan_folder_path, subfield, point_order_mat):
     """
     计算亚区的测量值，包括厚度、宽度、长度等
     """
-    # 加载point_order数据
-    point_order = load_point_order(point_order_mat)
+    # 加载模板索引（point_order 所在目录下编译好的 template_index.npz）
+    template = get_template_index(os.path.dirname(os.path.abspath(point_order_mat)))
+    crest_start, crest_end = template['partition_bounds'][1:3]
     
     # 构建vtk文件路径
     pt_file = os.path.join(scan_folder_path, f'{subfield}_pt_refined.vtk')
@@ -125,13 +110,10 @@ def compute_subfield_measures(scan_folder_path, subfield, point_order_mat):
     
     # 计算refined_spokes和crest_spoke_length
     refined_spokes = BdryPt - SkelPt
-    crest_spoke_length = np.linalg.norm(refined_spokes[1098:1162], axis=1)
+    crest_spoke_length = np.linalg.norm(refined_spokes[crest_start:crest_end], axis=1)
     
-    # 计算skeletonPt_order
-    skeletonPt_order = np.zeros((17, 31), dtype=int)
-    skeletonPt_order[8:17, :] = point_order[:, 1:32]
-    for k in range(31):
-        skeletonPt_order[0:8, k] = point_order[1:9, 64-k]
+    # skeletonPt_order 已在模板索引中算好
+    skeletonPt_order = template['skeletonPt_order']
     
     # 计算宽度
     width1, width2 = compute_width(SkelPt, skeletonPt_order, crest_spoke_length)
@@ -159,7 +141,7 @@ def compute_subfield_thickness(scan_folder_path, subfield):
     pt_file = os.path.join(scan_folder_path, f'{subfield}_pt_refined.vtk')
     ps_file = os.path.join(scan_folder_path, f'{subfield}_ps_refined.vtk')
     
-    if os.path.exists(pt_file) and os.path.exists(ps_file):  # 确保文件存在
+    if entry_exists(pt_file) and entry_exists(ps_file):  # 确保文件存在（.vtk / .vtp 或归档中）
         # 读取vtk文件数据
         pt_points = read_vtk_points(pt_file)
         ps_points = read_vtk_points(ps_file)
@@ -179,12 +161,12 @@ def compute_subfield_thickness(scan_folder_path, subfield):
 
 # 主函数
 def process_followups(followups_path, output_path, point_order_mat):
-    # 读取subfield_list_00.xlsx，获取亚区名称和点数
-    subfield_df = pd.read_excel('/home/nagao/subfield_list_00.xlsx', header=None)
-    subfield_list = subfield_df.iloc[:, 0].tolist()  # 亚区名称
+    # 从模板索引（与 point_order_mat 同目录的 subfield_list_00.xlsx 编译而来）获取亚区名称和点数
+    template = get_template_index(os.path.dirname(os.path.abspath(point_order_mat)))
+    subfield_list = template['subfield_names'].tolist()  # 亚区名称
     print(f"All Subfields: {subfield_list}")
 
-    N_vector = subfield_df.iloc[:, 3].values  # 点数
+    N_vector = template['subfield_spokes']  # 点数
 
     all_thickness = []  # 用于存储所有的厚度数据
     subfield_lengths = {}  # 用于记录每个亚区的长度
@@ -279,9 +261,12 @@ def process_followups(followups_path, output_path, point_order_mat):
     thickness_df.to_excel(output_path, index=False) 
 
 if __name__ == '__main__':
-
-    output_path = "/home/nagao/adni_data/Measures2_AV1451_PET_ABETA_MRI.xlsx"
-    followups_path = '/home/nagao/adni_data/FollowUps2'
-    point_order_mat = '/home/nagao/point_order_skeleton.mat'
-
-    process_followups(followups_path, output_path, point_order_mat)
+    parser = argparse.ArgumentParser(description="Compute subfield thickness/width/length measures for all follow-up scans.")
+    parser.add_argument('--followups_path', type=str, required=True, help="FollowUps folder (side/group/subject/scan)")
+    parser.add_argument('--output_path', type=str, required=True, help="Output .xlsx path")
+    parser.add_argument('--point_order_mat', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), POINT_ORDER_NAME),
+                        help="point_order_skeleton.mat of the template (default: the one next to this script)")
+    args = parser.parse_args()
+
+    process_followups(args.followups_path, args.output_path, args.point_order_mat)
@@ -1,70 +1,71 @@
 import os
-import vtk
-import pandas as pd
 import numpy as np
+from template_index import get_template_index
+from mesh_io import read_points
+from spoke_archive import archive_enabled, write_entries
 
-def extract_spokes(subject_dir, subfield_list_path):
+# Deformetrica 重构曲面：前 1002 个点是曲面本身，之后依次是各亚区的 pt、ps
+SURFACE_NAME = 'GeodesicRegression__Reconstruction__hippo__tp_1__age_3.00.vtk'
+
+
+def slice_spokes(points, template):
+    """
+    把重构曲面的点 (N,3) 按模板索引切成各亚区的 (pt, ps)，返回 {亚区名: (pt, ps)}。
+    pt、ps 是 points 的视图（不拷贝），偏移量来自模板索引中预先算好的 surface_offset / subfield_offsets。
+    """
+    spoke_pts = points[template['surface_offset']:]
+    spokes = {}
+    for name, start, count in zip(template['subfield_names'], template['subfield_offsets'], template['subfield_counts']):
+        half = int(count) // 2
+        spokes[str(name)] = (spoke_pts[start:start + half], spoke_pts[start + half:start + 2 * half])
+    return spokes
+
+
+def extract_spokes(subject_dirs, subfield_list_path, write=True):
     """
     输入：
-        subject_dir: 该被试的路径，如 /data03/ng/adni_test/data/Baseline/Left/group/subject/scan
+        subject_dirs: 扫描的路径，如 /data03/ng/adni_test/data/Baseline/Left/group/subject/scan，
+                      也可以是多个扫描路径的列表（一次调用处理全部扫描）
         subfield_list_path: 亚区表格路径，如 /data03/ng/adni_test/subfield_list_00.xlsx
+        write: 是否写出 {亚区}_pt.vtk / _ps.vtk；融合模式下 spokes 直接交给第九步，只在调试时写出
     功能：
-        对一个被试（左右各一次）重构的hippocampus进行spokes点提取和保存
+        对重构的hippocampus进行spokes点提取，每个扫描的所有亚区 pt/ps 一次写出
+        （归档模式下写入扫描的 spokes.npz）
+    返回：
+        {扫描路径: {亚区名: (pt, ps)}}，pt/ps 为 float32 的 (n,3) 数组；找不到重构曲面的扫描不在其中
     """
+    if isinstance(subject_dirs, (str, os.PathLike)):
+        subject_dirs = [subject_dirs]
 
-    # 读取亚区信息
-    subfield_info = pd.read_excel(subfield_list_path, header=None)
-    subfield_list = subfield_info[0].values
-    num_vector = subfield_info[2].astype(int).values
-    N_whole = num_vector.sum()
-    L_subfield = len(subfield_info)
-
-    # surface vtk 文件路径
-    surface_path = os.path.join(subject_dir, 'output', 'GeodesicRegression__Reconstruction__hippo__tp_1__age_3.00.vtk')
-    if not os.path.exists(surface_path):
-        print(f"VTK surface not found: {surface_path}")
-        return
-
-    # 读取 VTK 文件
-    reader = vtk.vtkPolyDataReader()
-    reader.SetFileName(surface_path)
-    reader.Update()
-    sub_surf = reader.GetOutput()
-
-    # 获取点矩阵
-    points = sub_surf.GetPoints()
-    raw_pts = [points.GetPoint(i) for i in range(points.GetNumberOfPoints())]
-    raw_pts = np.array(raw_pts)[1002:, :]  # 去掉前1002个点
-
-    # 遍历每个亚区，提取 pt 和 ps 并写入 vtk 文件
-    for iw in range(L_subfield):
-        subfield_name = subfield_list[iw]
-        tmp_num = num_vector[iw]
+    # 读取亚区信息（来自亚区表格所在目录下编译好的模板索引，每个进程只加载一次）
+    template = get_template_index(os.path.dirname(os.path.abspath(str(subfield_list_path))))
 
-        past_num_vector = num_vector[iw:]
-        minus_num = past_num_vector.sum()
-        pt_start_row = N_whole - minus_num + 1
-        pt_end_row = pt_start_row - 1 + tmp_num // 2
-        ps_start_row = pt_end_row + 1
-        ps_end_row = ps_start_row - 1 + tmp_num // 2
+    results = {}
+    for subject_dir in subject_dirs:
+        subject_dir = str(subject_dir)
 
-        pt = raw_pts[pt_start_row-1:pt_end_row, :]
-        ps = raw_pts[ps_start_row-1:ps_end_row, :]
+        # surface vtk 文件路径
+        surface_path = os.path.join(subject_dir, 'output', SURFACE_NAME)
+        if not os.path.exists(surface_path):
+            print(f"VTK surface not found: {surface_path}")
+            continue
 
-        def write_vtk(file_name, points):
-            poly_data = vtk.vtkPolyData()
-            vtk_points = vtk.vtkPoints()
-            for pt in points:
-                vtk_points.InsertNextPoint(pt)
-            poly_data.SetPoints(vtk_points)
-            writer = vtk.vtkPolyDataWriter()
-            writer.SetFileName(file_name)
-            writer.SetInputData(poly_data)
-            writer.Write()
+        # 只读取点矩阵（不构建 vtkPolyData），统一为 float32（与原来写出的 vtk 一致）
+        points = read_points(surface_path).astype(np.float32, copy=False)
+        spokes = slice_spokes(points, template)
+        results[subject_dir] = spokes
+        if not write:
+            continue
 
-        write_name_pt = os.path.join(subject_dir, f"{subfield_name}_pt.vtk")
-        write_name_ps = os.path.join(subject_dir, f"{subfield_name}_ps.vtk")
-        write_vtk(write_name_pt, pt)
-        write_vtk(write_name_ps, ps)
+        entries = {}
+        for subfield_name, (pt, ps) in spokes.items():
+            entries[os.path.join(subject_dir, f"{subfield_name}_pt.vtk")] = pt
+            entries[os.path.join(subject_dir, f"{subfield_name}_ps.vtk")] = ps
+        written = write_entries(entries)
 
-        print(f"Saved: {write_name_pt} and {write_name_ps}")
+        if archive_enabled():
+            print(f"Saved: {len(spokes)} subfields to {written[0]}")
+        else:
+            for write_name_pt, write_name_ps in zip(written[::2], written[1::2]):
+                print(f"Saved: {write_name_pt} and {write_name_ps}")
+    return results
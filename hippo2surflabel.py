@@ -1,6 +1,7 @@
 import os
 import subprocess
 import vtk
+from mesh_io import write_mesh
 
 # 子区标签定义
 subfield_labels = {
@@ -28,15 +29,9 @@ def nii_2_mesh(filename_nii, vtk_filename, label):
     smoother.GenerateErrorScalarsOn()
     smoother.Update()
 
-    writer_vtk = vtk.vtkPolyDataWriter()
-    writer_vtk.SetFileName(vtk_filename)
-    writer_vtk.SetInputConnection(smoother.GetOutputPort())
-    writer_vtk.Write()
-
-    writer_stl = vtk.vtkSTLWriter()
-    writer_stl.SetFileName(vtk_filename.replace(".vtk", ".stl"))
-    writer_stl.SetInputConnection(smoother.GetOutputPort())
-    writer_stl.Write()
+    # 按 mesh_io 的格式写出 VTK（.vtk 或 .vtp）和 STL
+    write_mesh(smoother.GetOutput(), vtk_filename)
+    write_mesh(smoother.GetOutput(), vtk_filename.replace(".vtk", ".stl"))
 
 def merge_labels_and_convert_to_vtk(label_dir, output_nii, output_vtk):
     """合并所有 label 的 nii.gz 文件并转换为 VTK"""
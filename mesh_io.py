@@ -0,0 +1,202 @@
+# mesh_io.py
+import os
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+# 网格文件的磁盘格式：
+#   'ascii'  - ASCII legacy VTK / ASCII STL（VTK writer 的默认设置，原有行为）
+#   'binary' - 二进制 legacy VTK / 二进制 STL，文件名不变
+#   'vtp'    - 压缩的 XML PolyData（.vtk 文件改写为同名 .vtp）/ 二进制 STL
+MESH_FORMATS = ('ascii', 'binary', 'vtp')
+
+# 通过环境变量设置默认格式，子进程（如 step 9 的隔离模式）会继承
+MESH_FORMAT_ENV = 'HIPPOMETRIC_MESH_FORMAT'
+
+_LEGACY_EXT = '.vtk'
+_XML_EXT = '.vtp'
+
+
+def get_mesh_format():
+    """当前默认的网格写出格式。"""
+    fmt = os.environ.get(MESH_FORMAT_ENV, 'ascii')
+    if fmt not in MESH_FORMATS:
+        raise ValueError(f"Unknown mesh format in {MESH_FORMAT_ENV}: {fmt}")
+    return fmt
+
+
+def set_mesh_format(fmt):
+    """设置默认的网格写出格式（写入环境变量，之后启动的子进程也使用该格式）。"""
+    if fmt not in MESH_FORMATS:
+        raise ValueError(f"Unknown mesh format: {fmt}")
+    os.environ[MESH_FORMAT_ENV] = fmt
+
+
+def mesh_path(path, fmt=None):
+    """按格式映射文件名：'vtp' 时 .vtk 改为 .vtp，其他情况不变。"""
+    fmt = fmt or get_mesh_format()
+    root, ext = os.path.splitext(str(path))
+    if fmt == 'vtp' and ext.lower() == _LEGACY_EXT:
+        return root + _XML_EXT
+    return str(path)
+
+
+def _sibling_paths(path):
+    """同一网格在 legacy / XML 两种命名下的路径。"""
+    root, ext = os.path.splitext(str(path))
+    if ext.lower() in (_LEGACY_EXT, _XML_EXT):
+        return [root + _LEGACY_EXT, root + _XML_EXT]
+    return [str(path)]
+
+
+def resolve_mesh_path(path):
+    """
+    返回磁盘上实际存在的文件：按当前格式映射后的路径优先，其次是给定路径和另一种命名。
+    都不存在时返回给定路径。
+    """
+    candidates = [mesh_path(path), str(path)] + _sibling_paths(path)
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return str(path)
+
+
+def mesh_exists(path):
+    return os.path.exists(resolve_mesh_path(path))
+
+
+def detect_mesh_format(path):
+    """根据文件头判断格式：'vtk'（legacy，ASCII 或二进制）、'vtp'（XML）或 'stl'。"""
+    with open(path, 'rb') as f:
+        head = f.read(256).lstrip()
+    if head.startswith(b'# vtk DataFile'):
+        return 'vtk'
+    if head.startswith(b'<?xml') or head.startswith(b'<VTKFile'):
+        return 'vtp'
+    return 'stl'
+
+
+def read_mesh(path):
+    """
+    读取网格为 vtkPolyData，自动识别 legacy VTK（ASCII/二进制）、XML .vtp 和 STL（ASCII/二进制）。
+    给定 .vtk 路径而磁盘上只有同名 .vtp（或反之）时读取实际存在的文件。
+    """
+    path = resolve_mesh_path(path)
+    if os.path.exists(path):
+        kind = detect_mesh_format(path)
+    else:
+        # 文件不存在时保持原来的行为：由对应的 VTK reader 报错并返回空的 polydata
+        kind = 'stl' if path.lower().endswith('.stl') else 'vtk'
+
+    if kind == 'vtk':
+        reader = vtk.vtkPolyDataReader()
+    elif kind == 'vtp':
+        reader = vtk.vtkXMLPolyDataReader()
+    else:
+        reader = vtk.vtkSTLReader()
+    reader.SetFileName(path)
+    reader.Update()
+    return reader.GetOutput()
+
+
+# legacy VTK 中 POINTS 的数据类型 -> NumPy 类型（二进制数据为大端序）
+_LEGACY_POINT_TYPES = {b'float': np.float32, b'double': np.float64}
+
+
+def _read_legacy_points(path):
+    """
+    直接解析 legacy VTK（ASCII/二进制）的 POINTS 段，不经过 VTK reader。
+    二进制按偏移一次读出整块数据，ASCII 一次解析 3N 个数。
+    文件头不是 "DATASET POLYDATA" 紧跟 POINTS 的简单布局时返回 None（交给 VTK reader）。
+    """
+    with open(path, 'rb') as f:
+        header = [f.readline() for _ in range(4)]
+        if not header[0].startswith(b'# vtk DataFile') or header[3].split() != [b'DATASET', b'POLYDATA']:
+            return None
+        line = f.readline()
+        while line and not line.strip():
+            line = f.readline()
+        fields = line.split()
+        if len(fields) != 3 or fields[0] != b'POINTS' or fields[2] not in _LEGACY_POINT_TYPES:
+            return None
+        n = int(fields[1])
+        dtype = np.dtype(_LEGACY_POINT_TYPES[fields[2]])
+
+        file_type = header[2].strip()
+        if file_type == b'BINARY':
+            points = np.fromfile(path, dtype=dtype.newbyteorder('>'), count=3 * n, offset=f.tell())
+            if points.size != 3 * n:
+                return None
+            points = points.astype(dtype)
+        elif file_type == b'ASCII':
+            # 点数据之后可能还有 VERTICES / POINT_DATA 等段，只解析前 3N 个数
+            tokens = f.read().split(maxsplit=3 * n)[:3 * n]
+            if len(tokens) != 3 * n:
+                return None
+            points = np.array(tokens, dtype=np.float64).astype(dtype, copy=False)
+        else:
+            return None
+    return points.reshape(n, 3)
+
+
+def read_points(path):
+    """
+    只读取点坐标，返回 (N,3) 数组（float 为 float32，double 为 float64，与 vtk_to_numpy 一致）。
+    legacy VTK 直接解析，不构建 VTK 对象；.vtp / STL 或无法直接解析的文件退回 read_mesh。
+    """
+    path = resolve_mesh_path(path)
+    if os.path.exists(path) and detect_mesh_format(path) == 'vtk':
+        try:
+            points = _read_legacy_points(path)
+        except ValueError:
+            points = None
+        if points is not None:
+            return points
+
+    points = read_mesh(path).GetPoints()
+    if points is None:
+        return np.zeros((0, 3), dtype=np.float32)
+    return vtk_to_numpy(points.GetData())
+
+
+def write_mesh(polydata, path, fmt=None, keep_name=False):
+    """
+    按格式写出网格，返回实际写出的路径。.stl 写 STL，其余按 legacy VTK / XML .vtp 写出。
+    keep_name=True 时文件名保持不变（'vtp' 退回二进制 legacy VTK），用于 Deformetrica 等
+    按固定文件名读取 .vtk 的下游。
+    先写临时文件再改名，并删除同一网格另一种命名的旧文件，避免下游读到过期的结果。
+    """
+    fmt = fmt or get_mesh_format()
+    if fmt not in MESH_FORMATS:
+        raise ValueError(f"Unknown mesh format: {fmt}")
+    if keep_name and fmt == 'vtp':
+        fmt = 'binary'
+
+    path = str(path)
+    if path.lower().endswith('.stl'):
+        writer = vtk.vtkSTLWriter()
+        if fmt != 'ascii':
+            writer.SetFileTypeToBinary()
+    else:
+        path = mesh_path(path, fmt)
+        if fmt == 'vtp':
+            writer = vtk.vtkXMLPolyDataWriter()
+            writer.SetDataModeToAppended()
+            writer.EncodeAppendedDataOff()
+            writer.SetCompressorTypeToZLib()
+        else:
+            writer = vtk.vtkPolyDataWriter()
+            if fmt == 'binary':
+                writer.SetFileTypeToBinary()
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    writer.SetFileName(tmp_path)
+    writer.SetInputData(polydata)
+    if not writer.Write():
+        raise IOError(f"Failed to write {path}")
+    os.replace(tmp_path, path)
+
+    for sibling in _sibling_paths(path):
+        if sibling != path and os.path.exists(sibling):
+            os.remove(sibling)
+    return path
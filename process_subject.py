@@ -4,10 +4,6 @@ import numpy as np
 import math
 import vtk
 from vtk.util.numpy_support import vtk_to_numpy
-# noinspection PyUnresolvedReferences
-import vtkmodules.vtkInteractionStyle
-# noinspection PyUnresolvedReferences
-import vtkmodules.vtkRenderingOpenGL2
 from vtkmodules.vtkCommonCore import (
     mutable,
     vtkPoints
@@ -21,19 +17,30 @@ import re
 import random
 import pandas as pd
 import scipy.io
+import scipy.ndimage
 from vtk.util.numpy_support import numpy_to_vtk
 import logging
-
-# 设置日志记录
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from template_index import (get_template_index, load_subfield_list, spoke_pairs, template_dir_of,
+                            POINT_ORDER_NAME, SUBFIELD_LIST_NAME, SUBFIELD_PYTHON_NAME)
+from mesh_io import set_mesh_format, MESH_FORMATS
+from spoke_archive import (read_entry, read_entry_points, write_entries, entry_exists, entry_sha1,
+                           array_sha1, set_archive_mode, write_json_entry, read_json_entry)
+
+# 设置日志记录：使用命名 logger 而不是 root logger 的 basicConfig，
+# 在 run_post_process 进程内调用时（它先配置了 root logger）refine 日志也仍写到 refine_spoke_length.log
 log_file_path = os.path.join(os.getcwd(), "refine_spoke_length.log")
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file_path),
-        logging.StreamHandler()
-    ]
-)
+logger = logging.getLogger("process_subject")
+if not logger.handlers:
+    logger.setLevel(logging.INFO)
+    _log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    for _log_handler in (logging.FileHandler(log_file_path), logging.StreamHandler()):
+        _log_handler.setFormatter(_log_formatter)
+        logger.addHandler(_log_handler)
+    logger.propagate = False
 
 def extract_random_rows(array, num_rows):
     random_indices = random.sample(range(len(array)), num_rows)
@@ -41,18 +48,577 @@ def extract_random_rows(array, num_rows):
     return random_indices, random_rows
 
 
+class InsideOracle:
+    """
+    针对同一个 surf_vtk 复用的 inside/outside 判断器。
+    定位器只在构造时建立一次，之后可以逐点或按 (N,3) 数组批量判断。
+    射线方向与单点 vtkSelectEnclosedPoints 完全一致（随机池取同一段序列），
+    因此结果与原来逐点新建 filter 的 IsInsideCheck 相同。原来的点先存进 float 的 vtkPoints，
+    这里同样先把坐标取整到 float32（恰好在曲面上的点，取整与否的结果会不同）。
+    """
+    def __init__(self, surf_vtk, tolerance=1e-4):
+        self.surf_vtk = surf_vtk
+        self.tolerance = tolerance
+        self.bounds = surf_vtk.GetBounds()
+        self.length = surf_vtk.GetLength()
+
+        self.locator = vtk.vtkStaticCellLocator()
+        self.locator.SetDataSet(surf_vtk)
+        self.locator.BuildLocator()
+
+        # 与 vtkSelectEnclosedPoints::RequestData 对单个点的设置相同
+        self.pool = vtk.vtkRandomPool()
+        self.pool.SetSize(1500)
+        self.pool.GeneratePool()
+        self.cell_ids = vtk.vtkIdList()
+        self.cell = vtk.vtkGenericCell()
+        self.counter = vtk.vtkIntersectionCounter(tolerance * self.length, self.length)
+        self.num_queries = 0
+
+    def is_inside(self, pt):
+        self.num_queries += 1
+        return vtk.vtkSelectEnclosedPoints.IsInsideSurface(
+            [float(np.float32(pt[0])), float(np.float32(pt[1])), float(np.float32(pt[2]))], self.surf_vtk, self.bounds, self.length,
+            self.tolerance, self.locator, self.cell_ids, self.cell, self.counter, self.pool, 0)
+
+    def classify(self, points):
+        """对 (N,3) 点数组批量判断，返回长度为 N 的 0/1 数组。"""
+        points = np.asarray(points, dtype=np.float32).astype(float).reshape(-1, 3)
+        self.num_queries += points.shape[0]
+        is_inside = vtk.vtkSelectEnclosedPoints.IsInsideSurface
+        args = (self.surf_vtk, self.bounds, self.length, self.tolerance,
+                self.locator, self.cell_ids, self.cell, self.counter, self.pool, 0)
+        return np.fromiter((is_inside(p, *args) for p in points.tolist()),
+                           dtype=np.int8, count=points.shape[0])
+
+
+class SurfaceIntersector:
+    """
+    基于 vtkModifiedBSPTree 的线段-曲面求交，每个 surf_vtk 只建一次树。
+    一次查询返回线段穿过曲面的全部交点，代替按 0.05 步长逐点 inside 判断的做法。
+    end_margin 与原 marching 的停止距离（1e-3）相同：离端点这么近的交点不单独计入，
+    由端点本身的 inside 状态决定是否算一次穿越（端点恰好在曲面上时与原来逐点判断一致）。
+    """
+    def __init__(self, surf_vtk, oracle, merge_tol=1e-6, end_margin=1e-3):
+        self.surf_vtk = surf_vtk
+        self.merge_tol = merge_tol
+        self.end_margin = end_margin
+        self.bsp_tree = vtk.vtkModifiedBSPTree()
+        self.bsp_tree.SetDataSet(surf_vtk)
+        self.bsp_tree.BuildLocator()
+        self.oracle = oracle
+        self._hits = vtk.vtkPoints()
+        self._hit_cells = vtk.vtkIdList()
+        self.num_queries = 0
+
+    def crossings(self, p_start, p_end):
+        """
+        返回线段 p_start -> p_end 与曲面的交点 (K,3)，按到 p_start 的距离由近到远排序。
+        擦边（两侧 inside 状态相同）和共边重复的交点会被去掉，只保留真正的穿越点。
+        两个端点直接判断 inside（同原来的逐点判断），离端点 end_margin 以内的交点去掉；
+        端点与相邻区间状态不同时，穿越点记在端点上。
+        """
+        p_start = np.asarray(p_start, dtype=float)
+        segment = np.asarray(p_end, dtype=float) - p_start
+        seg_len2 = np.dot(segment, segment)
+        if seg_len2 < 1e-12:
+            return np.zeros((0, 3))
+
+        self.num_queries += 1
+        self.bsp_tree.IntersectWithLine(p_start.tolist(), (p_start + segment).tolist(), 0.0,
+                                        self._hits, self._hit_cells)
+        # 没有交点时仍判断两个端点：端点恰好在曲面上时树可能漏掉交点，而取整后的 inside 状态会不同
+        if self._hits.GetNumberOfPoints() == 0:
+            t = np.zeros(0)
+        else:
+            hits = vtk_to_numpy(self._hits.GetData()).astype(float)
+            t = np.sort(np.clip((hits - p_start) @ segment / seg_len2, 0.0, 1.0))
+            t = t[np.concatenate([[True], np.diff(t) > self.merge_tol])]
+        margin = self.end_margin / np.sqrt(seg_len2)
+        t = t[(t > margin) & (t < 1.0 - margin)]
+
+        # 两个端点和相邻交点之间的中点一起判断 inside，相邻两个状态不同处才是真正穿越曲面
+        bounds = np.concatenate([[0.0], t, [1.0]])
+        samples = np.concatenate([[0.0], 0.5 * (bounds[:-1] + bounds[1:]), [1.0]])
+        state = self.oracle.classify(p_start + samples[:, None] * segment)
+        t = bounds[state[1:] != state[:-1]]
+        return p_start + t[:, None] * segment
+
+    def crossings_batch(self, p_start, p_end):
+        """对多条线段逐条调用 crossings，返回交点列表。"""
+        return [self.crossings(a, b) for a, b in zip(np.asarray(p_start, dtype=float), np.asarray(p_end, dtype=float))]
+
+
+class SurfaceGeometry:
+    """
+    一个已读入曲面的几何缓存：polydata、点法向量、cell locator、NumPy 视图，
+    以及 inside 判断器和线段求交器。各部分在第一次用到时才构建，之后被
+    RepairSkeleton / RefineSpokeDirection / RefineSpokeLength / GenerateOutside_pts 共用。
+    """
+    def __init__(self, surf_vtk):
+        self.surf_vtk = surf_vtk
+        self.mtime = surf_vtk.GetMTime()
+        self._normals = None
+        self._cell_locator = None
+        self._oracle = None
+        self._intersector = None
+        self._distance_fields = {}
+        self._coarse = {}
+        self.num_queries = 0
+
+    @property
+    def points(self):
+        return vtk_to_numpy(self.surf_vtk.GetPoints().GetData())
+
+    @property
+    def normals(self):
+        if self._normals is None:
+            # Calculate normal vectors of the surface
+            normFilter = vtk.vtkPolyDataNormals()
+            normFilter.SetInputData(self.surf_vtk)
+            normFilter.SetComputePointNormals(1)
+            normFilter.SetComputeCellNormals(0)
+            normFilter.SetAutoOrientNormals(1)
+            normFilter.SetSplitting(0)
+            normFilter.Update()
+            self._normals = np.array(normFilter.GetOutput().GetPointData().GetNormals())
+        return self._normals
+
+    @property
+    def cell_locator(self):
+        if self._cell_locator is None:
+            self._cell_locator = vtk.vtkCellLocator()
+            self._cell_locator.SetDataSet(self.surf_vtk)
+            self._cell_locator.BuildLocator()
+        return self._cell_locator
+
+    @property
+    def oracle(self):
+        if self._oracle is None:
+            self._oracle = InsideOracle(self.surf_vtk)
+        return self._oracle
+
+    @property
+    def intersector(self):
+        if self._intersector is None:
+            self._intersector = SurfaceIntersector(self.surf_vtk, self.oracle)
+        return self._intersector
+
+    def signed_distance_field(self, spacing):
+        """按给定体素间距构建（并缓存）该曲面的窄带有符号距离场。"""
+        if spacing not in self._distance_fields:
+            self._distance_fields[spacing] = SignedDistanceField(self, spacing)
+        return self._distance_fields[spacing]
+
+    def coarse(self, target_reduction=0.75):
+        """按 target_reduction 抽稀（vtkQuadricDecimation）后的曲面几何，与原曲面一起缓存。"""
+        if target_reduction not in self._coarse:
+            triangles = vtk.vtkTriangleFilter()
+            triangles.SetInputData(self.surf_vtk)
+            decimate = vtk.vtkQuadricDecimation()
+            decimate.SetInputConnection(triangles.GetOutputPort())
+            decimate.SetTargetReduction(target_reduction)
+            decimate.VolumePreservationOn()
+            decimate.Update()
+            self._coarse[target_reduction] = SurfaceGeometry(decimate.GetOutput())
+        return self._coarse[target_reduction]
+
+    def closest_point(self, pt):
+        """返回曲面上离 pt 最近的点及其所在 cell 的 id。"""
+        self.num_queries += 1
+        c = [0.0, 0.0, 0.0]
+        cellId = vtk.reference(0)
+        self.cell_locator.FindClosestPoint([float(pt[0]), float(pt[1]), float(pt[2])], c, cellId,
+                                           vtk.reference(0), vtk.reference(0.0))
+        return np.array(c), int(cellId)
+
+    def closest_points(self, points):
+        """批量最近点查询，返回最近点 (N,3) 和所在 cell 的 id (N,)。"""
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.num_queries += points.shape[0]
+        closest = np.empty_like(points)
+        cell_ids = np.empty(points.shape[0], dtype=np.int64)
+        find_closest = self.cell_locator.FindClosestPoint
+        c = [0.0, 0.0, 0.0]
+        cellId = vtk.reference(0)
+        subId = vtk.reference(0)
+        d = vtk.reference(0.0)
+        for i, p in enumerate(points.tolist()):
+            find_closest(p, c, cellId, subId, d)
+            closest[i, :] = c
+            cell_ids[i] = int(cellId)
+        return closest, cell_ids
+
+    def cell_point_ids(self, cell_ids):
+        """返回每个 cell 的顶点 id（拼接后的数组）以及每个 cell 的顶点数。"""
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        surf_vtk = self.surf_vtk
+        if surf_vtk.GetNumberOfCells() == surf_vtk.GetNumberOfPolys():
+            offsets = vtk_to_numpy(surf_vtk.GetPolys().GetOffsetsArray())
+            connectivity = vtk_to_numpy(surf_vtk.GetPolys().GetConnectivityArray())
+            starts = offsets[cell_ids]
+            counts = offsets[cell_ids + 1] - starts
+            index = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            return connectivity[index], counts
+        # 含 verts/lines 等其他 cell 时逐个取
+        pt_ids = vtk.vtkIdList()
+        ids, counts = [], []
+        for cellId in cell_ids.tolist():
+            surf_vtk.GetCellPoints(cellId, pt_ids)
+            ids.extend(pt_ids.GetId(i) for i in range(pt_ids.GetNumberOfIds()))
+            counts.append(pt_ids.GetNumberOfIds())
+        return np.array(ids, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+    def closest_points_normals(self, points):
+        """
+        CalculateNormalVectorofIntersection 的批量版本：对每个点返回最近 cell 的第一个顶点，
+        以及该 cell 各顶点法向量的平均（单位化）。
+        """
+        _, cell_ids = self.closest_points(points)
+        ids, counts = self.cell_point_ids(cell_ids)
+        starts = np.cumsum(counts) - counts
+        mean_vector = np.add.reduceat(self.normals[ids].astype(float), starts, axis=0) / counts[:, None]
+        normal_vectors = mean_vector / np.linalg.norm(mean_vector, axis=1)[:, None]
+        return self.points[ids[starts]].astype(float), normal_vectors
+
+
+class SignedDistanceField:
+    """
+    曲面的窄带有符号距离场（内部为负）。曲面只体素化一次，之后 inside 判断、
+    线段与边界的交点、最近点方向都变成 NumPy 数组上的三线性插值和梯度，可以对所有
+    spokes 一起计算，不再每次查询都调用 VTK。
+    接口与 SurfaceGeometry / InsideOracle / SurfaceIntersector 相同，可以直接替代 surf_vtk
+    传给各个 Refine 函数。窄带以外梯度为零的点会退回到精确的网格查询。
+    """
+    def __init__(self, geometry, spacing, band_voxels=4):
+        self.geometry = geometry
+        self.surf_vtk = geometry.surf_vtk
+        self.spacing = float(spacing)
+        self.band = band_voxels * self.spacing
+        self.num_queries = 0
+        self.num_fallbacks = 0
+
+        h = self.spacing
+        bounds = np.array(self.surf_vtk.GetBounds()).reshape(3, 2)
+        pad = self.band + 2 * h
+        self.origin = bounds[:, 0] - pad
+        self.dims = np.ceil((bounds[:, 1] - bounds[:, 0] + 2 * pad) / h).astype(int) + 1
+
+        # 在三角面上按 h 间距采样，标记其所在体素，再膨胀得到窄带
+        points = geometry.points.astype(float)
+        ids, counts = geometry.cell_point_ids(np.arange(self.surf_vtk.GetNumberOfCells()))
+        tris = ids.reshape(-1, 3) if np.all(counts == 3) else self._triangulate(ids, counts)
+        v0, v1, v2 = points[tris[:, 0]], points[tris[:, 1]], points[tris[:, 2]]
+        max_edge = max(np.linalg.norm(v1 - v0, axis=1).max(), np.linalg.norm(v2 - v0, axis=1).max(),
+                       np.linalg.norm(v2 - v1, axis=1).max())
+        n_sub = max(1, int(np.ceil(max_edge / h)))
+        u, v = np.meshgrid(np.arange(n_sub + 1), np.arange(n_sub + 1), indexing='ij')
+        keep = (u + v) <= n_sub
+        u, v = u[keep] / n_sub, v[keep] / n_sub
+        samples = (v0[:, None, :] + u[None, :, None] * (v1 - v0)[:, None, :]
+                   + v[None, :, None] * (v2 - v0)[:, None, :]).reshape(-1, 3)
+        index = np.clip(np.rint((samples - self.origin) / h).astype(int), 0, self.dims - 1)
+        near = np.zeros(self.dims, dtype=bool)
+        near[index[:, 0], index[:, 1], index[:, 2]] = True
+        band_mask = scipy.ndimage.binary_dilation(near, structure=np.ones((3, 3, 3), dtype=bool),
+                                                  iterations=band_voxels + 1)
+
+        # 窄带内精确求有符号距离
+        band_index = np.argwhere(band_mask)
+        band_points = self.origin + band_index * h
+        implicit = vtk.vtkImplicitPolyDataDistance()
+        implicit.SetInput(self.surf_vtk)
+        band_values = vtk.vtkDoubleArray()
+        implicit.FunctionValue(numpy_to_vtk(band_points, deep=True), band_values)
+        band_dist = vtk_to_numpy(band_values).copy()
+
+        # vtkImplicitPolyDataDistance 的符号取决于法向量朝向，用 inside 判断校正一次
+        probe = np.where(np.abs(band_dist) > h)[0]
+        if probe.size > 0:
+            probe = probe[np.linspace(0, probe.size - 1, min(probe.size, 200)).astype(int)]
+            inside = geometry.oracle.classify(band_points[probe]).astype(bool)
+            if np.mean(inside == (band_dist[probe] < 0)) < 0.5:
+                band_dist = -band_dist
+
+        # 窄带外：与网格边界连通的区域为外部，其余为内部
+        labels, _ = scipy.ndimage.label(~band_mask)
+        border = np.unique(np.concatenate([labels[0].ravel(), labels[-1].ravel(), labels[:, 0].ravel(),
+                                           labels[:, -1].ravel(), labels[:, :, 0].ravel(), labels[:, :, -1].ravel()]))
+        outside = np.isin(labels, border[border > 0])
+        self.grid = np.where(outside, self.band, -self.band).astype(np.float32)
+        self.grid[band_mask] = np.clip(band_dist, -self.band, self.band)
+
+        self.error = self.approximation_error()
+        logger.info(f"Signed distance field built (spacing={h}, dims={self.dims.tolist()}): {self.error}")
+
+    @staticmethod
+    def _triangulate(ids, counts):
+        """把多边形扇形剖分成三角形。"""
+        tris = []
+        start = 0
+        for n in counts.tolist():
+            for k in range(1, n - 1):
+                tris.append((ids[start], ids[start + k], ids[start + k + 1]))
+            start += n
+        return np.array(tris, dtype=np.int64)
+
+    @property
+    def oracle(self):
+        return self
+
+    @property
+    def intersector(self):
+        return self
+
+    def distance(self, points):
+        """三线性插值得到的有符号距离 (N,)；网格外视为外部。"""
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        g = (points - self.origin) / self.spacing
+        outside = np.any((g < 0) | (g > self.dims - 1), axis=1)
+        g = np.clip(g, 0, self.dims - 1 - 1e-9)
+        i0 = np.floor(g).astype(int)
+        f = g - i0
+        i1 = np.minimum(i0 + 1, self.dims - 1)
+        grid = self.grid
+        d = np.zeros(points.shape[0])
+        for corner in range(8):
+            ix = i1[:, 0] if corner & 1 else i0[:, 0]
+            iy = i1[:, 1] if corner & 2 else i0[:, 1]
+            iz = i1[:, 2] if corner & 4 else i0[:, 2]
+            wx = f[:, 0] if corner & 1 else 1 - f[:, 0]
+            wy = f[:, 1] if corner & 2 else 1 - f[:, 1]
+            wz = f[:, 2] if corner & 4 else 1 - f[:, 2]
+            d += wx * wy * wz * grid[ix, iy, iz]
+        d[outside] = self.band
+        return d
+
+    def gradient(self, points):
+        """距离场的中心差分梯度 (N,3)。"""
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        h = 0.5 * self.spacing
+        grad = np.empty_like(points)
+        for axis in range(3):
+            offset = np.zeros(3)
+            offset[axis] = h
+            grad[:, axis] = (self.distance(points + offset) - self.distance(points - offset)) / (2 * h)
+        return grad
+
+    def is_inside(self, pt):
+        return int(self.classify(pt)[0])
+
+    def classify(self, points):
+        """对 (N,3) 点数组批量判断，返回长度为 N 的 0/1 数组。"""
+        d = self.distance(points)
+        self.num_queries += d.shape[0]
+        return (d < 0).astype(np.int8)
+
+    def crossings_batch(self, p_start, p_end):
+        """
+        对多条线段同时求与边界（距离为 0）的交点。沿线段按半个体素采样，符号变化处线性插值。
+        返回列表，每项为 (K,3)，按到起点的距离由近到远排序。
+        """
+        p_start = np.asarray(p_start, dtype=float).reshape(-1, 3)
+        if p_start.shape[0] == 0:
+            return []
+        segment = np.asarray(p_end, dtype=float).reshape(-1, 3) - p_start
+        seg_len = np.linalg.norm(segment, axis=1)
+        num_steps = np.maximum(1, np.ceil(seg_len / (0.5 * self.spacing)).astype(int))
+        t = np.linspace(0.0, 1.0, num_steps.max() + 1)[None, :] * (num_steps.max() / num_steps)[:, None]
+        t = np.minimum(t, 1.0)
+        samples = p_start[:, None, :] + t[:, :, None] * segment[:, None, :]
+        d = self.distance(samples.reshape(-1, 3)).reshape(t.shape)
+        self.num_queries += p_start.shape[0]
+
+        outside = d >= 0
+        change = (outside[:, :-1] != outside[:, 1:]) & (t[:, 1:] > t[:, :-1])
+        results = []
+        for i in range(p_start.shape[0]):
+            if seg_len[i] < 1e-6:
+                results.append(np.zeros((0, 3)))
+                continue
+            k = np.where(change[i])[0]
+            d0, d1 = d[i, k], d[i, k + 1]
+            tk = t[i, k] + (t[i, k + 1] - t[i, k]) * d0 / (d0 - d1)
+            results.append(p_start[i] + tk[:, None] * segment[i])
+        return results
+
+    def crossings(self, p_start, p_end):
+        return self.crossings_batch(p_start, p_end)[0]
+
+    def closest_points_normals(self, points):
+        """最近点和外法向量（梯度方向）；梯度退化的点退回到网格查询。"""
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        d = self.distance(points)
+        grad = self.gradient(points)
+        norm = np.linalg.norm(grad, axis=1)
+        good = norm > 1e-6
+        normals = np.zeros_like(points)
+        normals[good] = grad[good] / norm[good, None]
+        closest = points - d[:, None] * normals
+        if not np.all(good):
+            self.num_fallbacks += int(np.count_nonzero(~good))
+            closest[~good], normals[~good] = self.geometry.closest_points_normals(points[~good])
+        return closest, normals
+
+    def closest_point(self, pt):
+        closest, _ = self.closest_points_normals(pt)
+        return closest[0], -1
+
+    def approximation_error(self, num_samples=2000, seed=0):
+        """
+        与精确网格后端比较的近似误差：窄带内距离误差、inside 判断不一致比例、法向量夹角（度）。
+        """
+        rng = np.random.default_rng(seed)
+        vertices = self.geometry.points.astype(float)
+        samples = vertices[rng.integers(0, vertices.shape[0], num_samples)]
+        samples = samples + rng.normal(scale=0.5 * self.band, size=samples.shape)
+
+        implicit = vtk.vtkImplicitPolyDataDistance()
+        implicit.SetInput(self.surf_vtk)
+        values = vtk.vtkDoubleArray()
+        implicit.FunctionValue(numpy_to_vtk(samples, deep=True), values)
+        exact_dist = np.abs(vtk_to_numpy(values))
+        in_band = exact_dist < self.band
+        dist_err = np.abs(np.abs(self.distance(samples[in_band])) - exact_dist[in_band])
+
+        inside_exact = self.geometry.oracle.classify(samples)
+        inside_sdf = (self.distance(samples) < 0).astype(np.int8)
+
+        _, n_exact = self.geometry.closest_points_normals(samples[in_band])
+        _, n_sdf = self.closest_points_normals(samples[in_band])
+        cos = np.clip(np.abs(np.sum(n_exact * n_sdf, axis=1)), -1.0, 1.0)
+        angle = np.degrees(np.arccos(cos))
+
+        return {
+            'spacing': self.spacing,
+            'distance_error_mean': float(dist_err.mean()) if dist_err.size else 0.0,
+            'distance_error_max': float(dist_err.max()) if dist_err.size else 0.0,
+            'inside_mismatch_rate': float(np.mean(inside_exact != inside_sdf)),
+            'normal_angle_mean_deg': float(angle.mean()) if angle.size else 0.0,
+            'normal_angle_max_deg': float(angle.max()) if angle.size else 0.0,
+        }
+
+
+def get_surface_backend(surf_vtk, backend='mesh', eps_s=0.1, spacing_factor=2.0):
+    """
+    选择曲面查询后端：'mesh' 直接返回 surf_vtk（精确网格查询），
+    'sdf' 返回该曲面缓存的有符号距离场，体素间距为 spacing_factor * eps_s。
+    """
+    if backend == 'sdf':
+        return get_surface_geometry(surf_vtk).signed_distance_field(spacing_factor * eps_s)
+    return surf_vtk
+
+
+# 按 LRU 缓存每个已读入曲面的 SurfaceGeometry；缓存中保存 surf_vtk 引用，避免地址被复用
+_surface_geometries = OrderedDict()
+_max_cached_surfaces = 32
+
+
+def get_surface_geometry(surf_vtk):
+    if isinstance(surf_vtk, (SurfaceGeometry, SignedDistanceField)):
+        return surf_vtk
+    key = surf_vtk.GetAddressAsString('vtkPolyData')
+    geometry = _surface_geometries.get(key)
+    if geometry is None or geometry.surf_vtk is not surf_vtk or geometry.mtime != surf_vtk.GetMTime():
+        geometry = SurfaceGeometry(surf_vtk)
+        _surface_geometries[key] = geometry
+        while len(_surface_geometries) > _max_cached_surfaces:
+            _surface_geometries.popitem(last=False)
+    _surface_geometries.move_to_end(key)
+    return geometry
+
+
+def release_surface_geometry(surf_vtk=None):
+    """一个扫描处理完后释放其曲面缓存；不指定 surf_vtk 时全部释放。"""
+    if surf_vtk is None:
+        _surface_geometries.clear()
+    else:
+        _surface_geometries.pop(surf_vtk.GetAddressAsString('vtkPolyData'), None)
+
+
+def get_inside_oracle(surf_vtk):
+    if isinstance(surf_vtk, (InsideOracle, SignedDistanceField)):
+        return surf_vtk
+    return get_surface_geometry(surf_vtk).oracle
+
+
+def get_surface_intersector(surf_vtk):
+    if isinstance(surf_vtk, (SurfaceIntersector, SignedDistanceField)):
+        return surf_vtk
+    return get_surface_geometry(surf_vtk).intersector
+
+
+def coarse_surface(surf_query, target_reduction=0.75):
+    """多分辨率 refine 用的抽稀曲面；sdf 后端本身已是近似，不再抽稀，返回 None。"""
+    if isinstance(surf_query, SignedDistanceField):
+        return None
+    return get_surface_geometry(surf_query).coarse(target_reduction)
+
+
+def tip_deviation(pt_a, pt_b):
+    """两组 tips 之间的距离统计（多分辨率与单分辨率结果的偏差）。"""
+    d = np.linalg.norm(points_of(pt_a).astype(float) - points_of(pt_b).astype(float), axis=1)
+    if d.size == 0:
+        return {'mean': 0.0, 'p95': 0.0, 'max': 0.0}
+    return {'mean': float(d.mean()), 'p95': float(np.percentile(d, 95)), 'max': float(d.max())}
+
+
+def query_counts(surf_query):
+    """曲面查询计数：inside 判断、线段求交、最近点（cell locator）查询次数，sdf 后端另加距离场查询次数。"""
+    sdf = surf_query if isinstance(surf_query, SignedDistanceField) else None
+    geometry = sdf.geometry if sdf is not None else get_surface_geometry(surf_query)
+    counts = {
+        'inside_tests': geometry._oracle.num_queries if geometry._oracle is not None else 0,
+        'intersection_queries': geometry._intersector.num_queries if geometry._intersector is not None else 0,
+        'closest_point_queries': geometry.num_queries,
+    }
+    if sdf is not None:
+        counts['sdf_queries'] = sdf.num_queries
+        counts['sdf_fallbacks'] = sdf.num_fallbacks
+    for coarse in geometry._coarse.values():
+        # 多分辨率 refine 在抽稀曲面上的查询
+        coarse_counts = query_counts(coarse)
+        for key in ('inside_tests', 'intersection_queries', 'closest_point_queries'):
+            counts['coarse_' + key] = counts.get('coarse_' + key, 0) + coarse_counts[key]
+    return counts
+
+
+def count_histogram(values):
+    """整数数组的直方图 {值: 个数}（用于迭代次数、交点个数的分布）。"""
+    keys, counts = np.unique(np.asarray(values, dtype=int), return_counts=True)
+    return {int(k): int(n) for k, n in zip(keys, counts)}
+
+
+def iteration_metrics(iter_counts, capped):
+    """迭代次数直方图及达到最大迭代次数的 spokes 数。"""
+    iter_counts = np.asarray(iter_counts, dtype=int)
+    return {
+        'spokes': int(iter_counts.size),
+        'iterations_histogram': count_histogram(iter_counts),
+        'iterations_max': int(iter_counts.max()) if iter_counts.size > 0 else 0,
+        'capped': int(np.count_nonzero(capped)),
+    }
+
+
+def finish_stage(metrics, name, tic):
+    """记录一个阶段的耗时（秒），返回下一阶段的起始时间。"""
+    now = time.perf_counter()
+    metrics.setdefault('stage_seconds', {})[name] = now - tic
+    return now
+
+
+def write_refine_metrics(metrics, output_path):
+    """
+    把一个亚区的 refine 指标写到 *_pt_refined.vtk 旁边的 *_pt_refined_metrics.json
+    （归档模式下写入扫描归档，见 spoke_archive.write_json_entry）。
+    """
+    metrics_path = os.path.splitext(output_path)[0] + "_metrics.json"
+    write_json_entry(metrics, metrics_path)
+    return metrics_path
+
+
 def IsInsideCheck(pX, pY, pZ, mesh):
-    select = vtk.vtkSelectEnclosedPoints()
-    select.SetSurfaceData(mesh)
-    select.SetTolerance(1e-4)
-
-    pts = vtk.vtkPoints()
-    pts.InsertNextPoint((pX), (pY), (pZ))
-    pts_pd = vtk.vtkPolyData()
-    pts_pd.SetPoints(pts)
-    select.SetInputData(pts_pd)
-    select.Update()
-    return select.IsInside(0)
+    return get_inside_oracle(mesh).is_inside((pX, pY, pZ))
 
 def numpy_to_vtk_polydata(points):
     vtk_points = vtk.vtkPoints()
@@ -63,48 +629,119 @@ def numpy_to_vtk_polydata(points):
     polydata.SetPoints(vtk_points)
     return polydata    
 
+def points_of(polydata):
+    """vtkPolyData 的点坐标，(N,3) 的 NumPy 视图（零拷贝）。"""
+    points = polydata.GetPoints()
+    if points is None:
+        return np.zeros((0, 3), dtype=np.float32)
+    return vtk_to_numpy(points.GetData())
+
+
+def read_polydata(path):
+    """读取网格文件（legacy VTK ASCII/二进制或 .vtp，见 mesh_io），或扫描归档中的对应成员（见 spoke_archive）。"""
+    return read_entry(path)
+
+
+class SpokeSet:
+    """
+    一组 spokes 的数组表示：skeleton（骨架点 ps）和 tips（边界点 pt）是连续的 (N,3) float32 数组，
+    inside 标记骨架点是否在曲面内（划分 inside/outside spokes），subfield_offsets 是各亚区的起始行
+    （长度为亚区数 + 1，只有整张曲面的 spokes 才需要）。
+    与 vtkPolyData 之间通过 numpy_to_vtk / vtk_to_numpy 零拷贝转换，划分与合并都是按下标的数组操作，
+    不改变 spokes 的顺序。
+    """
+
+    def __init__(self, skeleton, tips, inside=None, subfield_names=None, subfield_offsets=None):
+        self.skeleton = np.ascontiguousarray(skeleton, dtype=np.float32).reshape(-1, 3)
+        self.tips = np.ascontiguousarray(tips, dtype=np.float32).reshape(-1, 3)
+        if self.skeleton.shape != self.tips.shape:
+            raise ValueError(f"skeleton {self.skeleton.shape} and tips {self.tips.shape} do not match")
+        self.inside = None if inside is None else np.asarray(inside, dtype=bool)
+        self.subfield_names = subfield_names
+        self.subfield_offsets = subfield_offsets
+
+    def __len__(self):
+        return self.skeleton.shape[0]
+
+    @classmethod
+    def from_polydata(cls, ps_vtk, pt_vtk, **kwargs):
+        """由骨架点和边界点的 vtkPolyData 构造（float32 时不拷贝）。"""
+        return cls(points_of(ps_vtk), points_of(pt_vtk), **kwargs)
+
+    @classmethod
+    def read(cls, ps_path, pt_path, **kwargs):
+        """读取 *_ps.vtk / *_pt.vtk（只读点坐标，不构建 vtkPolyData）。"""
+        return cls(read_entry_points(ps_path), read_entry_points(pt_path), **kwargs)
+
+    @staticmethod
+    def _to_polydata(points):
+        vtk_points = vtk.vtkPoints()
+        # deep=False：vtk 数组直接引用 NumPy 内存（numpy_support 会保留对数组的引用）
+        vtk_points.SetData(numpy_to_vtk(points, deep=False, array_type=vtk.VTK_FLOAT))
+        polydata = vtk.vtkPolyData()
+        polydata.SetPoints(vtk_points)
+        return polydata
+
+    def skeleton_polydata(self):
+        return self._to_polydata(self.skeleton)
+
+    def tips_polydata(self):
+        return self._to_polydata(self.tips)
+
+    def copy(self):
+        inside = None if self.inside is None else self.inside.copy()
+        return SpokeSet(self.skeleton.copy(), self.tips.copy(), inside, self.subfield_names, self.subfield_offsets)
+
+    def subset(self, indices):
+        """按下标（或布尔掩码）取出一部分 spokes。"""
+        inside = None if self.inside is None else self.inside[indices]
+        return SpokeSet(self.skeleton[indices], self.tips[indices], inside)
+
+    def partition(self):
+        """按 inside 掩码划分，返回 (inside spokes, outside spokes, inside 下标, outside 下标)。"""
+        inside_indices = np.flatnonzero(self.inside)
+        outside_indices = np.flatnonzero(~self.inside)
+        return self.subset(inside_indices), self.subset(outside_indices), inside_indices, outside_indices
+
+    def scatter(self, indices, spokes):
+        """把 spokes 按下标写回（partition 的逆操作）。"""
+        self.skeleton[indices] = spokes.skeleton
+        self.tips[indices] = spokes.tips
+
+    def subfield(self, name):
+        """某个亚区的 spokes（视图，不拷贝）。"""
+        i = list(self.subfield_names).index(name)
+        start, end = self.subfield_offsets[i], self.subfield_offsets[i + 1]
+        return SpokeSet(self.skeleton[start:end], self.tips[start:end])
+
+    def write(self, pt_path, ps_path):
+        """写出 *_pt.vtk（tips）和 *_ps.vtk（skeleton）；归档模式下两者一起写入扫描的归档。"""
+        write_entries({pt_path: self.tips, ps_path: self.skeleton})
+
+
 def CalculateNormalVectorofIntersection(pt, surf_vtk):
-    # Calculate normal vectors of the surface
-    normFilter = vtk.vtkPolyDataNormals()
-    normFilter.SetInputData(surf_vtk)
-    normFilter.SetComputePointNormals(1)
-    normFilter.SetComputeCellNormals(0)
-    normFilter.SetAutoOrientNormals(1)
-    normFilter.SetSplitting(0)
-    normFilter.Update()
-    NormalVector = normFilter.GetOutput()  # 已经是VTK文件
-    all_Normals = np.array(NormalVector.GetPointData().GetNormals())
-    
+    # 法向量和 cell locator 都来自缓存的 SurfaceGeometry，不再每次重建
+    geometry = get_surface_geometry(surf_vtk)
+    if isinstance(geometry, SignedDistanceField):
+        p_closestPoints, normalVectors = geometry.closest_points_normals(pt)
+        return p_closestPoints[0], normalVectors[0]
+    all_Normals = geometry.normals
+
     # Calculate the closest point of pt on the boundary surface
-    cell_locator = vtk.vtkCellLocator()
-    cell_locator.SetDataSet(surf_vtk)
-    cell_locator.BuildLocator()
-    
-    c = [0.0, 0.0, 0.0]
-    cellId = vtk.reference(0)
-    subId = vtk.reference(0)
-    d = vtk.reference(0.0)
-    
-    # Find closest point using locator
-    cell_locator.FindClosestPoint(pt, c, cellId, subId, d)
-    
+    c, cellId = geometry.closest_point(pt)
+
     # Get points of the closest cell
     pt_ids = vtk.vtkIdList()
-    surf_vtk.GetCellPoints(cellId, pt_ids)
-    
+    geometry.surf_vtk.GetCellPoints(cellId, pt_ids)
+
     num_cell = pt_ids.GetNumberOfIds()
     if num_cell == 0:
         return None, None  # If no points in the cell, return None
-    
-    # Initialize vectors
-    vector_array = np.zeros((num_cell, 3))
-    p_closestPoints = np.zeros((num_cell, 3))
-    
+
     # Calculate normal vector for each point
-    for i in range(num_cell):
-        pt_id = pt_ids.GetId(i)
-        p_closestPoints[i, :] = np.array(surf_vtk.GetPoint(pt_id))
-        vector_array[i, :] = all_Normals[pt_id, :]
+    ids = [pt_ids.GetId(i) for i in range(num_cell)]
+    p_closestPoints = geometry.points[ids].astype(float)
+    vector_array = all_Normals[ids, :].astype(float)
 
     # Calculate the mean normal vector
     mean_vector = np.mean(vector_array, axis=0)
@@ -114,110 +751,84 @@ def CalculateNormalVectorofIntersection(pt, surf_vtk):
     return p_closestPoints[0, :], normalVector
 
 
+def marching_end(pt, ps, step=0.05, stop=1e-3):
+    """
+    原逐步求交（从 pt 每次向 ps 走 step 并判断 inside）最后一个被判断的采样点。
+    越过 ps 的第一个采样点也会被判断；离 ps 不足 stop 的采样点不判断，停在前一个点。
+    对 pt -> 该点的线段求交，交点个数与原来的 marching 计数一致。
+    pt, ps 为 (N,3) 或 (3,)，返回同样形状；spoke 长度不足 stop 时返回 pt（没有采样点）。
+    """
+    pt = np.asarray(pt, dtype=float)
+    ps = np.asarray(ps, dtype=float)
+    spoke = (pt - ps).reshape(-1, 3)
+    length = np.linalg.norm(spoke, axis=1)
+
+    # 以到 ps 的有向距离表示采样点：s_last 是第一个落到或越过 ps 的采样点，s_prev 是它的前一个
+    s_last = length - np.ceil(length / step) * step
+    s_prev = s_last + step
+    s_end = np.where(s_last <= -stop, s_last, s_prev)
+    s_end = np.where(s_prev < stop, s_prev + step, s_end)
+    s_end = np.where(length < stop, length, np.minimum(s_end, length))
+
+    spoke_dir = np.zeros_like(spoke)
+    valid = length > 0
+    spoke_dir[valid] = spoke[valid] / length[valid, None]
+    end = ps.reshape(-1, 3) + s_end[:, None] * spoke_dir
+    return end.reshape(pt.shape)
+
+
 def IntersectionNumber(pt, ps, surf_vtk):
     # Compute intersection number of spoke and surface
-    lamda = 0.05
-    spoke = pt - ps
-    spoke_length = np.linalg.norm(spoke)
+    spoke_length = np.linalg.norm(pt - ps)
 
     # Handle the case where the initial spoke length is zero
     if spoke_length < 1e-6:
         return 0
 
-    spoke_dir = spoke / spoke_length
-    spoke_dir_new = spoke_dir
-    spoke_length_new = spoke_length
-    status = 0
-    cycle_num = 0
-    Last_IsInside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
-
-    while np.dot(spoke_dir_new, spoke_dir) > 0:
-        cycle_num += 1
-
-        # Update the spoke length and check if it's near zero
-        spoke = pt - ps
-        spoke_length = np.linalg.norm(spoke)
-        if spoke_length < 1e-3:
-            break
-
-        spoke_dir = spoke / spoke_length
-
-        # Update the point along the direction
-        pt = pt - lamda * spoke_dir
-
-        # Update new spoke length and direction
-        spoke = pt - ps
-        spoke_length_new = np.linalg.norm(spoke)
-        if spoke_length_new < 1e-3:
-            break
-
-        spoke_dir_new = spoke / spoke_length_new
-
-        # Check if the point is inside or outside the surface
-        IsInside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
-
-        # Detect crossing of surface boundary
-        if IsInside != Last_IsInside:
-            status += 1
-
-        Last_IsInside = IsInside
-
-    return status
-
+    # 线段止于原 marching 最后一个采样点（可能略越过 ps），ps 恰好在曲面上时计数与原来一致
+    return get_surface_intersector(surf_vtk).crossings(pt, marching_end(pt, ps)).shape[0]
 
 
 def IntersectionNumber1(pt, ps, surf_vtk):
-    import numpy as np
-
-    # Compute intersection number of spoke and surface
-    lamda = 0.05
-    spoke = pt - ps
-    spoke_length = np.linalg.norm(spoke)
+    # Compute intersection points of spoke and surface, walking from pt back to ps
+    spoke_length = np.linalg.norm(pt - ps)
 
     # Handle the case where initial spoke length is zero
     if spoke_length < 1e-3:
         return [], 0
 
-    spoke_dir = spoke / spoke_length
-    status = 0
-    intersections = []
-    Last_IsInside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
-
-    while spoke_length > 1e-3:  # Add a threshold for spoke length to stop the loop
-        # Update the point along the direction
-        pt -= lamda * spoke_dir
-
-        # Update the spoke vector, length, and direction
-        spoke = pt - ps
-        spoke_length = np.linalg.norm(spoke)
-
-        if spoke_length < 1e-3:  # Handle near-zero spoke length
-            break
-
-        spoke_dir = spoke / spoke_length
-
-        # Check if the point is inside or outside the surface
-        IsInside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+    crossings = get_surface_intersector(surf_vtk).crossings(pt, marching_end(pt, ps))
+    intersections = [c for c in crossings[:3]]
+    status = len(intersections)
 
-        # Detect crossing of surface boundary
-        if IsInside != Last_IsInside:
-            status += 1
-            intersections.append(pt.copy())  # Record the crossing point
-        
-        Last_IsInside = IsInside
-
-        # Early exit if too many intersections are detected
-        if status > 2:
-            break
-
-    # Return the intersections based on status
+    # Return the intersections based on status (最多数到第 3 个交点，保留最后两个)
     if status > 2:
         return intersections[-2:], status
     else:
         return intersections, status
 
 
-def RefineSpokeLength(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path):
+def IntersectionNumberBatch(pt_array, ps_array, surf_vtk):
+    """
+    对一个亚区的所有 spokes 一次性求交。
+    返回每根 spoke 的交点个数 (N,) 和对应的交点列表（每项为 (K,3)，从 pt 往 ps 排序）。
+    与 IntersectionNumber 一样，线段止于原 marching 的最后一个采样点。
+    """
+    intersections = get_surface_intersector(surf_vtk).crossings_batch(pt_array, marching_end(pt_array, ps_array))
+    intersect_nums = np.array([c.shape[0] for c in intersections], dtype=int)
+    return intersect_nums, intersections
+
+
+def RefineSpokeLength(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path, mode='march', metrics=None):
+    # 长度总是在原曲面上收敛：停靠位置取决于沿 spoke 的交点个数，先在抽稀曲面上移动 tip
+    # 会让部分 spokes 停到另一个交点上（多分辨率只用于方向，见 RefineSpokeDirection）
+
+    # mode='direct' 时一次把 tip 放到边界交点上，见 RefineSpokeLengthDirect
+    if mode == 'direct':
+        return RefineSpokeLengthDirect(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path, metrics=metrics)
+    # 距离场后端单点查询的开销大，所有 spokes 同步逐步移动，每步批量判断 inside
+    if isinstance(surf_vtk, SignedDistanceField):
+        return RefineSpokeLengthMarchBatch(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path, metrics=metrics)
 
     # 将 VTK 点数据转换为 NumPy 数组
     pt_points = vtk_to_numpy(pt_vtk.GetPoints().GetData())
@@ -230,41 +841,47 @@ def RefineSpokeLength(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path):
     max_iter = 1000
     
     pt_dir = pt_path
+    oracle = get_inside_oracle(surf_vtk)
+    intersect_nums, _ = IntersectionNumberBatch(pt_points, ps_points, surf_vtk)
+    iter_counts = np.zeros(num_pt, dtype=int)
+    capped = np.zeros(num_pt, dtype=bool)
 
     # 处理每个点
     for i in range(num_pt):
-        pt = pt_points[i, :]
+        pt = pt_points[i, :].copy()  # 不修改输入 polydata 的点
         ps = ps_points[i, :]
         displacement = pt - ps  # 缓存位移
         spoke_length = np.linalg.norm(displacement)
 
         if spoke_length != 0:
             spoke_dir = displacement / spoke_length
-            intersect_num = IntersectionNumber(pt, ps, surf_vtk)
-            is_inside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+            intersect_num = intersect_nums[i]
+            is_inside = oracle.is_inside(pt)
 
             iter_count = 0
 
             if intersect_num == 0:
                 while is_inside:
                     pt += spoke_dir * eps_s
-                    is_inside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+                    is_inside = oracle.is_inside(pt)
                     iter_count += 1
                     if iter_count > max_iter:
-                        logging.warning(
+                        logger.warning(
                             f"Max iterations reached in pt_path: {pt_dir}"
                         )
+                        capped[i] = True
                         break
 
             elif intersect_num == 1:
                 while not is_inside:
                     pt -= spoke_dir * eps_s
-                    is_inside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+                    is_inside = oracle.is_inside(pt)
                     iter_count += 1
                     if iter_count > max_iter:
-                        logging.warning(
+                        logger.warning(
                             f"Max iterations reached in pt_path: {pt_dir}"
                         )
+                        capped[i] = True
                         break
 
             elif intersect_num == 2:
@@ -273,18 +890,20 @@ def RefineSpokeLength(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path):
                     intersect_num = IntersectionNumber(pt, ps, surf_vtk)
                     iter_count += 1
                     if iter_count > max_iter:
-                        logging.warning(
+                        logger.warning(
                             f"Max iterations reached in pt_path: {pt_dir}"
                         )
+                        capped[i] = True
                         break
                 while not is_inside:
                     pt -= spoke_dir * eps_s
-                    is_inside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+                    is_inside = oracle.is_inside(pt)
                     iter_count += 1
                     if iter_count > max_iter:
-                        logging.warning(
+                        logger.warning(
                             f"Max iterations reached in pt_path: {pt_dir}"
                         )
+                        capped[i] = True
                         break
 
             elif intersect_num == 3:
@@ -293,39 +912,168 @@ def RefineSpokeLength(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path):
                     intersect_num = IntersectionNumber(pt, ps, surf_vtk)
                     iter_count += 1
                     if iter_count > max_iter:
-                        logging.warning(
+                        logger.warning(
                             f"Max iterations reached in pt_path: {pt_dir}"
                         )
+                        capped[i] = True
                         break
                 while intersect_num == 1:
                     pt -= spoke_dir * eps_s
                     intersect_num = IntersectionNumber(pt, ps, surf_vtk)
                     iter_count += 1
                     if iter_count > max_iter:
-                        logging.warning(
+                        logger.warning(
                             f"Max iterations reached in pt_path: {pt_dir}"
                         )
+                        capped[i] = True
                         break
                 while not is_inside:
                     pt -= spoke_dir * eps_s
-                    is_inside = IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+                    is_inside = oracle.is_inside(pt)
                     iter_count += 1
                     if iter_count > max_iter:
-                        logging.warning(
+                        logger.warning(
                             f"Max iterations reached in pt_path: {pt_dir}"
                         )
+                        capped[i] = True
                         break
 
+            iter_counts[i] = iter_count
+
         pt_array[i, :] = pt
 
+    if metrics is not None:
+        metrics['length'] = dict(iteration_metrics(iter_counts, capped), mode='march',
+                                 intersections_histogram=count_histogram(intersect_nums))
+
     # 使用 numpy_to_vtk_polydata 来创建 vtkPolyData 对象
     pt_vtk_LengthRefined = numpy_to_vtk_polydata(pt_array)
     
     return pt_vtk_LengthRefined
 
 
+def RefineSpokeLengthMarchBatch(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path, max_iter=1000, metrics=None):
+    """
+    RefineSpokeLength 逐步版本的批量实现：所有 spokes 同步按 eps_s 移动，每一步对仍在移动的 tips
+    一次性判断 inside。停靠规则、步长和最大迭代次数与逐个处理相同：
+    - 0 个交点且 tip 在内部：向外走到 tip 落到外部
+    - 1~3 个交点且 tip 在外部：往回走到 tip 落到内部（逐步版本中按交点个数的循环不会执行）
+    """
+    pt_points = vtk_to_numpy(pt_vtk.GetPoints().GetData())
+    ps_points = vtk_to_numpy(ps_vtk.GetPoints().GetData())
+    pt_array = pt_points.copy()
+
+    displacement = pt_array - ps_points
+    spoke_length = np.linalg.norm(displacement, axis=1)
+    valid = spoke_length != 0
+    spoke_dir = np.zeros_like(displacement)
+    spoke_dir[valid] = displacement[valid] / spoke_length[valid, None]
+
+    oracle = get_inside_oracle(surf_vtk)
+    intersect_nums, _ = IntersectionNumberBatch(pt_points, ps_points, surf_vtk)
+    is_inside = oracle.classify(pt_array).astype(bool)
+
+    # 向外为 +1，往回为 -1；移动到 inside 状态改变为止
+    step = np.zeros(pt_array.shape[0], dtype=pt_array.dtype)
+    step[valid & (intersect_nums == 0) & is_inside] = 1
+    step[valid & (intersect_nums >= 1) & (intersect_nums <= 3) & ~is_inside] = -1
+    iter_counts = np.zeros(pt_array.shape[0], dtype=int)
+    capped = np.zeros(pt_array.shape[0], dtype=bool)
+
+    active = np.flatnonzero(step)
+    while active.size > 0:
+        pt_array[active] += step[active, None] * spoke_dir[active] * eps_s
+        iter_counts[active] += 1
+        moved_inside = oracle.classify(pt_array[active]).astype(bool)
+        capped[active] = iter_counts[active] > max_iter
+        active = active[(moved_inside == is_inside[active]) & ~capped[active]]
+    if np.any(capped):
+        logger.warning(f"Max iterations reached in pt_path: {pt_path} ({int(np.count_nonzero(capped))} spokes)")
+
+    if metrics is not None:
+        metrics['length'] = dict(iteration_metrics(iter_counts, capped), mode='march',
+                                 intersections_histogram=count_histogram(intersect_nums))
+
+    return numpy_to_vtk_polydata(pt_array)
+
+
+def RefineSpokeLengthDirect(surf_vtk, pt_vtk, ps_vtk, eps_s, pt_path, max_iter=1000, metrics=None):
+    """
+    RefineSpokeLength 的直接求交版本：沿 spoke 方向一次求出 tip 应停靠的边界交点，
+    不再按 eps_s 步长逐步移动。一个亚区的所有 spokes 一起处理，停靠规则与逐步版本相同：
+    - 0 个交点且 tip 在内部：沿 spoke 方向向外找第一个交点（最远 (max_iter+1)*eps_s）
+    - 1~3 个交点且 tip 在外部：退回到离 tip 最近的交点
+    - 其余情况 tip 不动
+    """
+    pt_points = vtk_to_numpy(pt_vtk.GetPoints().GetData()).astype(float)
+    ps_points = vtk_to_numpy(ps_vtk.GetPoints().GetData()).astype(float)
+    pt_array = pt_points.copy()
+
+    displacement = pt_points - ps_points
+    spoke_length = np.linalg.norm(displacement, axis=1)
+    valid = spoke_length != 0
+    spoke_dir = np.zeros_like(displacement)
+    spoke_dir[valid] = displacement[valid] / spoke_length[valid, None]
+
+    intersect_nums, intersections = IntersectionNumberBatch(pt_points, ps_points, surf_vtk)
+    is_inside = get_inside_oracle(surf_vtk).classify(pt_points).astype(bool)
+
+    # tip 在外部：退回到从 tip 往骨架点方向的第一个交点
+    shrink = np.where(valid & (intersect_nums >= 1) & (intersect_nums <= 3) & ~is_inside)[0]
+    for i in shrink:
+        pt_array[i, :] = intersections[i][0]
+
+    # tip 在内部且与曲面无交点：沿 spoke 方向向外延长到第一个交点
+    grow = np.where(valid & (intersect_nums == 0) & is_inside)[0]
+    num_capped = 0
+    if grow.size > 0:
+        far_points = pt_points[grow] + (max_iter + 1) * eps_s * spoke_dir[grow]
+        # 向外延长的线段直接求交（不是 pt -> ps 的 spoke，不用 marching_end）
+        grow_hits = get_surface_intersector(surf_vtk).crossings_batch(pt_points[grow], far_points)
+        for i, hits, far_pt in zip(grow, grow_hits, far_points):
+            if hits.shape[0] > 0:
+                pt_array[i, :] = hits[0]
+            else:
+                pt_array[i, :] = far_pt
+                num_capped += 1
+                logger.warning(f"Max iterations reached in pt_path: {pt_path}")
+
+    if metrics is not None:
+        metrics['length'] = {
+            'mode': 'direct',
+            'spokes': int(pt_points.shape[0]),
+            'shrunk': int(shrink.size),
+            'grown': int(grow.size),
+            'capped': num_capped,
+            'intersections_histogram': count_histogram(intersect_nums),
+        }
+
+    pt_vtk_LengthRefined = numpy_to_vtk_polydata(pt_array)
+
+    return pt_vtk_LengthRefined
+
+
+
+def RefineSpokeDirection(surf_vtk, pt_vtk, ps_vtk, eps_d, pt_path, mode='loop', metrics=None,
+                         resolution='single', target_reduction=0.75, coarse_iter=5, max_iter=50, warn_capped=True):
+    # resolution='multi' 时先在抽稀曲面上做最多 coarse_iter 轮迭代（只用于前几轮），
+    # 再从抽稀结果出发在原曲面上收敛到 eps_d
+    if resolution == 'multi':
+        coarse = coarse_surface(surf_vtk, target_reduction)
+        if coarse is not None:
+            coarse_metrics = {}
+            pt_vtk = RefineSpokeDirection(coarse, pt_vtk, ps_vtk, eps_d, pt_path, mode=mode, metrics=coarse_metrics,
+                                          max_iter=coarse_iter, warn_capped=False)
+            if metrics is not None:
+                metrics['direction_coarse'] = coarse_metrics['direction']
+
+    # mode='batch' 时所有 spokes 一起迭代，见 RefineSpokeDirectionBatch
+    if mode == 'batch':
+        pt_vtk_DirectionRefined, iter_counts = RefineSpokeDirectionBatch(surf_vtk, pt_vtk, ps_vtk, eps_d, pt_path,
+                                                                         max_iter=max_iter, metrics=metrics,
+                                                                         warn_capped=warn_capped)
+        return pt_vtk_DirectionRefined
 
-def RefineSpokeDirection(surf_vtk, pt_vtk, ps_vtk, eps_d, pt_path):
     # 将 VTK 点数据转换为 NumPy 数组
     pt_points = vtk_to_numpy(pt_vtk.GetPoints().GetData())
     ps_points = vtk_to_numpy(ps_vtk.GetPoints().GetData())
@@ -334,6 +1082,9 @@ def RefineSpokeDirection(surf_vtk, pt_vtk, ps_vtk, eps_d, pt_path):
     pt_array = np.zeros_like(pt_points)  # 创建与 pt_points 相同形状的空数组
 
     alpha = 0.5  # alpha 越大越接近 normalvector
+    geometry = get_surface_geometry(surf_vtk)
+    iter_counts = np.zeros(num_pt, dtype=int)
+    capped = np.zeros(num_pt, dtype=bool)
 
     for i in range(num_pt):
         pt = pt_points[i, :]
@@ -345,11 +1096,11 @@ def RefineSpokeDirection(surf_vtk, pt_vtk, ps_vtk, eps_d, pt_path):
             cos_angle = 0
             circle_num = 0
 
-            while (1 - cos_angle) > eps_d and circle_num < 50:
+            while (1 - cos_angle) > eps_d and circle_num < max_iter:
                 circle_num += 1
 
                 # Calculate normal vector
-                p_closestPoint, nomalVector = CalculateNormalVectorofIntersection(pt, surf_vtk)
+                p_closestPoint, nomalVector = CalculateNormalVectorofIntersection(pt, geometry)
 
                 # Update spoke direction
                 medial_vector = (alpha * spoke_dir + (1 - alpha) * nomalVector)
@@ -362,92 +1113,130 @@ def RefineSpokeDirection(surf_vtk, pt_vtk, ps_vtk, eps_d, pt_path):
                 cos_angle = np.dot(spoke_dir, nomalVector)
 
                 # Logging
-                #logging.info(f"Point {i}, Iter {circle_num}: cos_angle={cos_angle}, spoke_length={spoke_length}")
+                #logger.info(f"Point {i}, Iter {circle_num}: cos_angle={cos_angle}, spoke_length={spoke_length}")
 
-            if circle_num >= 100:
-                logging.warning(f"Max iterations reached for RefineSpokeDirection in pt_path: {pt_path}")
+            # 循环在 max_iter 次停止，此时仍未收敛才算达到上限
+            iter_counts[i] = circle_num
+            if (1 - cos_angle) > eps_d:
+                capped[i] = True
+                if warn_capped:
+                    logger.warning(f"Max iterations reached for RefineSpokeDirection in pt_path: {pt_path}")
 
         pt_array[i, :] = pt
 
+    if metrics is not None:
+        metrics['direction'] = dict(iteration_metrics(iter_counts, capped), mode='loop')
+
     pt_vtk_DirectionRefined = numpy_to_vtk_polydata(pt_array)
     return pt_vtk_DirectionRefined
 
 
-def EqualSpokeLength(pt_vtk, ps_vtk, eps_e):  # tips points, skeleton points, error
-    num_pt = pt_vtk.GetNumberOfPoints()
-    pt_array = np.zeros((num_pt, 3))
-    num_ps = ps_vtk.GetNumberOfPoints()
-    ps_array = np.zeros((num_ps, 3))
-    InnerSpokeLength = np.zeros((549, 2))  # ((549, 2))
-    finished_points = 0
-    for i in range(num_pt):
-        pt_array[i, :] = np.array(pt_vtk.GetPoint(i))
-        ps_array[i, :] = np.array(ps_vtk.GetPoint(i))
-        pt = pt_array[i, :]
-        ps = ps_array[i, :]
-        if np.linalg.norm(pt - ps) != 0:
-            spoke = pt - ps
-            spoke_length = np.linalg.norm(spoke)
-        else:
-            spoke_length = 0
-        if i < 549:  # 549:
-            InnerSpokeLength[i, 0] = spoke_length
-        elif i >= 549 and i < 1098:
-            InnerSpokeLength[i - 549, 1] = spoke_length  # InnerSpokeLength[i-549,1] = spoke_length
-        # print(InnerSpokeLength)
-        # print(pt_array)
-    for i in range(549):
-        finished_points += 1
-        lengthDiff = InnerSpokeLength[i, 0] - InnerSpokeLength[i, 1]
-        # print(lengthDiff)
-        if abs(lengthDiff) > eps_e:
-            if InnerSpokeLength[i, 0] > InnerSpokeLength[i, 1]:
-                pt = pt_array[i, :]
-                ps = ps_array[i, :]
-                if np.linalg.norm(pt_array[i + 549, :] - ps_array[i + 549, :]) != 0:
-                    spoke = pt - ps
-                    spoke_dir = spoke / InnerSpokeLength[i, 1]
-                    pt = ps + InnerSpokeLength[i, 1] * spoke_dir
-                else:
-                    pt = ps
-                InnerSpokeLength[i, 0] = np.linalg.norm(pt - ps)
-                pt_array[i, :] = pt
-            elif InnerSpokeLength[i, 0] < InnerSpokeLength[i, 1]:
-                pt = pt_array[i + 549, :]  # [i+549,:]
-                ps = ps_array[i + 549, :]  # [i+549,:]
-                if np.linalg.norm(pt_array[i - 549, :] - ps_array[i - 549, :]) != 0:
-                    spoke = pt - ps
-                    spoke_dir = spoke / InnerSpokeLength[i, 1]
-                    pt = ps + InnerSpokeLength[i, 0] * spoke_dir
-                else:
-                    pt = ps
-                InnerSpokeLength[i, 1] = np.linalg.norm(pt - ps)
-                pt_array[i + 549, :] = pt  # pt_array[i+549, :] = pt
-        # print('Equalize Spoke Length Finished Points: %s of Total 549' % str(finished_points))
-    # print(InnerSpokeLength)
-    # print(pt_array)
+def RefineSpokeDirectionBatch(surf_vtk, pt_vtk, ps_vtk, eps_d, pt_path, max_iter=50, metrics=None, warn_capped=True):
+    """
+    RefineSpokeDirection 的批量版本：一个亚区的所有 spokes 以 (N,3) 数组一起迭代，
+    每轮只做一次批量最近点+法向量查询，已收敛（1 - cos_angle <= eps_d）的 spokes 移出活动集。
+    返回方向优化后的 vtkPolyData 和每根 spoke 的迭代次数 (N,)。
+    """
+    pt_points = vtk_to_numpy(pt_vtk.GetPoints().GetData())
+    ps_points = vtk_to_numpy(ps_vtk.GetPoints().GetData())
+    geometry = get_surface_geometry(surf_vtk)
+
+    alpha = 0.5  # alpha 越大越接近 normalvector
+
+    # 初始方向与逐根版本一样按输入点的精度（通常是 float32）计算，之后的迭代为 float64
+    spoke = pt_points - ps_points
+    spoke_length = np.linalg.norm(spoke, axis=1)
+    valid = spoke_length != 0
+    spoke_dir = np.zeros(spoke.shape)
+    spoke_dir[valid] = spoke[valid] / spoke_length[valid, None]
+    spoke_length = spoke_length.astype(float)
+    pt_array = pt_points.astype(float)
+    ps_points = ps_points.astype(float)
+
+    iter_counts = np.zeros(pt_array.shape[0], dtype=int)
+    converged = ~valid
+    active = np.where(valid)[0]
+
+    while active.size > 0:
+        iter_counts[active] += 1
+
+        # Calculate normal vectors for all active spokes at once
+        _, nomalVector = geometry.closest_points_normals(pt_array[active])
+
+        # Update spoke directions
+        medial_vector = alpha * spoke_dir[active] + (1 - alpha) * nomalVector
+        mv = medial_vector / np.linalg.norm(medial_vector, axis=1)[:, None]
+        pt_array[active] = ps_points[active] + spoke_length[active, None] * mv
+
+        spoke = pt_array[active] - ps_points[active]
+        spoke_length[active] = np.linalg.norm(spoke, axis=1)
+        spoke_dir[active] = spoke / spoke_length[active, None]
+        cos_angle = np.sum(spoke_dir[active] * nomalVector, axis=1)
+
+        # 收敛的 spokes 移出活动集
+        done = (1 - cos_angle) <= eps_d
+        converged[active[done]] = True
+        active = active[~done & (iter_counts[active] < max_iter)]
+
+    num_capped = int(np.count_nonzero(~converged))
+    if num_capped > 0 and warn_capped:
+        logger.warning(f"Max iterations reached for RefineSpokeDirection on {num_capped} spokes in pt_path: {pt_path}")
+    if metrics is not None:
+        metrics['direction'] = dict(iteration_metrics(iter_counts, ~converged), mode='batch')
+
+    pt_vtk_DirectionRefined = numpy_to_vtk_polydata(pt_array)
+    return pt_vtk_DirectionRefined, iter_counts
+
+
+def EqualSpokeLength(pt_vtk, ps_vtk, eps_e, pairs=None):  # tips points, skeleton points, error
+    """
+    让上下成对的 spokes 长度相等：长度差超过 eps_e 时，把较长的 spoke 沿原方向缩短到较短的长度
+    （较短的长度为 0 时 tip 退回骨架点）。pairs 为 (up, down) 下标数组，来自模板索引的 spoke_pairs，
+    默认是 combined_label 的 [0, 549) / [549, 1098)。
+    """
+    if pairs is None:
+        pairs = spoke_pairs(get_template_index(), 'combined_label')
+    up, down = (np.asarray(idx, dtype=int) for idx in pairs)
+
+    pt_array = points_of(pt_vtk).astype(float)
+    ps_array = points_of(ps_vtk).astype(float)
+    spoke = pt_array - ps_array
+    spoke_length = np.linalg.norm(spoke, axis=1)
+
+    length_up = spoke_length[up]
+    length_down = spoke_length[down]
+    unequal = np.abs(length_up - length_down) > eps_e
+    longer = np.where(length_up > length_down, up, down)[unequal]
+    shorter_length = np.minimum(length_up, length_down)[unequal]
+
+    # 较长的 spoke 按比例缩放到较短的长度
+    pt_array[longer] = ps_array[longer] + spoke[longer] * (shorter_length / spoke_length[longer])[:, None]
+
     # 使用 numpy_to_vtk_polydata 来创建 vtkPolyData 对象
     pt_vtk_EualizedLength = numpy_to_vtk_polydata(pt_array)
     return pt_vtk_EualizedLength
 
 
-def ClosestSurfPoint(ps, surf_vtk):
-    # Set up the cell locator
-    cell_locator = vtk.vtkCellLocator()
-    cell_locator.SetDataSet(surf_vtk)
-    cell_locator.BuildLocator()
+def subfield_spoke_pairs(subfield, num_spokes, template_dir=None):
+    """亚区的上下配对：已知亚区名时取自 template_dir 的模板索引，否则按 spokes 数对半分。"""
+    template = get_template_index(template_dir)
+    if subfield not in template['subfield_names']:
+        up = np.arange(num_spokes // 2)
+        return up, up + num_spokes // 2
+    up, down = spoke_pairs(template, subfield)
+    if down.size > 0 and down[-1] >= num_spokes:
+        raise ValueError(f"{subfield} expects at least {down[-1] + 1} spokes, got {num_spokes}")
+    return up, down
 
-    # Variables for closest point search
-    c = [0.0, 0.0, 0.0]
-    cell_locator.FindClosestPoint(ps, c, vtk.reference(0), vtk.reference(0), vtk.reference(0.0))
 
-    # Get the closest point coordinates directly
-    p_closestPoint = np.array(c)
+def ClosestSurfPoint(ps, surf_vtk):
+    # Get the closest point coordinates directly (cell locator 由 SurfaceGeometry 缓存)
+    p_closestPoint, _ = get_surface_geometry(surf_vtk).closest_point(ps)
 
     return p_closestPoint
 
 
-def RepairSkeleton(surf_vtk, pt_vtk, ps_vtk):
+def RepairSkeleton(surf_vtk, pt_vtk, ps_vtk, metrics=None):
     # 将 VTK 点数据转换为 NumPy 数组
     pt_points = vtk_to_numpy(pt_vtk.GetPoints().GetData())
     ps_points = vtk_to_numpy(ps_vtk.GetPoints().GetData())
@@ -459,11 +1248,14 @@ def RepairSkeleton(surf_vtk, pt_vtk, ps_vtk):
     finished_points = 0
     invalid_num = 0
 
+    # 一次性批量判断所有骨架点是否在曲面内
+    ps_is_inside = get_inside_oracle(surf_vtk).classify(ps_points)
+
     for i in range(num_pt):
         finished_points += 1
         pt = pt_points[i, :]
         ps = ps_points[i, :]
-        IsInside = IsInsideCheck(ps[0], ps[1], ps[2], surf_vtk)
+        IsInside = ps_is_inside[i]
         if IsInside == 0:
             # print('Point %s is inside surface'% str(i))
             # 替换该点为最临近的曲面点
@@ -472,54 +1264,53 @@ def RepairSkeleton(surf_vtk, pt_vtk, ps_vtk):
         pt_array[i, :] = pt
         ps_array[i, :] = ps
         # print('Repair Skeleton Finished Points: %s' % str(finished_points))
+    if metrics is not None:
+        # 骨架点在曲面外的 spokes 被替换为最近的曲面点
+        num_outside = int(np.count_nonzero(ps_is_inside == 0))
+        metrics['split'] = {'spokes': int(num_pt), 'inside': int(num_pt) - num_outside, 'outside': num_outside}
     # 使用 numpy_to_vtk_polydata 来创建 vtkPolyData 对象
     RepairTips = numpy_to_vtk_polydata(pt_array)
     RepairSkeleton = numpy_to_vtk_polydata(ps_array)
     return RepairSkeleton, RepairTips
 
-def GenerateOutside_pts(surf_vtk, pt_vtk, ps_vtk):
-    num_pt = pt_vtk.GetNumberOfPoints()
-    pt_array = np.zeros((num_pt, 3))
-    num_ps = ps_vtk.GetNumberOfPoints()
-    ps_array = np.zeros((num_ps, 3))
-    finished_points = 0
+def GenerateOutside_pts(surf_vtk, pt_vtk, ps_vtk, metrics=None):
+    """
+    修复骨架点在曲面外的 spokes：把 spoke 拉长到 10，沿 pt -> ps 一次求出全部交点
+    （BSP 树每个曲面只建一次），与 IntersectionNumber1 一样最多数到第 3 个交点、保留最后两个：
+    第一个作为新的 tip，第二个作为新的骨架点；交点不足 2 个的 spoke 记为无效，pt = ps。
+    metrics 不为 None 时写入 metrics['outside']（spokes 数、无效数、交点个数分布）。
+    """
+    pt_array = points_of(pt_vtk).astype(float)
+    ps_array = points_of(ps_vtk).astype(float)
+
+    # pt 与 ps 重合的 spokes 保持不变
+    moving = np.flatnonzero(np.any(pt_array != ps_array, axis=1))
+    spoke = pt_array[moving] - ps_array[moving]
+    spoke /= np.linalg.norm(spoke, axis=1)[:, None]
+    stretched = ps_array[moving] + spoke * 10.0
+
+    # 与 IntersectionNumber1 一样，线段止于原 marching 的最后一个采样点（不判断 ps 本身）
+    intersections = get_surface_intersector(surf_vtk).crossings_batch(stretched,
+                                                                      marching_end(stretched, ps_array[moving]))
     invaild_num = 0
-    for i in range(num_ps):
-        finished_points += 1
-        pt_array[i, :] = np.array(pt_vtk.GetPoint(i))
-        ps_array[i, :] = np.array(ps_vtk.GetPoint(i))
-        pt = pt_array[i, :]
-        ps = ps_array[i, :]
-        if np.array_equal(pt, ps):
-            #print("Point ps is the same as point pt.")
-            pt_array[i, :] = pt
-            ps_array[i, :] = ps
+    for i, hits in zip(moving, intersections):
+        hits = hits[:3][-2:]
+        if hits.shape[0] >= 2:
+            pt_array[i, :] = hits[0]
+            ps_array[i, :] = hits[1]
         else:
-            # print(pt)
-            # print(ps)
-            spoke = pt - ps
-            # print(spoke)
-            length = np.linalg.norm(spoke)
-            # print(length)
-            spoke /= length
-            spoke *= 10.0
-            pt = ps+spoke
-            intersect_point, q = IntersectionNumber1(pt,ps,surf_vtk)
-            if q>=2:
-                #print('Spoke %s direction available,calculate intersection points'%str(i))
-                pt_array[i, :] = intersect_point[0]
-                ps_array[i, :] = intersect_point[1]
-                # print(pt_array[i, :])
-                # print(ps_array[i, :])
-            else:
-                #print('Spoke'  + str(i) + ' has ' + str(q) + ' points, direction unavailable,set pt equal ps' )
-                pt_array[i, :] = ps
-                ps_array[i, :] = ps
-                invaild_num += 1
-                # print(pt_array[i, :])
-                # print(ps_array[i, :])
-        #print('Repair Skeleton Finished Points: %s' % str(finished_points))
-    #print('invalid points num is ' + str(invaild_num))
+            pt_array[i, :] = ps_array[i, :]
+            invaild_num += 1
+
+    if invaild_num > 0:
+        logger.info(f"GenerateOutside_pts: {invaild_num} of {pt_array.shape[0]} outside spokes invalid (fewer than 2 crossings)")
+    if metrics is not None:
+        metrics['outside'] = {
+            'spokes': int(pt_array.shape[0]),
+            'invalid': invaild_num,
+            'intersections_histogram': count_histogram([min(hits.shape[0], 3) for hits in intersections]),
+        }
+
     # 使用 numpy_to_vtk_polydata 来创建 vtkPolyData 对象
     RepairTips = numpy_to_vtk_polydata(pt_array)
     RepairSkeleton = numpy_to_vtk_polydata(ps_array)
@@ -527,81 +1318,29 @@ def GenerateOutside_pts(surf_vtk, pt_vtk, ps_vtk):
 
 
 def list2array(ps, pt, indices):
-    ps_array = np.array(ps)
-    pt_array = np.array(pt)
-    index_array = np.array(indices)
-    num_row = index_array.shape[0]
-    ps = vtk.vtkPoints()
-    pt = vtk.vtkPoints()
-    for j in range(num_row):
-        ps.InsertNextPoint((ps_array[j, 0]), (ps_array[j, 1]), (ps_array[j, 2]))
-        pt.InsertNextPoint((pt_array[j, 0]), (pt_array[j, 1]), (pt_array[j, 2]))
-    ps_poly = vtk.vtkPolyData()
-    pt_poly = vtk.vtkPolyData()
-    ps_poly.SetPoints(ps)
-    pt_poly.SetPoints(pt)
-    return ps_poly, pt_poly, index_array
+    ps_poly = numpy_to_vtk_polydata(np.asarray(ps, dtype=float).reshape(-1, 3))
+    pt_poly = numpy_to_vtk_polydata(np.asarray(pt, dtype=float).reshape(-1, 3))
+    return ps_poly, pt_poly, np.asarray(indices, dtype=int)
 
 
 def classify_points(ps_vtk, pt_vtk, surf_vtk,):
-    num_ps = ps_vtk.GetNumberOfPoints()
-    ps_inside_indices = []
-    ps_outside_indices = []
-    ps_inside = []
-    pt_inside = []
-    ps_outside = []
-    pt_outside = []
-    finished_points = 0
-
-    for i in range(num_ps):
-        finished_points += 1
-        ps_array = np.array(ps_vtk.GetPoint(i))
-        pt_array = np.array(pt_vtk.GetPoint(i))
-        if IsInsideCheck(ps_array[0], ps_array[1], ps_array[2], surf_vtk) == 1:
-            #print('Point %s is inside surface' % str(i))
-            ps_inside.append(ps_array)
-            ps_inside_indices.append(i)
-            pt_inside.append(pt_array)
-        else:
-            #print('Point %s is outside surface' % str(i))
-            ps_outside.append(ps_array)
-            ps_outside_indices.append(i)
-            pt_outside.append(pt_array)
-
-    ps_inside_vtk, pt_inside_vtk, inside_indices = list2array(ps_inside, pt_inside, ps_inside_indices)
-    ps_outside_vtk, pt_outside_vtk, outside_indices = list2array(ps_outside, pt_outside, ps_outside_indices)
+    # 一次性批量判断所有骨架点是否在曲面内，按掩码划分 inside / outside spokes
+    spokes = SpokeSet.from_polydata(ps_vtk, pt_vtk)
+    spokes.inside = get_inside_oracle(surf_vtk).classify(spokes.skeleton) == 1
+    inside, outside, inside_indices, outside_indices = spokes.partition()
 
-    return ps_inside_vtk, pt_inside_vtk, ps_outside_vtk, pt_outside_vtk, inside_indices, outside_indices, num_ps
+    return (inside.skeleton_polydata(), inside.tips_polydata(), outside.skeleton_polydata(),
+            outside.tips_polydata(), inside_indices, outside_indices, len(spokes))
 
 def merge_vtk(ps_i, pt_i, i_index, ps_o, pt_o, o_index):
-    # 获取两个数据集的行数
-    row_inside = i_index.shape[0]
-    row_outside = o_index.shape[0]
-    num = row_inside + row_outside
-    
-    # 创建vtk点集
-    pts = vtk.vtkPoints()
-    pss = vtk.vtkPoints()
-
-    # 处理内部索引
-    for i in range(row_inside):
-        index_in = i_index[i]
-        pts.InsertNextPoint(pt_i.GetPoint(i))
-        pss.InsertNextPoint(ps_i.GetPoint(i))
-
-    # 处理外部索引
-    for z in range(row_outside):
-        index_out = o_index[z]
-        pts.InsertNextPoint(pt_o.GetPoint(z))
-        pss.InsertNextPoint(ps_o.GetPoint(z))
-
-    # 创建PolyData对象
-    RepairSkeleton = vtk.vtkPolyData()
-    RepairTips = vtk.vtkPolyData()
-
-    # 设置点数据
-    RepairSkeleton.SetPoints(pss)
-    RepairTips.SetPoints(pts)
+    # 按 inside / outside 下标写回原来的位置，保持 spokes 原有顺序
+    num = i_index.shape[0] + o_index.shape[0]
+    merged = SpokeSet(np.zeros((num, 3)), np.zeros((num, 3)))
+    merged.scatter(i_index, SpokeSet.from_polydata(ps_i, pt_i))
+    merged.scatter(o_index, SpokeSet.from_polydata(ps_o, pt_o))
+
+    RepairSkeleton = merged.skeleton_polydata()
+    RepairTips = merged.tips_polydata()
 
     return RepairSkeleton, RepairTips
 
@@ -613,7 +1352,7 @@ def check_vtk_has_cells(vtk_data, vtk_file_path):
     if vtk_data.GetNumberOfCells() == 0:
         raise ValueError(f"Error: VTK file '{vtk_file_path}' has no cells to build.")
 
-def Generate_final_pts(pt_path, ps_path, surf_path, output_path1, output_path2):
+def Generate_final_pts(pt_path, ps_path, surf_path, output_path1, output_path2, length_mode='march', direction_mode='loop', backend='mesh', equalize_length=False, subfield=None, resolution='single', target_reduction=0.75, validate_resolution=False, spokes=None, template_dir=None):
     eps_s = 0.1
     eps_d = 0.1
     eps_e = 0.1
@@ -621,68 +1360,78 @@ def Generate_final_pts(pt_path, ps_path, surf_path, output_path1, output_path2):
     output_dir1 = output_path1
     output_dir2 = output_path2
 
-    # 读取 pt VTK 文件
     pt = pt_path
-    pt_reader = vtk.vtkPolyDataReader()
-    pt_reader.SetFileName(pt)
-    pt_reader.Update()
-    pt_vtk = pt_reader.GetOutput()
-
-    # 检查 pt 数据是否有效
-    #check_vtk_has_cells(pt_vtk, pt)
-
-    # 读取 ps VTK 文件
-    ps = ps_path
-    ps_reader = vtk.vtkPolyDataReader()
-    ps_reader.SetFileName(ps)
-    ps_reader.Update()
-    ps_vtk = ps_reader.GetOutput()
-
-    # 检查 ps 数据是否有效
-    #check_vtk_has_cells(ps_vtk, ps)
-
-    # 读取 surf VTK 文件
-    surf = surf_path
-    surf_reader = vtk.vtkPolyDataReader()
-    surf_reader.SetFileName(surf)
-    surf_reader.Update()
-    surf_vtk = surf_reader.GetOutput()
+    metrics = {'pt_path': pt_path, 'surf_path': surf_path, 'subfield': subfield, 'backend': backend,
+               'length_mode': length_mode, 'direction_mode': direction_mode, 'resolution': resolution}
+    # resolution='multi' 时方向的前几轮迭代在抽稀曲面上，再在原曲面上收敛；长度总在原曲面上收敛
+    resolution_options = dict(resolution=resolution, target_reduction=target_reduction)
+    tic = time.perf_counter()
+
+    # 读取 spokes（skeleton = ps, tips = pt）和曲面；spokes 已读入时（融合模式）直接复制一份
+    spokes = SpokeSet.read(ps_path, pt_path) if spokes is None else spokes.copy()
+    surf_vtk = read_polydata(surf_path)
+    tic = finish_stage(metrics, 'read', tic)
 
     # 检查 surf 数据是否有效
-    #check_vtk_has_cells(surf_vtk, surf)
+    #check_vtk_has_cells(surf_vtk, surf_path)
+
+    # 选择曲面查询后端（'mesh' 精确网格，'sdf' 有符号距离场）
+    surf_query = get_surface_backend(surf_vtk, backend, eps_s)
+    queries_start = query_counts(surf_query)
+    tic = finish_stage(metrics, 'backend', tic)
 
     # 分割点（inside 和 outside）
-    ps_inside_vtk, pt_inside_vtk, ps_outside_vtk, pt_outside_vtk, inside_indices, outside_indices, num_all = classify_points(ps_vtk, pt_vtk, surf_vtk)
+    spokes.inside = get_inside_oracle(surf_query).classify(spokes.skeleton) == 1
+
+    if equalize_length:
+        # 上下配对的 inside spokes 等长（outside spokes 之后会按交点重建，不参与）
+        up, down = subfield_spoke_pairs(subfield, len(spokes), template_dir)
+        both_inside = spokes.inside[up] & spokes.inside[down]
+        spokes.tips = points_of(EqualSpokeLength(spokes.tips_polydata(), spokes.skeleton_polydata(), eps_e,
+                                                 (up[both_inside], down[both_inside])))
+
+    inside, outside, inside_indices, outside_indices = spokes.partition()
+    ps_inside_vtk = inside.skeleton_polydata()
+    pt_inside_vtk = inside.tips_polydata()
+    metrics['split'] = {'spokes': len(spokes), 'inside': len(inside), 'outside': len(outside)}
+    tic = finish_stage(metrics, 'classify', tic)
     print("Finish classify_points!")
     
-    pt_vtk_EualizedLength = pt_inside_vtk
-    pt_vtk_RefinedDircetion = pt_inside_vtk
     # refine inside spoke directions
-    pt_vtk_RefinedDircetion = RefineSpokeDirection(surf_vtk, pt_vtk_EualizedLength, ps_inside_vtk, eps_d, pt)
+    pt_vtk_RefinedDircetion = RefineSpokeDirection(surf_query, pt_inside_vtk, ps_inside_vtk, eps_d, pt, mode=direction_mode, metrics=metrics, **resolution_options)
+    tic = finish_stage(metrics, 'direction', tic)
     print("Finish RefineSpokeDirection!")
     
     # refine spoke length
-    pt_vtk_RefinedLength = RefineSpokeLength(surf_vtk, pt_vtk_RefinedDircetion, ps_inside_vtk, eps_s, pt)
+    pt_vtk_RefinedLength = RefineSpokeLength(surf_query, pt_vtk_RefinedDircetion, ps_inside_vtk, eps_s, pt, mode=length_mode, metrics=metrics)
+    inside.tips = points_of(pt_vtk_RefinedLength)
+    tic = finish_stage(metrics, 'length', tic)
     print("Finish RefineSpokeLength!")
+
+    if resolution == 'multi' and validate_resolution:
+        # 在原曲面上用单分辨率重新 refine 一遍，报告最终 tips 与之的偏差
+        pt_single = RefineSpokeDirection(surf_query, pt_inside_vtk, ps_inside_vtk, eps_d, pt, mode=direction_mode)
+        pt_single = RefineSpokeLength(surf_query, pt_single, ps_inside_vtk, eps_s, pt, mode=length_mode)
+        metrics['resolution_deviation'] = tip_deviation(pt_vtk_RefinedLength, pt_single)
+        tic = finish_stage(metrics, 'single_resolution', tic)
+        logger.info(f"Multi-resolution tip deviation in pt_path {pt}: {metrics['resolution_deviation']}")
  
     # 修复outside points
-    ps_outside_vtk_repair, pt_outside_vtk_repair = GenerateOutside_pts(surf_vtk, pt_outside_vtk, ps_outside_vtk)
+    ps_outside_vtk_repair, pt_outside_vtk_repair = GenerateOutside_pts(surf_query, outside.tips_polydata(), outside.skeleton_polydata(), metrics=metrics)
+    tic = finish_stage(metrics, 'outside', tic)
     print("Finish GenerateOutside_pts!")
 
-    # 合并 points
-    ps_final, pt_final = merge_vtk(ps_inside_vtk, pt_vtk_RefinedLength, inside_indices, ps_outside_vtk_repair, pt_outside_vtk_repair, outside_indices)
+    # 合并 points：按下标写回原来的位置
+    spokes.scatter(inside_indices, inside)
+    spokes.scatter(outside_indices, SpokeSet.from_polydata(ps_outside_vtk_repair, pt_outside_vtk_repair))
     print("Finish merge_vtk!")
 
     # 写入输出文件
-    writer = vtk.vtkPolyDataWriter()
-    writer.SetFileName(output_dir1)
-    writer.SetInputData(pt_final)
-    writer.Update()
-
-    writer = vtk.vtkPolyDataWriter()
-    writer.SetFileName(output_dir2)
-    writer.SetInputData(ps_final)
-    writer.Update()
+    spokes.write(output_dir1, output_dir2)
+    finish_stage(metrics, 'write', tic)
+    queries_end = query_counts(surf_query)
+    metrics['queries'] = {key: queries_end[key] - queries_start.get(key, 0) for key in queries_end}
+    write_refine_metrics(metrics, output_dir1)
     # print(f"Finished processing: {pt_path}, {ps_path}, {surf_path}")
 
 def load_mat_file(mat_filename):
@@ -721,43 +1470,48 @@ def Add_CrestSpoke(pt_vtk_RefinedDircetion, ps_repaired_vtk, crest_order, crest_
 
     return pt_vtk_addCrest, ps_vtk_addCrest        
    
-def Generate_final_hippo_pts(pt_path, ps_path, surf_path, output_path1, output_path2, is_followup=False):
+def Generate_final_hippo_pts(pt_path, ps_path, surf_path, output_path1, output_path2, is_followup=False, length_mode='march', direction_mode='loop', backend='mesh', equalize_length=False, resolution='single', target_reduction=0.75, validate_resolution=False, spokes=None, template_dir=None):
     eps_s = 0.1
     eps_d = 0.1
     eps_e = 0.1
     
-    ptod_name = "/home/nagao/point_order_skeleton.mat"  # 假设文件名为 point_order_skeleton.mat
-    point_order = load_mat_file(ptod_name)
+    # crest_order / crest_neighbor 来自 template_dir（本次运行的模板表格所在目录）编译好的模板索引
+    point_order = get_template_index(template_dir)
 
     output_dir1 = output_path1
     output_dir2 = output_path2
 
-    # 读取 pt VTK 文件
     pt = pt_path
-    pt_reader = vtk.vtkPolyDataReader()
-    pt_reader.SetFileName(pt)
-    pt_reader.Update()
-    pt_vtk = pt_reader.GetOutput()
-
-    # 读取 ps VTK 文件
-    ps = ps_path
-    ps_reader = vtk.vtkPolyDataReader()
-    ps_reader.SetFileName(ps)
-    ps_reader.Update()
-    ps_vtk = ps_reader.GetOutput()
-
-    # 读取 surf VTK 文件
-    surf = surf_path
-    surf_reader = vtk.vtkPolyDataReader()
-    surf_reader.SetFileName(surf)
-    surf_reader.Update()
-    surf_vtk = surf_reader.GetOutput()
+    metrics = {'pt_path': pt_path, 'surf_path': surf_path, 'subfield': 'combined_label', 'backend': backend,
+               'length_mode': length_mode, 'direction_mode': direction_mode, 'is_followup': is_followup,
+               'resolution': resolution}
+    # resolution='multi' 时方向的前几轮迭代在抽稀曲面上，再在原曲面上收敛；长度总在原曲面上收敛
+    resolution_options = dict(resolution=resolution, target_reduction=target_reduction)
+    tic = time.perf_counter()
+
+    # 读取 spokes（skeleton = ps, tips = pt）和曲面；spokes 已读入时（融合模式）直接复制一份
+    spokes = SpokeSet.read(ps_path, pt_path) if spokes is None else spokes.copy()
+    pt_vtk = spokes.tips_polydata()
+    ps_vtk = spokes.skeleton_polydata()
+    surf_vtk = read_polydata(surf_path)
+    tic = finish_stage(metrics, 'read', tic)
+
+    # 选择曲面查询后端（'mesh' 精确网格，'sdf' 有符号距离场）
+    surf_query = get_surface_backend(surf_vtk, backend, eps_s)
+    queries_start = query_counts(surf_query)
+    tic = finish_stage(metrics, 'backend', tic)
     
     # 修正骨架点露到外边的
-    ps_repaired_vtk, pt_repaired_vtk = RepairSkeleton(surf_vtk, pt_vtk, ps_vtk)
+    ps_repaired_vtk, pt_repaired_vtk = RepairSkeleton(surf_query, pt_vtk, ps_vtk, metrics=metrics)
+    tic = finish_stage(metrics, 'repair', tic)
+
+    if equalize_length:
+        # 上下配对的 spokes 等长（[0, 549) 与 [549, 1098)，crest spokes 不参与）
+        pt_vtk = EqualSpokeLength(pt_vtk, ps_repaired_vtk, eps_e, subfield_spoke_pairs('combined_label', pt_vtk.GetNumberOfPoints(), template_dir))
     
     # refine inside spoke directions
-    pt_vtk_RefinedDircetion = RefineSpokeDirection(surf_vtk, pt_vtk, ps_repaired_vtk, eps_d, pt)
+    pt_vtk_RefinedDircetion = RefineSpokeDirection(surf_query, pt_vtk, ps_repaired_vtk, eps_d, pt, mode=direction_mode, metrics=metrics, **resolution_options)
+    tic = finish_stage(metrics, 'direction', tic)
     print("Finish RefineSpokeDirection!")
     
     if not is_followup:  # 只有在处理基线数据时才需要装上crest spokes
@@ -768,19 +1522,299 @@ def Generate_final_hippo_pts(pt_path, ps_path, surf_path, output_path1, output_p
         pt_vtk_addCrest, ps_vtk_addCrest = pt_vtk_RefinedDircetion, ps_repaired_vtk
     
     # refine spoke length
-    pt_vtk_RefinedLength = RefineSpokeLength(surf_vtk, pt_vtk_addCrest, ps_vtk_addCrest, eps_s, pt)
+    pt_vtk_RefinedLength = RefineSpokeLength(surf_query, pt_vtk_addCrest, ps_vtk_addCrest, eps_s, pt, mode=length_mode, metrics=metrics)
+    tic = finish_stage(metrics, 'length', tic)
     print("Finish RefineSpokeLength!")
+
+    if resolution == 'multi' and validate_resolution:
+        # 在原曲面上用单分辨率重新 refine 一遍，报告最终 tips 与之的偏差
+        pt_single = RefineSpokeDirection(surf_query, pt_vtk, ps_repaired_vtk, eps_d, pt, mode=direction_mode)
+        if not is_followup:
+            pt_single, _ = Add_CrestSpoke(pt_single, ps_repaired_vtk, point_order['crest_order'], point_order['crest_neighbor'], lamda=1)
+        pt_single = RefineSpokeLength(surf_query, pt_single, ps_vtk_addCrest, eps_s, pt, mode=length_mode)
+        metrics['resolution_deviation'] = tip_deviation(pt_vtk_RefinedLength, pt_single)
+        tic = finish_stage(metrics, 'single_resolution', tic)
+        logger.info(f"Multi-resolution tip deviation in pt_path {pt}: {metrics['resolution_deviation']}")
     
     # 写入输出文件
-    writer = vtk.vtkPolyDataWriter()
-    writer.SetFileName(output_dir1)
-    writer.SetInputData(pt_vtk_RefinedLength)
-    writer.Update()
+    SpokeSet.from_polydata(ps_vtk_addCrest, pt_vtk_RefinedLength).write(output_dir1, output_dir2)
+    finish_stage(metrics, 'write', tic)
+    queries_end = query_counts(surf_query)
+    metrics['queries'] = {key: queries_end[key] - queries_start.get(key, 0) for key in queries_end}
+    write_refine_metrics(metrics, output_dir1)
+
+def collect_subject_units(baseline_path, followup_path, subfield_list, subject, side, group, spokes=None):
+    """
+    列出一个被试某一侧所有 (时间点, 亚区) 的处理单元，顺序与逐个处理时相同。
+    follow-up 单元读取最后一个基线时间点的同名亚区结果，depends_on 记录它依赖的基线单元。
+    spokes 为 SeperateSpokes.extract_spokes 返回的 {扫描路径: {亚区名: (pt, ps)}}（融合模式），
+    其中有的基线单元带上 'spokes'，直接使用内存中的 spokes，不再读 *_pt.vtk / *_ps.vtk。
+    """
+    scan_spokes = {os.path.abspath(str(scan)): subfields for scan, subfields in (spokes or {}).items()}
+    baseline_units = []
+    followup_units = []
+
+    raw_Inputdir = os.path.join(baseline_path, side, group, subject)  # 进入对应被试的文件夹
+    if not os.path.exists(raw_Inputdir):
+        return baseline_units, followup_units
+
+    sub_dir = None
+    for timepoint in os.listdir(raw_Inputdir):  # 遍历每个扫描时间点
+        sub_dir = os.path.join(raw_Inputdir, timepoint)
+        for subfield_name in subfield_list:  # 遍历每个亚区
+            baseline_units.append({
+                'key': (side, timepoint, subfield_name),
+                'side': side,
+                'subject': subject,
+                'timepoint': timepoint,
+                'subfield': subfield_name,
+                'pt_path': os.path.join(sub_dir, f"{subfield_name}_pt.vtk"),
+                'ps_path': os.path.join(sub_dir, f"{subfield_name}_ps.vtk"),
+                'surf_path': os.path.join(sub_dir, f"Remesh_{subfield_name}_transformed.vtk"),
+                'output_path1': os.path.join(sub_dir, f"{subfield_name}_pt_refined.vtk"),
+                'output_path2': os.path.join(sub_dir, f"{subfield_name}_ps_refined.vtk"),
+                'is_followup': False,
+                'depends_on': None,
+            })
+            extracted = scan_spokes.get(os.path.abspath(sub_dir), {}).get(subfield_name)
+            if extracted is not None:
+                pt, ps = extracted
+                baseline_units[-1]['spokes'] = SpokeSet(ps, pt)
+    if sub_dir is None:
+        return baseline_units, followup_units
+    baseline_timepoint = os.path.basename(sub_dir)
+
+    followup_subject_dir = os.path.join(followup_path, side, group, subject)  # 进入随访数据对应被试文件夹
+    if os.path.exists(followup_subject_dir):
+        for timepoints in os.listdir(followup_subject_dir):  # 遍历随访扫描时间点
+            fl_sub_dir = os.path.join(followup_subject_dir, timepoints)
+            for subfield_name in subfield_list:  # 遍历每个亚区
+                followup_units.append({
+                    'key': (side, timepoints, subfield_name),
+                    'side': side,
+                    'subject': subject,
+                    'timepoint': timepoints,
+                    'subfield': subfield_name,
+                    'pt_path': os.path.join(sub_dir, f"{subfield_name}_pt_refined.vtk"),
+                    'ps_path': os.path.join(sub_dir, f"{subfield_name}_ps_refined.vtk"),
+                    'surf_path': os.path.join(fl_sub_dir, f"Remesh_{subfield_name}_transformed.vtk"),
+                    'output_path1': os.path.join(fl_sub_dir, f"{subfield_name}_pt_refined.vtk"),
+                    'output_path2': os.path.join(fl_sub_dir, f"{subfield_name}_ps_refined.vtk"),
+                    'is_followup': True,
+                    'depends_on': (side, baseline_timepoint, subfield_name),
+                })
+    return baseline_units, followup_units
+
+
+def unit_manifest_path(unit):
+    """处理单元的 manifest：*_pt_refined.vtk 旁边的 *_pt_refined_manifest.json（归档模式下为归档成员）。"""
+    return os.path.splitext(unit['output_path1'])[0] + "_manifest.json"
+
+
+def unit_files(unit):
+    """单元的输入、输出文件（磁盘上的 .vtk / .vtp，或扫描归档中的成员，见 spoke_archive 的 entry_*）。"""
+    inputs = {'pt': unit['pt_path'], 'ps': unit['ps_path'], 'surf': unit['surf_path']}
+    outputs = {'pt_refined': unit['output_path1'], 'ps_refined': unit['output_path2']}
+    return inputs, outputs
+
+
+def unit_file_inputs(unit):
+    """需要从磁盘读取的输入；融合模式下 pt/ps 在内存中，不要求文件存在。"""
+    inputs, _ = unit_files(unit)
+    if unit.get('spokes') is not None:
+        return {'surf': inputs['surf']}
+    return inputs
+
+
+def unit_input_sha1(unit, key, path):
+    """输入的 SHA-1；内存中的 spokes 按数组数据计算（与归档成员的算法相同）。"""
+    spokes = unit.get('spokes')
+    if spokes is not None and key in ('pt', 'ps'):
+        return array_sha1(spokes.tips if key == 'pt' else spokes.skeleton)
+    return entry_sha1(path)
+
+
+# 每个进程计算过的代码版本，按模板目录缓存
+_code_versions = {}
+
+
+def code_version(template_dir=None):
+    """
+    refine 代码（本文件及其读写/模板模块 mesh_io、spoke_archive、template_index）和模板表格的 SHA-1，
+    记录在 manifest 中：代码或模板改动后 resume 不再复用旧的结果。
+    """
+    import mesh_io
+    import spoke_archive
+    import template_index
+    if template_dir is None:
+        template_dir = os.path.dirname(os.path.abspath(__file__))
+    template_dir = os.path.abspath(str(template_dir))
+    version = _code_versions.get(template_dir)
+    if version is None:
+        digest = hashlib.sha1()
+        sources = [os.path.abspath(path) for path in
+                   (__file__, mesh_io.__file__, spoke_archive.__file__, template_index.__file__)]
+        sources += [os.path.join(template_dir, name) for name in
+                    (POINT_ORDER_NAME, SUBFIELD_LIST_NAME, SUBFIELD_PYTHON_NAME)]
+        for path in sources:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        version = _code_versions[template_dir] = digest.hexdigest()
+    return version
+
+
+def write_unit_manifest(unit, refine_options, code=None):
+    """
+    处理单元完成后记录输入、输出文件的哈希、refine 参数和代码版本（code_version）
+    （最后写，存在即表示输出完整）。
+    """
+    inputs, outputs = unit_files(unit)
+    manifest = {
+        'options': refine_options,
+        'code': code,
+        'inputs': {key: unit_input_sha1(unit, key, path) for key, path in inputs.items()},
+        'outputs': {key: entry_sha1(path) for key, path in outputs.items()},
+    }
+    write_json_entry(manifest, unit_manifest_path(unit))
+
+
+def unit_is_up_to_date(unit, refine_options, code=None):
+    """
+    输出文件存在、manifest 中的输入/输出哈希、refine 参数和代码版本与当前一致时返回 True，
+    此时可以跳过该单元。
+    """
+    try:
+        manifest = read_json_entry(unit_manifest_path(unit))
+    except (OSError, ValueError):
+        return False
+    if manifest is None:
+        return False
+    if manifest.get('options') != refine_options or manifest.get('code') != code:
+        return False
+
+    inputs, outputs = unit_files(unit)
+    file_inputs = unit_file_inputs(unit)
+    if not all(entry_exists(path) for path in list(file_inputs.values()) + list(outputs.values())):
+        return False
+    # 不比较修改时间：归档的修改时间是整个文件的，追加 metrics/manifest 等成员后会变
+    if any(manifest['outputs'].get(key) != entry_sha1(path) for key, path in outputs.items()):
+        return False
+    return all(manifest['inputs'].get(key) == unit_input_sha1(unit, key, path) for key, path in inputs.items())
+
+
+def unit_refine_options(length_mode='march', direction_mode='loop', backend='mesh', equalize_length=False,
+                        resolution='single', target_reduction=0.75, validate_resolution=False):
+    """manifest 中记录的 refine 参数（参数改变时 resume 重新处理）。"""
+    return dict(length_mode=length_mode, direction_mode=direction_mode, backend=backend,
+                equalize_length=equalize_length, resolution=resolution,
+                target_reduction=target_reduction, validate_resolution=validate_resolution)
+
+
+def run_subfield_unit(unit, length_mode='march', direction_mode='loop', backend='mesh', equalize_length=False,
+                      resolution='single', target_reduction=0.75, validate_resolution=False, resume=True,
+                      spokes=None, template_dir=None):
+    """
+    处理一个 (时间点, 亚区) 单元；resume=True 时跳过 manifest 显示已完成的单元。
+    spokes 为已读入的输入 spokes，未给出时使用单元中内存里的 spokes（融合模式），
+    都没有时读取 pt_path / ps_path。
+    template_dir 为模板表格所在目录（None 时为 process_subject 所在目录）。
+    """
+    if spokes is None:
+        spokes = unit.get('spokes')
+    refine_options = unit_refine_options(length_mode, direction_mode, backend, equalize_length, resolution,
+                                         target_reduction, validate_resolution)
+    code = code_version(template_dir)
+    if resume and unit_is_up_to_date(unit, refine_options, code):
+        print(f"Skipping up-to-date Subject: {unit['subject']}, Timepoint: {unit['timepoint']}, Subfield: {unit['subfield']}")
+        return
+    if unit['is_followup']:
+        print(f"Processing Follow-up for Subject: {unit['subject']}, Timepoint: {unit['timepoint']}, Subfield: {unit['subfield']}")
+    else:
+        print(f"Processing Subject: {unit['subject']}, Timepoint: {unit['timepoint']}, Subfield: {unit['subfield']}")
+    if unit['subfield'] == "combined_label":
+        # 针对 combined_label 调用专用函数
+        Generate_final_hippo_pts(unit['pt_path'], unit['ps_path'], unit['surf_path'], unit['output_path1'],
+                                 unit['output_path2'], is_followup=unit['is_followup'], spokes=spokes,
+                                 template_dir=template_dir, **refine_options)
+    else:
+        # 其他 subfield 使用通用函数
+        Generate_final_pts(unit['pt_path'], unit['ps_path'], unit['surf_path'], unit['output_path1'],
+                           unit['output_path2'], subfield=unit['subfield'], spokes=spokes,
+                           template_dir=template_dir, **refine_options)
+    write_unit_manifest(unit, refine_options, code)
+
+
+def run_units_serial(units, **refine_options):
+    """按顺序逐个处理；每换一个扫描时间点释放上一扫描的曲面缓存。"""
+    last_scan = None
+    for unit in units:
+        scan = (unit['side'], unit['timepoint'], unit['is_followup'])
+        if last_scan is not None and scan != last_scan:
+            release_surface_geometry()
+        last_scan = scan
+        run_subfield_unit(unit, **refine_options)
+    release_surface_geometry()
+
+
+def run_units_parallel(baseline_units, followup_units, num_workers, **refine_options):
+    """
+    用进程池调度处理单元。同一时间点内的亚区互不依赖，基线单元全部立即提交；
+    follow-up 单元在它依赖的基线亚区完成后再提交。出错的单元（及依赖它的 follow-up）
+    记录到日志，其余单元照常处理，最后统一报错。
+    """
+    baseline_keys = set(unit['key'] for unit in baseline_units)
+    waiting = {}
+    ready = list(baseline_units)
+    for unit in followup_units:
+        if unit['depends_on'] in baseline_keys:
+            waiting.setdefault(unit['depends_on'], []).append(unit)
+        else:
+            ready.append(unit)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(run_subfield_unit, unit, **refine_options): unit for unit in ready}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit = futures.pop(future)
+                dependents = waiting.pop(unit['key'], [])
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f"Failed: side {unit['side']}, timepoint {unit['timepoint']}, subfield {unit['subfield']}")
+                    failed.append(unit['key'])
+                    failed.extend(dep['key'] for dep in dependents)
+                    continue
+                for dep in dependents:
+                    futures[executor.submit(run_subfield_unit, dep, **refine_options)] = dep
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} subfield units failed: {failed}")
+
+
+def process_subject_sides(baseline_path, followup_path, subfield_list, subject, sides, group,
+                          num_workers=1, spokes=None, **refine_options):
+    """
+    处理一个被试的若干侧（如 ['Left', 'Right']）。num_workers > 1 时所有侧、所有时间点的
+    亚区放进同一个进程池并行处理。
+    spokes 为第八步 extract_spokes 的返回值时，基线单元直接使用内存中的 spokes（融合模式）。
+    """
+    baseline_units = []
+    followup_units = []
+    for side in sides:
+        print(f"Processing Side: {side}, Subject: {subject}, Group: {group}")
+        side_baseline, side_followup = collect_subject_units(baseline_path, followup_path, subfield_list,
+                                                             subject, side, group, spokes=spokes)
+        baseline_units.extend(side_baseline)
+        followup_units.extend(side_followup)
+
+    if num_workers > 1:
+        run_units_parallel(baseline_units, followup_units, num_workers, **refine_options)
+    else:
+        run_units_serial(baseline_units + followup_units, **refine_options)
 
-    writer = vtk.vtkPolyDataWriter()
-    writer.SetFileName(output_dir2)
-    writer.SetInputData(ps_vtk_addCrest)
-    writer.Update()
 
 def process_single_subject(
     baseline_path,         # 跟 args.baseline_path 对应
@@ -789,83 +1823,87 @@ def process_single_subject(
     subject,               # 跟 args.subject 对应
     side,                  # 跟 args.side 对应
     group,                 # 跟 args.group 对应
-    subfield_file          # 表格原始对象（可能用于原始信息）
+    subfield_file,         # 亚区表格路径，其所在目录的模板表格用于 crest / 配对下标
+    length_mode='march',   # spoke 长度优化方式：'march' 逐步移动，'direct' 直接求边界交点
+    direction_mode='loop', # spoke 方向优化方式：'loop' 逐根迭代，'batch' 所有 spokes 一起迭代
+    backend='mesh',        # 曲面查询后端：'mesh' 精确网格，'sdf' 有符号距离场
+    num_workers=1,         # 并行进程数，1 表示逐个处理
+    equalize_length=False, # 是否让上下配对的 spokes 等长
+    resume=True,           # 跳过输出已完整、输入和代码版本未变的亚区
+    resolution='single',   # 'multi' 时方向的前几轮迭代在抽稀曲面上，再在原曲面上收敛
+    target_reduction=0.75, # 'multi' 时抽稀曲面去掉的三角形比例
+    validate_resolution=False  # 'multi' 时另做一遍单分辨率 refine，把 tips 偏差记入 metrics
 ):
     """
     处理单个被试的所有数据，包括基线和多个扫描时间点。
     """
-    # 处理基线数据
-    raw_dir = os.path.join(baseline_path, side)  # 对应侧面的文件夹
-    print(f"Processing Side: {side}, Subject: {subject}, Group: {group}")
-
-    # 组文件夹在侧面文件夹下，进入组文件夹
-    raw_Inputdir = os.path.join(raw_dir, group, subject)  # 进入对应被试的文件夹
-    if os.path.exists(raw_Inputdir):
-        for timepoint in os.listdir(raw_Inputdir):  # 遍历每个扫描时间点
-            sub_dir = os.path.join(raw_Inputdir, timepoint)
+    template_dir = template_dir_of(subfield_file) if isinstance(subfield_file, (str, os.PathLike)) else None
+    process_subject_sides(baseline_path, followup_path, list(subfield_list), subject, [side], group,
+                          num_workers=num_workers, length_mode=length_mode,
+                          direction_mode=direction_mode, backend=backend, equalize_length=equalize_length,
+                          resume=resume, resolution=resolution, target_reduction=target_reduction,
+                          validate_resolution=validate_resolution, template_dir=template_dir)
 
-            for subfield_name in subfield_list:  # 遍历每个亚区
-                pt_path = os.path.join(sub_dir, f"{subfield_name}_pt.vtk")
-                ps_path = os.path.join(sub_dir, f"{subfield_name}_ps.vtk")
-                surf_path = os.path.join(sub_dir, f"Remesh_{subfield_name}_transformed.vtk")
-                output_path1 = os.path.join(sub_dir, f"{subfield_name}_pt_refined.vtk")
-                output_path2 = os.path.join(sub_dir, f"{subfield_name}_ps_refined.vtk")
-
-                # 日志并调用处理函数
-                print(f"Processing Subject: {subject}, Timepoint: {timepoint}, Subfield: {subfield_name}")
-                if subfield_name == "combined_label":
-                    # 针对 combined_label 调用专用函数
-                    Generate_final_hippo_pts(pt_path, ps_path, surf_path, output_path1, output_path2, is_followup=False)
-                else:
-                    # 其他 subfield 使用通用函数
-                    Generate_final_pts(pt_path, ps_path, surf_path, output_path1, output_path2)
-
-        # 处理Follow-ups
-        followup_dir = os.path.join(followup_path, side)  # 对应侧面文件夹
-        print(f"Processing Follow-ups for Subject: {subject}, Group: {group}")
-
-        followup_subject_dir = os.path.join(followup_dir, group, subject)  # 进入随访数据对应被试文件夹
-        if os.path.exists(followup_subject_dir):
-            for timepoints in os.listdir(followup_subject_dir):  # 遍历随访扫描时间点
-                fl_sub_dir = os.path.join(followup_subject_dir, timepoints)
-                for subfield_name in subfield_list:  # 遍历每个亚区
-                    pt_path = os.path.join(sub_dir, f"{subfield_name}_pt_refined.vtk")
-                    ps_path = os.path.join(sub_dir, f"{subfield_name}_ps_refined.vtk")
-                    surf_path = os.path.join(fl_sub_dir, f"Remesh_{subfield_name}_transformed.vtk")
-                    output_path1 = os.path.join(fl_sub_dir, f"{subfield_name}_pt_refined.vtk")
-                    output_path2 = os.path.join(fl_sub_dir, f"{subfield_name}_ps_refined.vtk")
-
-                    # 日志并调用处理函数
-                    print(f"Processing Follow-up for Subject: {subject}, Timepoint: {timepoints}, Subfield: {subfield_name}")
-                    if subfield_name == "combined_label":
-                        # 针对 combined_label 调用专用函数
-                        Generate_final_hippo_pts(pt_path, ps_path, surf_path, output_path1, output_path2, is_followup=True)
-                    else:
-                        # 其他 subfield 使用通用函数
-                        Generate_final_pts(pt_path, ps_path, surf_path, output_path1, output_path2)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Process a single subject's data.")
     parser.add_argument('subject', type=str, help="The subject ID to process")
-    parser.add_argument('side', type=str, choices=['Left', 'Right'], help="The side (Left or Right)")
+    parser.add_argument('side', type=str, choices=['Left', 'Right', 'Both'], help="The side (Left, Right or Both)")
     parser.add_argument('group', type=str, help="The group to process")
     parser.add_argument('--baseline_path', type=str, required=True, help="Path to baseline data")
     parser.add_argument('--followup_path', type=str, required=True, help="Path to followup data")
     parser.add_argument('--subfield_file', type=str, required=True, help="Path to subfield list file (.xlsx)")
+    parser.add_argument('--length_mode', type=str, choices=['march', 'direct'], default='march',
+                        help="Spoke length refinement: step by eps_s ('march') or jump to the boundary hit ('direct')")
+    parser.add_argument('--direction_mode', type=str, choices=['loop', 'batch'], default='loop',
+                        help="Spoke direction refinement: one spoke at a time ('loop') or all spokes together ('batch')")
+    parser.add_argument('--backend', type=str, choices=['mesh', 'sdf'], default='mesh',
+                        help="Surface queries on the exact mesh ('mesh') or on a narrow-band signed distance field ('sdf'); "
+                             "building the field takes seconds, so 'sdf' only pays off for large spoke counts")
+    parser.add_argument('--equalize_length', action='store_true',
+                        help="Equalize the lengths of paired up/down spokes before direction refinement")
+    parser.add_argument('--resolution', type=str, choices=['single', 'multi'], default='single',
+                        help="Refine on the full mesh only ('single') or start direction refinement on a decimated copy ('multi'); "
+                             "'multi' only pays off on dense surfaces where direction refinement needs many iterations")
+    parser.add_argument('--target_reduction', type=float, default=0.75,
+                        help="Fraction of triangles removed from the coarse surface in multi-resolution mode")
+    parser.add_argument('--validate_resolution', action='store_true',
+                        help="Also run single-resolution refinement and record the tip deviation in the metrics")
+    parser.add_argument('--no_resume', action='store_true',
+                        help="Reprocess every subfield even if its refined outputs are up to date")
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help="Number of worker processes for subfields/timepoints (1 = serial)")
+    parser.add_argument('--mesh_format', type=str, choices=MESH_FORMATS, default=None,
+                        help="On-disk format for refined spokes: ascii, binary legacy VTK, or compressed .vtp")
+    parser.add_argument('--spoke_archive', action='store_true',
+                        help="Read and write spokes through each scan's spokes.npz archive instead of per-subfield VTK files")
 
     args = parser.parse_args()
+    if args.mesh_format:
+        set_mesh_format(args.mesh_format)
+    if args.spoke_archive:
+        set_archive_mode(True)
 
     # 读取 subfield 表格
-    subfield_file = pd.read_excel(args.subfield_file)
-    subfield_list = subfield_file['Subfield']
+    subfield_list = load_subfield_list(args.subfield_file)
 
-    # 调用处理函数
-    process_single_subject(
+    # 调用处理函数（Both 时左右两侧放进同一个进程池）
+    sides = ['Left', 'Right'] if args.side == 'Both' else [args.side]
+    process_subject_sides(
         baseline_path=args.baseline_path,
         followup_path=args.followup_path,
-        subfield_list=subfield_list,
+        subfield_list=list(subfield_list),
         subject=args.subject,
-        side=args.side,
+        sides=sides,
         group=args.group,
-        subfield_file=subfield_file
+        num_workers=args.num_workers,
+        length_mode=args.length_mode,
+        direction_mode=args.direction_mode,
+        backend=args.backend,
+        equalize_length=args.equalize_length,
+        resume=not args.no_resume,
+        resolution=args.resolution,
+        target_reduction=args.target_reduction,
+        validate_resolution=args.validate_resolution,
+        template_dir=template_dir_of(args.subfield_file)
     )
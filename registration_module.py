@@ -1,14 +1,22 @@
 import os
+import json
 import vtk
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
-from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk, numpy_to_vtkIdTypeArray
+from mesh_io import read_mesh, write_mesh, set_mesh_format, MESH_FORMATS
+from spoke_archive import archive_enabled, set_archive_mode, write_entries
+
+def legacy_cells(polydata):
+    """polydata 的三角形单元，旧格式的 flat 数组 [3, a, b, c, 3, ...]（numpy 视图持有导出数组的引用）。"""
+    legacy = vtk.vtkIdTypeArray()
+    polydata.GetPolys().ExportLegacyFormat(legacy)
+    return vtk_to_numpy(legacy)
+
 
 def read_stl(filepath):
-    """读取 STL 文件的点和三角形数据。"""
-    reader = vtk.vtkSTLReader()
-    reader.SetFileName(filepath)
-    reader.Update()
-    polydata = reader.GetOutput()
+    """读取 STL 文件的点和三角形数据（ASCII/二进制自动识别）。"""
+    polydata = read_mesh(filepath)
 
     # 检查文件是否有效
     if polydata.GetNumberOfPoints() == 0:
@@ -19,7 +27,7 @@ def read_stl(filepath):
     points = vtk_to_numpy(polydata.GetPoints().GetData())
     
     # 提取单元数据
-    cells = vtk_to_numpy(polydata.GetPolys().GetData())  # 获取单元数据
+    cells = legacy_cells(polydata)  # 获取单元数据
     if cells.size == 0:
         print(f"Warning: No cells found in {filepath}. Skipping.")
     
@@ -27,11 +35,8 @@ def read_stl(filepath):
 
 
 def read_vtk(filepath):
-    """读取 VTK 文件的点数据和单元数据。"""
-    reader = vtk.vtkPolyDataReader()
-    reader.SetFileName(filepath)
-    reader.Update()
-    polydata = reader.GetOutput()
+    """读取 VTK 文件的点数据和单元数据（legacy ASCII/二进制或 .vtp，自动识别）。"""
+    polydata = read_mesh(filepath)
 
     # 检查文件是否有效
     if polydata.GetNumberOfPoints() == 0:
@@ -42,83 +47,303 @@ def read_vtk(filepath):
     points = vtk_to_numpy(polydata.GetPoints().GetData())
     
     # 提取单元数据
-    cells = vtk_to_numpy(polydata.GetPolys().GetData())  # 获取单元数据
+    cells = legacy_cells(polydata)  # 获取单元数据
     if cells.size == 0:
         print(f"Warning: No cells found in {filepath}. Skipping.")
     
     return points, cells
 
 
+def cells_to_vtk(cells):
+    """
+    把 flat 的单元数组（[3, a, b, c, 3, ...]，即 read_stl/read_vtk 返回的格式）转换为 vtkCellArray。
+    全是三角形时直接用 offsets/connectivity 两个 int64 数组 SetData：旧格式中点数与下标交错，
+    connectivity 需要一次拷贝（同时转为 int64），offsets 直接生成；之后 VTK 数组与 numpy 共享内存
+    并持有其引用，SetData 不再转换（用 vtkTypeInt64Array 而不是 vtkIdTypeArray，
+    写出的文件与逐个 InsertNextCell 时完全一致）。否则交给 VTK 解析旧格式。
+    """
+    cells = np.asarray(cells)
+    vtk_cells = vtk.vtkCellArray()
+    if cells.size % 4 == 0 and np.all(cells[0::4] == 3):
+        n_cells = cells.size // 4
+        connectivity = np.array(cells.reshape(n_cells, 4)[:, 1:], dtype=np.int64).ravel()
+        offsets = np.arange(0, 3 * n_cells + 1, 3, dtype=np.int64)
+        vtk_cells.SetData(numpy_to_vtk(offsets, array_type=vtk.VTK_TYPE_INT64),
+                          numpy_to_vtk(connectivity, array_type=vtk.VTK_TYPE_INT64))
+    else:
+        # 混合单元：由 VTK 解析 [n, id0, ..., n, ...] 的旧格式
+        vtk_cells.ImportLegacyFormat(numpy_to_vtkIdTypeArray(np.ascontiguousarray(cells, dtype=np.int64), deep=True))
+    return vtk_cells
+
+
 def points_to_polydata(points, cells=None):
     """将点数据转换为 vtkPolyData 格式，考虑到可能有单元数据。"""
     polydata = vtk.vtkPolyData()
     vtk_points = vtk.vtkPoints()
-    vtk_points.SetData(numpy_to_vtk(points))
+    # numpy_to_vtk 要求连续内存；VTK 数组持有 numpy 数组的引用，不复制
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points)))
     polydata.SetPoints(vtk_points)
-    
+
     if cells is not None and cells.size > 0:
-        # 需要将单元数据添加到 polydata 中
-        vtk_cells = vtk.vtkCellArray()
-        
-        # cells 为 flat list，按三个点为一组组成三角形单元
-        for i in range(0, len(cells), 4):  # 每四个数字构成一个三角形
-            # vtkCells.InsertNextCell() 需要插入每个三角形的三个点的索引
-            vtk_cells.InsertNextCell(3)  # 3表示单元格包含3个点
-            vtk_cells.InsertCellPoint(cells[i+1])  # 第一个点索引
-            vtk_cells.InsertCellPoint(cells[i+2])  # 第二个点索引
-            vtk_cells.InsertCellPoint(cells[i+3])  # 第三个点索引
-        
-        polydata.SetPolys(vtk_cells)
+        polydata.SetPolys(cells_to_vtk(cells))
 
     return polydata
 
 
-def rigid_registration(source_points, target_points, source_cells=None, target_cells=None):
-    """刚性配准（基于 ICP）。"""
-    # 将 numpy 点数据和单元数据转换为 vtkPolyData
-    source_polydata = points_to_polydata(source_points, source_cells)
-    target_polydata = points_to_polydata(target_points, target_cells)
-
-    # 设置 ICP 转换
+class RegistrationTarget:
+    """配准目标网格：点、单元，以及按需构建并缓存的 polydata、KD 树和 VTK 单元定位器。"""
+
+    def __init__(self, points, cells, polydata=None):
+        self.points = points
+        self.cells = cells
+        self._polydata = polydata
+        self._tree = None
+        self._locator = None
+
+    @property
+    def polydata(self):
+        if self._polydata is None:
+            self._polydata = points_to_polydata(self.points, self.cells)
+        return self._polydata
+
+    @property
+    def tree(self):
+        """KD 树（rigid_icp 引擎及 RMS 计算使用）。"""
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+    @property
+    def locator(self):
+        """VTK ICP 使用的单元定位器；目标不变时 VTK 不会重建。"""
+        if self._locator is None:
+            self._locator = vtk.vtkCellLocator()
+            self._locator.SetDataSet(self.polydata)
+            self._locator.SetNumberOfCellsPerBucket(1)
+            self._locator.BuildLocator()
+        return self._locator
+
+
+class RegistrationContext:
+    """
+    配准缓存：每个模板文件在进程内只读取一次（文件修改后重新读取），
+    其 polydata / KD 树 / 定位器随 RegistrationTarget 一起保留，供后续被试复用。
+    """
+
+    def __init__(self):
+        self._templates = {}
+
+    def template(self, template_file):
+        path = os.path.abspath(str(template_file))
+        mtime = os.path.getmtime(path)
+        cached = self._templates.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        points, cells = read_vtk(path)
+        if points is None:
+            return None
+        target = RegistrationTarget(points, cells)
+        self._templates[path] = (mtime, target)
+        return target
+
+
+# 进程内默认的配准缓存（process_subject 未传入 context 时使用）
+_registration_context = RegistrationContext()
+
+
+def vtk_icp(source_polydata, target_polydata, max_iter=50, locator=None):
+    """VTK 的 ICP（刚体模式，先对齐质心），返回 4x4 numpy 矩阵。"""
     icp = vtk.vtkIterativeClosestPointTransform()
     icp.SetSource(source_polydata)  # 源点集
     icp.SetTarget(target_polydata)  # 目标点集
+    if locator is not None:
+        icp.SetLocator(locator)
     icp.GetLandmarkTransform().SetModeToRigidBody()
-    icp.SetMaximumNumberOfIterations(50)
+    icp.SetMaximumNumberOfIterations(max_iter)
     icp.StartByMatchingCentroidsOn()
     icp.Update()
+    return matrix_to_numpy(icp.GetMatrix())
 
-    # 获取变换矩阵
-    matrix = icp.GetMatrix()
 
-    # 应用变换矩阵到源点集
-    transformed_points = []
-    for point in source_points:
-        x, y, z, _ = matrix.MultiplyPoint([*point, 1.0])
-        transformed_points.append([x, y, z])
+def register_rigid(source_points, source_cells, target, engine='vtk', compare_engines=False, icp_options=None):
+    """
+    把源网格刚性配准到目标网格（RegistrationTarget），返回 (4x4 变换矩阵, info)。
+
+    engine='vtk' 使用 vtkIterativeClosestPointTransform（固定 50 次迭代）；
+    engine='kdtree' 使用 rigid_icp 中基于 KD 树的 ICP（icp_options 传给 rigid_icp.icp）。
+    compare_engines=True 时两种都运行，info 中记录各自的 RMS 以及两者变换的差异。
+    """
+    from rigid_icp import icp, rms_distance, transform_points, transform_difference
+
+    info = {'engine': engine}
+    results = {}
+    if engine == 'vtk' or compare_engines:
+        results['vtk'] = vtk_icp(points_to_polydata(source_points, source_cells), target.polydata,
+                                 locator=target.locator)
+    if engine == 'kdtree' or compare_engines:
+        results['kdtree'], info['kdtree'] = icp(source_points, target.points, target_tree=target.tree,
+                                                **(icp_options or {}))
+    if engine not in results:
+        raise ValueError(f"Unknown registration engine: {engine}")
+
+    if compare_engines:
+        info.setdefault('vtk', {})['rms'] = rms_distance(transform_points(source_points, results['vtk']), target.tree)
+        info['difference'] = transform_difference(results['vtk'], results['kdtree'], source_points)
+    return results[engine], info
+
 
-    return np.array(transformed_points)
+def rigid_registration(source_points, target_points, source_cells=None, target_cells=None, engine='vtk'):
+    """刚性配准（基于 ICP）。"""
+    matrix, _ = register_rigid(source_points, source_cells, RegistrationTarget(target_points, target_cells),
+                               engine=engine)
+
+    # 应用变换矩阵到源点集
+    return apply_transform(source_points, matrix)
 
 
 def save_polydata_to_vtk(polydata, output_filepath):
-    """将 polydata 保存为 VTK 文件。"""
-    writer = vtk.vtkPolyDataWriter()
-    writer.SetFileName(output_filepath)
-    writer.SetInputData(polydata)
-    writer.Write()
+    """
+    将 polydata 保存为 VTK 文件（格式见 mesh_io）。配准结果由 Deformetrica 按 .vtk 文件名读取，
+    因此保持文件名不变。
+    """
+    write_mesh(polydata, output_filepath, keep_name=True)
     print(f"Saved transformed polydata to {output_filepath}")
 
+def matrix_to_numpy(matrix):
+    """vtkMatrix4x4 转换为 4x4 的 numpy 数组（已是数组时原样返回）。"""
+    if isinstance(matrix, np.ndarray):
+        return matrix
+    return np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+
 def apply_transform(points, matrix):
-    """应用变换矩阵到点集。"""
-    transformed_points = []
-    for point in points:
-        x, y, z, _ = matrix.MultiplyPoint([*point, 1.0])
-        transformed_points.append([x, y, z])
-    return np.array(transformed_points)
+    """
+    应用变换矩阵到点集。matrix 可以是 vtkMatrix4x4 或 4x4 数组；
+    与 MultiplyPoint 相同，取齐次坐标结果的前三个分量（刚性变换 w 恒为 1）。
+    """
+    M = matrix_to_numpy(matrix)
+    points = np.asarray(points, dtype=float)
+    return points @ M[:3, :3].T + M[:3, 3]
 
 # ---- 核心处理函数 ----
-def process_subject(subject_folder, template_file, output_folder, side, study):
-    """处理每个被试的数据，先对最小扫描号配准模板，再对其余扫描配准最小扫描"""
+def format_registration_info(info):
+    """配准信息的单行摘要。"""
+    parts = [f"engine={info['engine']}"]
+    for name in ('vtk', 'kdtree'):
+        if 'rms' in info.get(name, {}):
+            parts.append(f"{name}_rms={info[name]['rms']:.4f}")
+    if 'difference' in info:
+        diff = info['difference']
+        parts.append(f"diff: rot={diff['rotation_deg']:.4f}deg trans={diff['translation']:.4f} "
+                     f"max_disp={diff['max_displacement']:.4f}")
+    return ", ".join(parts)
+
+
+def transform_stl_file(stl_file, output_file, transform_matrix, to_archive=False):
+    """
+    读取一个 STL，应用变换矩阵并保存为 VTK。
+    to_archive=True 时不写文件，返回 (output_file, polydata) 由调用方一起写入扫描的归档。
+    """
+    stl_points, stl_cells = read_stl(stl_file)
+    if stl_points is None:
+        print(f"Failed to read STL file: {stl_file}")
+        return None
+
+    transformed_points = apply_transform(stl_points, transform_matrix)
+    transformed_polydata = points_to_polydata(transformed_points, stl_cells)
+    if to_archive:
+        return output_file, transformed_polydata
+    save_polydata_to_vtk(transformed_polydata, output_file)
+    return None
+
+
+def transform_scan_stls(scan_path, output_scan_folder, transform_matrix, io_threads=1):
+    """
+    对扫描文件夹中除 Remesh_combined_label.stl 外的所有 STL 应用变形矩阵。
+    各文件互不依赖，io_threads > 1 时在线程池中读取、变换和写出。
+    归档模式下（见 spoke_archive）变换后的网格一次写入扫描的 spokes.npz，不再逐个写文件。
+    """
+    jobs = [(os.path.join(scan_path, filename), os.path.join(output_scan_folder, f'{filename[:-4]}_transformed.vtk'))
+            for filename in sorted(os.listdir(scan_path))
+            if filename.endswith('.stl') and filename != 'Remesh_combined_label.stl']
+    to_archive = archive_enabled()
+
+    if io_threads > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=min(io_threads, len(jobs))) as executor:
+            futures = [executor.submit(transform_stl_file, stl_file, output_file, transform_matrix, to_archive)
+                       for stl_file, output_file in jobs]
+            results = [future.result() for future in futures]
+    else:
+        results = [transform_stl_file(stl_file, output_file, transform_matrix, to_archive)
+                   for stl_file, output_file in jobs]
+
+    meshes = dict(result for result in results if result is not None)
+    if meshes:
+        archive_file = write_entries(meshes)[0]
+        print(f"Saved {len(meshes)} transformed meshes to {archive_file}")
+
+
+def register_scan(scan_path, output_scan_folder, target, target_name,
+                  engine='vtk', compare_engines=False, icp_options=None, io_threads=1):
+    """
+    把一个扫描的 Remesh_combined_label.stl 配准到 target，保存配准结果，并对其余 STL 应用同一变换。
+    返回 (info, 变换后的 combined_label 目标)，文件缺失或读取失败时返回 None。
+    """
+    scan_folder = os.path.basename(scan_path)
+    os.makedirs(output_scan_folder, exist_ok=True)
+
+    remesh_combined_label_file = os.path.join(scan_path, 'Remesh_combined_label.stl')
+    if not os.path.exists(remesh_combined_label_file):
+        print(f"Warning: {remesh_combined_label_file} not found. Skipping {scan_folder}.")
+        return None
+
+    # 读取 Remesh_combined_label.stl
+    remesh_points, remesh_cells = read_stl(remesh_combined_label_file)
+    if remesh_points is None:
+        print(f"Failed to read STL file: {remesh_combined_label_file}")
+        return None
+
+    # 配准并获取形变矩阵
+    transform_matrix, info = register_rigid(remesh_points, remesh_cells, target,
+                                            engine, compare_engines, icp_options)
+    print(f"Registered {scan_folder} to {target_name}: {format_registration_info(info)}")
+
+    # 保存 Remesh_combined_label.stl 的配准结果
+    transformed_points = apply_transform(remesh_points, transform_matrix)
+    transformed_polydata = points_to_polydata(transformed_points, remesh_cells)
+    transformed_label_path = os.path.join(output_scan_folder, 'Remesh_combined_label_transformed.vtk')
+    save_polydata_to_vtk(transformed_polydata, transformed_label_path)
+
+    # 对 scan_folder 中其他 STL 文件应用变形矩阵
+    transform_scan_stls(scan_path, output_scan_folder, transform_matrix, io_threads)
+
+    return info, RegistrationTarget(transformed_points, remesh_cells, transformed_polydata)
+
+
+def register_followup_scan(scan_path, output_scan_folder, primary_points, primary_cells, primary_name,
+                           engine='vtk', compare_engines=False, icp_options=None, io_threads=1):
+    """进程池中配准一个随访扫描：主扫描几何以数组形式传入，在子进程中重建目标。"""
+    result = register_scan(scan_path, output_scan_folder, RegistrationTarget(primary_points, primary_cells),
+                           primary_name, engine, compare_engines, icp_options, io_threads)
+    return None if result is None else result[0]
+
+
+def process_subject(subject_folder, template_file, output_folder, side, study,
+                    engine='vtk', compare_engines=False, icp_options=None, context=None,
+                    num_workers=1, io_threads=1):
+    """
+    处理每个被试的数据，先对最小扫描号配准模板，再对其余扫描配准最小扫描。
+    engine / compare_engines / icp_options 见 register_rigid；比较两种引擎时
+    结果写入被试输出目录下的 registration_report.json。
+    context 为 RegistrationContext（默认使用进程内共享的缓存），模板只读取一次；
+    主扫描的配准结果直接保留在内存中作为随访扫描的配准目标。
+    num_workers > 1 时随访扫描在进程池中并行配准（它们只依赖主扫描的结果），
+    io_threads > 1 时每个扫描内的 STL 在线程池中变换和写出；输出文件与串行时相同。
+    """
+    if context is None:
+        context = _registration_context
     print(f"Processing subject folder: {subject_folder}")
 
     # 找到扫描文件夹中编号最小的 ScanXX
@@ -133,112 +358,46 @@ def process_subject(subject_folder, template_file, output_folder, side, study):
     # 输出文件夹，保持目录层级结构
     output_subject_folder = os.path.join(output_folder, side, study, os.path.basename(subject_folder))
     primary_output_folder = os.path.join(output_subject_folder, primary_scan_folder)
-    os.makedirs(primary_output_folder, exist_ok=True)
 
-    # 第一步：对最小的 ScanXX 文件夹执行模板配准
-    remesh_combined_label_file = os.path.join(primary_scan_path, 'Remesh_combined_label.stl')
-    if not os.path.exists(remesh_combined_label_file):
-        print(f"Warning: {remesh_combined_label_file} not found. Skipping primary scan.")
-        return
-
-    # 读取 Remesh_combined_label.stl
-    remesh_points, remesh_cells = read_stl(remesh_combined_label_file)
-    if remesh_points is None:
-        print(f"Failed to read STL file: {remesh_combined_label_file}")
-        return
-
-    # 读取模板文件
-    template_points, template_cells = read_vtk(template_file)
-    if template_points is None:
+    # 读取模板文件（同一进程内只读一次）
+    template = context.template(template_file)
+    if template is None:
         print(f"Failed to read template file: {template_file}")
         return
 
-    # 配准模板并获取形变矩阵
-    source_polydata = points_to_polydata(remesh_points, remesh_cells)
-    target_polydata = points_to_polydata(template_points, template_cells)
-
-    icp = vtk.vtkIterativeClosestPointTransform()
-    icp.SetSource(source_polydata)
-    icp.SetTarget(target_polydata)
-    icp.GetLandmarkTransform().SetModeToRigidBody()
-    icp.SetMaximumNumberOfIterations(50)
-    icp.StartByMatchingCentroidsOn()
-    icp.Update()
-    transform_matrix = icp.GetMatrix()
-
-    # 保存 primary_scan_folder 中的配准结果
-    transformed_points = apply_transform(remesh_points, transform_matrix)
-    transformed_polydata = points_to_polydata(transformed_points, remesh_cells)
-    primary_transformed_label_path = os.path.join(primary_output_folder, 'Remesh_combined_label_transformed.vtk')
-    save_polydata_to_vtk(transformed_polydata, primary_transformed_label_path)
-
-    # 对 primary_scan_folder 中其他 STL 文件应用变形矩阵
-    for filename in os.listdir(primary_scan_path):
-        if filename.endswith('.stl') and filename != 'Remesh_combined_label.stl':
-            stl_file = os.path.join(primary_scan_path, filename)
-            stl_points, stl_cells = read_stl(stl_file)
-            if stl_points is None:
-                print(f"Failed to read STL file: {stl_file}")
-                continue
-
-            transformed_points = apply_transform(stl_points, transform_matrix)
-            transformed_polydata = points_to_polydata(transformed_points, stl_cells)
-
-            output_file = os.path.join(primary_output_folder, f'{filename[:-4]}_transformed.vtk')
-            save_polydata_to_vtk(transformed_polydata, output_file)
+    # 第一步：对最小的 ScanXX 文件夹执行模板配准
+    result = register_scan(primary_scan_path, primary_output_folder, template, 'template',
+                           engine, compare_engines, icp_options, io_threads)
+    if result is None:
+        print(f"Primary scan {primary_scan_folder} could not be registered. Skipping {subject_folder}.")
+        return
+    # 随访扫描都配准到这个结果，直接使用内存中的几何，不再从磁盘读回
+    info, primary_target = result
+    report = {primary_scan_folder: info}
 
     # 第二步：对其余 ScanXX 文件夹进行配准
-    for scan_folder in scan_folders[1:]:
-        scan_path = os.path.join(subject_folder, scan_folder)
-        output_scan_folder = os.path.join(output_subject_folder, scan_folder)
-        os.makedirs(output_scan_folder, exist_ok=True)
-
-        remesh_combined_label_file = os.path.join(scan_path, 'Remesh_combined_label.stl')
-        if not os.path.exists(remesh_combined_label_file):
-            print(f"Warning: {remesh_combined_label_file} not found. Skipping {scan_folder}.")
-            continue
-
-        # 读取 Remesh_combined_label.stl
-        remesh_points, remesh_cells = read_stl(remesh_combined_label_file)
-        if remesh_points is None:
-            print(f"Failed to read STL file: {remesh_combined_label_file}")
-            continue
-
-        # 读取 primary_scan_folder 的配准结果
-        primary_transformed_points, primary_transformed_cells = read_vtk(primary_transformed_label_path)
-        if primary_transformed_points is None:
-            print(f"Failed to read transformed label: {primary_transformed_label_path}")
-            continue
-
-        # 配准并获取形变矩阵
-        source_polydata = points_to_polydata(remesh_points, remesh_cells)
-        target_polydata = points_to_polydata(primary_transformed_points, primary_transformed_cells)
-
-        icp.SetSource(source_polydata)
-        icp.SetTarget(target_polydata)
-        icp.Update()
-        transform_matrix = icp.GetMatrix()
-
-        # 保存 Remesh_combined_label.stl 的配准结果
-        transformed_points = apply_transform(remesh_points, transform_matrix)
-        transformed_polydata = points_to_polydata(transformed_points, remesh_cells)
-        transformed_label_path = os.path.join(output_scan_folder, 'Remesh_combined_label_transformed.vtk')
-        save_polydata_to_vtk(transformed_polydata, transformed_label_path)
-
-        # 对 scan_folder 中其他 STL 文件应用变形矩阵
-        for filename in os.listdir(scan_path):
-            if filename.endswith('.stl') and filename != 'Remesh_combined_label.stl':
-                stl_file = os.path.join(scan_path, filename)
-                stl_points, stl_cells = read_stl(stl_file)
-                if stl_points is None:
-                    print(f"Failed to read STL file: {stl_file}")
-                    continue
-
-                transformed_points = apply_transform(stl_points, transform_matrix)
-                transformed_polydata = points_to_polydata(transformed_points, stl_cells)
-
-                output_file = os.path.join(output_scan_folder, f'{filename[:-4]}_transformed.vtk')
-                save_polydata_to_vtk(transformed_polydata, output_file)
+    followups = [(scan_folder, os.path.join(subject_folder, scan_folder), os.path.join(output_subject_folder, scan_folder))
+                 for scan_folder in scan_folders[1:]]
+    if num_workers > 1 and len(followups) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(followups))) as executor:
+            futures = {scan_folder: executor.submit(register_followup_scan, scan_path, output_scan_folder,
+                                                    primary_target.points, primary_target.cells, primary_scan_folder,
+                                                    engine, compare_engines, icp_options, io_threads)
+                       for scan_folder, scan_path, output_scan_folder in followups}
+            for scan_folder, future in futures.items():
+                report[scan_folder] = future.result()
+    else:
+        for scan_folder, scan_path, output_scan_folder in followups:
+            result = register_scan(scan_path, output_scan_folder, primary_target, primary_scan_folder,
+                                   engine, compare_engines, icp_options, io_threads)
+            report[scan_folder] = None if result is None else result[0]
+
+    if compare_engines:
+        report = {scan_folder: info for scan_folder, info in report.items() if info is not None}
+        report_path = os.path.join(output_subject_folder, 'registration_report.json')
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved registration report to {report_path}")
 
 
 # ---- 主函数入口 ----
@@ -252,13 +411,44 @@ if __name__ == "__main__":
     parser.add_argument("--output_folder", type=str, required=True, help="Path to save the output files")
     parser.add_argument("--side", type=str, choices=["Left", "Right"], required=True, help="Hemisphere: Left or Right")
     parser.add_argument("--study", type=str, required=True, help="Study type, e.g., ADNI")
+    parser.add_argument("--engine", type=str, choices=["vtk", "kdtree"], default="vtk",
+                        help="Rigid registration engine: VTK ICP or KD-tree ICP")
+    parser.add_argument("--compare_engines", action="store_true",
+                        help="Run both engines and write RMS / transform differences to registration_report.json")
+    parser.add_argument("--prealign", type=str, choices=["centroid", "pca"], default="centroid",
+                        help="KD-tree ICP pre-alignment: centroid only or principal axes")
+    parser.add_argument("--subsample", type=str, choices=["random", "farthest"], default="random",
+                        help="KD-tree ICP source subsampling method")
+    parser.add_argument("--levels", type=int, nargs="+", default=[250, 1000],
+                        help="KD-tree ICP sample counts, coarse to fine")
+    parser.add_argument("--max_iter", type=int, default=30, help="KD-tree ICP iterations per level")
+    parser.add_argument("--tolerance", type=float, default=1e-4,
+                        help="KD-tree ICP convergence tolerance on the RMS change (mm)")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Processes used to register follow-up scans in parallel")
+    parser.add_argument("--mesh_format", type=str, choices=MESH_FORMATS, default=None,
+                        help="On-disk mesh format: ascii, binary legacy VTK, or compressed .vtp")
+    parser.add_argument("--spoke_archive", action="store_true",
+                        help="Store the transformed subfield meshes in each scan's spokes.npz archive")
+    parser.add_argument("--io_threads", type=int, default=1,
+                        help="Threads used to transform and write the subfield STLs of each scan")
 
     args = parser.parse_args()
+    if args.mesh_format:
+        set_mesh_format(args.mesh_format)
+    if args.spoke_archive:
+        set_archive_mode(True)
 
     process_subject(
         subject_folder=args.subject_folder,
         template_file=args.template_file,
         output_folder=args.output_folder,
         side=args.side,
-        study=args.study
+        study=args.study,
+        engine=args.engine,
+        compare_engines=args.compare_engines,
+        icp_options=dict(prealign_mode=args.prealign, subsample_method=args.subsample,
+                         levels=tuple(args.levels), max_iter=args.max_iter, tolerance=args.tolerance),
+        num_workers=args.num_workers,
+        io_threads=args.io_threads
     )
@@ -0,0 +1,160 @@
+# rigid_icp.py
+import numpy as np
+from scipy.spatial import cKDTree
+
+# 主轴预对齐时可选的符号组合（det = +1，保持右手系）
+_AXIS_SIGNS = np.array([[1, 1, 1], [-1, -1, 1], [-1, 1, -1], [1, -1, -1]], dtype=float)
+
+
+def to_matrix(R, t):
+    """旋转矩阵和平移向量组合成 4x4 齐次矩阵。"""
+    M = np.eye(4)
+    M[:3, :3] = R
+    M[:3, 3] = t
+    return M
+
+
+def transform_points(points, M):
+    """对 (N, 3) 点集应用 4x4 齐次矩阵。"""
+    return points @ M[:3, :3].T + M[:3, 3]
+
+
+def kabsch(src, dst):
+    """最小二乘意义下 src -> dst 的刚性变换（SVD / Kabsch），返回 4x4 矩阵。"""
+    src_c = src.mean(axis=0)
+    dst_c = dst.mean(axis=0)
+    H = (src - src_c).T @ (dst - dst_c)
+    U, _, Vt = np.linalg.svd(H)
+    D = np.eye(3)
+    D[2, 2] = np.sign(np.linalg.det(Vt.T @ U.T))
+    R = Vt.T @ D @ U.T
+    return to_matrix(R, dst_c - R @ src_c)
+
+
+def principal_axes(points):
+    """点集的主轴（按方差从大到小的列向量），保证为右手系。"""
+    centered = points - points.mean(axis=0)
+    _, vecs = np.linalg.eigh(centered.T @ centered)
+    axes = vecs[:, ::-1]
+    if np.linalg.det(axes) < 0:
+        axes[:, 2] = -axes[:, 2]
+    return axes
+
+
+def subsample(points, n_samples, method='farthest', seed=0):
+    """
+    源点下采样，返回下标。'farthest' 为最远点采样，'random' 为随机采样，None 不采样。
+    两种方式得到的下标前缀本身也是均匀的子样本，可直接用于由粗到精的各级迭代。
+    """
+    n = len(points)
+    if method is None or n_samples is None or n_samples >= n:
+        return np.arange(n)
+    if method == 'random':
+        return np.random.default_rng(seed).permutation(n)[:n_samples]
+    if method != 'farthest':
+        raise ValueError(f"Unknown subsample method: {method}")
+
+    # 从离质心最近的点开始，每次取离已选点集最远的点（比较平方距离，省去开方）
+    pts = np.ascontiguousarray(points, dtype=float)
+    idx = np.empty(n_samples, dtype=int)
+    diff = pts - pts.mean(axis=0)
+    idx[0] = np.argmin(np.einsum('ij,ij->i', diff, diff))
+    np.subtract(pts, pts[idx[0]], out=diff)
+    dist = np.einsum('ij,ij->i', diff, diff)
+    for k in range(1, n_samples):
+        idx[k] = np.argmax(dist)
+        np.subtract(pts, pts[idx[k]], out=diff)
+        np.minimum(dist, np.einsum('ij,ij->i', diff, diff), out=dist)
+    return idx
+
+
+def rms_distance(points, tree):
+    """点到目标点集最近点距离的均方根。"""
+    dist, _ = tree.query(points)
+    return float(np.sqrt(np.mean(dist ** 2)))
+
+
+def prealign(source, target, tree, mode='centroid'):
+    """
+    初始变换。'centroid' 只对齐质心（同 VTK ICP 的 StartByMatchingCentroids）；
+    'pca' 再对齐主轴，在 4 种符号组合和仅平移中选最近点 RMS 最小的一个。
+    """
+    shift = to_matrix(np.eye(3), target.mean(axis=0) - source.mean(axis=0))
+    if mode == 'centroid':
+        return shift
+    if mode != 'pca':
+        raise ValueError(f"Unknown prealign mode: {mode}")
+
+    src_c = source.mean(axis=0)
+    dst_c = target.mean(axis=0)
+    src_axes = principal_axes(source)
+    dst_axes = principal_axes(target)
+    candidates = [shift]
+    for signs in _AXIS_SIGNS:
+        R = dst_axes @ np.diag(signs) @ src_axes.T
+        candidates.append(to_matrix(R, dst_c - R @ src_c))
+    rms = [rms_distance(transform_points(source, M), tree) for M in candidates]
+    return candidates[int(np.argmin(rms))]
+
+
+def icp(source_points, target_points, prealign_mode='centroid', subsample_method='random',
+        levels=(250, 1000), max_iter=30, tolerance=1e-4, seed=0, target_tree=None):
+    """
+    基于 KD 树的刚性 ICP（点到最近顶点）。
+
+    源点先按 subsample_method 采样（'random' 最快；'farthest' 分布更均匀，但需要逐点迭代），levels 中每一级依次使用前 n 个采样点（由粗到精），
+    每级最多迭代 max_iter 次，最近点 RMS 的变化小于 tolerance（mm）时进入下一级。
+    target_tree 可传入已建好的 cKDTree 以便复用。
+
+    返回 (4x4 变换矩阵, info)，info 中 rms 为全部源点变换后到目标的最近点 RMS。
+    """
+    source = np.asarray(source_points, dtype=float)
+    target = np.asarray(target_points, dtype=float)
+    tree = target_tree if target_tree is not None else cKDTree(target)
+
+    order = subsample(source, max(levels), subsample_method, seed)
+    M = prealign(source[order], target, tree, prealign_mode)
+
+    iterations = []
+    for n in levels:
+        sample = source[order[:n]]
+        prev_rms = np.inf
+        num_iter = 0  # max_iter=0 时该级不迭代
+        for _ in range(max_iter):
+            num_iter += 1
+            moved = transform_points(sample, M)
+            dist, nn = tree.query(moved)
+            rms = float(np.sqrt(np.mean(dist ** 2)))
+            if prev_rms - rms < tolerance:
+                break
+            prev_rms = rms
+            M = kabsch(moved, target[nn]) @ M
+        iterations.append(num_iter)
+
+    info = {
+        'rms': rms_distance(transform_points(source, M), tree),
+        'iterations': iterations,
+        'samples': [int(min(n, len(order))) for n in levels],
+        'prealign': prealign_mode,
+        'subsample': subsample_method,
+    }
+    return M, info
+
+
+def transform_difference(M1, M2, points=None):
+    """
+    两个刚性变换的差异：旋转角（度）、平移差（mm），给出 points 时还有这些点在两种变换下的最大位移。
+    """
+    M1 = np.asarray(M1, dtype=float)
+    M2 = np.asarray(M2, dtype=float)
+    R = M1[:3, :3].T @ M2[:3, :3]
+    angle = np.degrees(np.arccos(np.clip((np.trace(R) - 1) / 2, -1.0, 1.0)))
+    diff = {
+        'rotation_deg': float(angle),
+        'translation': float(np.linalg.norm(M1[:3, 3] - M2[:3, 3])),
+    }
+    if points is not None:
+        points = np.asarray(points, dtype=float)
+        diff['max_displacement'] = float(np.linalg.norm(
+            transform_points(points, M1) - transform_points(points, M2), axis=1).max())
+    return diff
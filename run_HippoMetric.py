@@ -10,6 +10,8 @@ from transform_single_subject import run_regression
 from SeperateSpokes import extract_spokes
 from run_post_process import run_post_process_for_subject
 from merge_baseline_followups import merge_subject_scans
+from mesh_io import set_mesh_format
+from spoke_archive import set_archive_mode
 
 
 def run_pipeline(
@@ -23,7 +25,12 @@ def run_pipeline(
     run_step7=True,
     run_step8=True,
     run_step9=True,
-    run_step10=True
+    run_step10=True,
+    mesh_format=None,
+    spoke_archive=None,
+    fuse_spokes=False,
+    keep_intermediate=False,
+    **refine_options
 ):
     """
     Run the full processing pipeline for a single subject.
@@ -33,7 +40,19 @@ def run_pipeline(
         subject_id (str): 被试文件夹名，如 '002-S-1280'
         group_name (str): 分组名，如 'PET_ABETA_CSF_PTAU_MRI'
         run_stepX (bool): 控制是否执行第X步
+        mesh_format (str): 网格文件格式，'ascii'、'binary'（二进制 legacy VTK/STL）或 'vtp'（压缩 XML）；
+            None 时沿用环境变量中的设置（见 mesh_io）
+        spoke_archive (bool): 每个扫描的 spokes 和亚区网格存入一个 spokes.npz，而不是几十个 VTK 文件；
+            None 时沿用环境变量中的设置（见 spoke_archive）
+        fuse_spokes (bool): 第八步提取的 spokes 直接在内存中交给第九步 refine，不写出再读回 {亚区}_pt/_ps.vtk
+        keep_intermediate (bool): 融合模式下仍写出 {亚区}_pt/_ps.vtk（调试用）
+        refine_options: 第九步 refine 的其他参数，原样传给 run_post_process_for_subject，
+            如 length_mode、direction_mode、backend、num_workers、equalize_length、resume、resolution、isolate
     """
+    if mesh_format is not None:
+        set_mesh_format(mesh_format)
+    if spoke_archive is not None:
+        set_archive_mode(spoke_archive)
 
     base_dir = Path(base_dir)
     subject_folder = base_dir / subject_id
@@ -162,6 +181,7 @@ def run_pipeline(
     # Step 8
     print("==> 第八步：提取 spokes 点并保存为 vtk")
     subfield_list_path = work_dir / "subfield_list_00.xlsx"
+    scans = []
     for side in sides:
         print(f"[INFO] 正在处理 {side} 側")
         baseline_folder = work_dir / "output" / "Baseline" / side
@@ -173,7 +193,10 @@ def run_pipeline(
                 if not scan.is_dir():
                     continue
                 print(f"[INFO] 正在提取 spokes 点: {scan}")
-                extract_spokes(str(scan), subfield_list_path)
+                scans.append(str(scan))
+    # 所有扫描一次提取（模板索引只加载一次）；融合模式下 spokes 留在内存中交给第九步
+    fused = fuse_spokes and run_step9
+    extracted = extract_spokes(scans, subfield_list_path, write=not fused or keep_intermediate)
     
     # Step 9
     if run_step9:
@@ -181,7 +204,9 @@ def run_pipeline(
         baseline_path = work_dir / "output" / "Baseline"
         followup_path = work_dir / "output" / "FollowUps"
         subfield_file_path = work_dir / "subfield_list_python.xlsx"
-        run_post_process_for_subject(subject_id, group_name, baseline_path, followup_path, subfield_file_path)
+        # 出错时抛出异常，不再继续第十步
+        run_post_process_for_subject(subject_id, group_name, baseline_path, followup_path, subfield_file_path,
+                                     spokes=extracted if fused else None, **refine_options)
         
     # Step 10
     if run_step10:
@@ -1,4 +1,6 @@
 # run_post_process.py
+import os
+import sys
 import subprocess
 import logging
 
@@ -9,29 +11,89 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
 )
 
-def run_post_process_for_subject(subject_id: str, group_name: str, baseline_path: str, followup_path: str, subfield_file_path: str):
+# 已读取的亚区列表，按 (路径, 修改时间) 缓存，多个被试/侧共用
+_subfield_lists = {}
+
+
+def load_subfield_list(subfield_file_path):
+    """读取 subfield 表格中的亚区列表（同一文件只读一次）。"""
+    subfield_file_path = os.path.abspath(str(subfield_file_path))
+    key = (subfield_file_path, os.path.getmtime(subfield_file_path))
+    if key not in _subfield_lists:
+        from template_index import load_subfield_list as read_subfield_list
+        _subfield_lists[key] = read_subfield_list(subfield_file_path)
+    return _subfield_lists[key]
+
+
+def _run_side_subprocess(subject_id, side, group_name, baseline_path, followup_path, subfield_file_path,
+                         length_mode, direction_mode, backend, num_workers, equalize_length, resume, resolution,
+                         target_reduction, validate_resolution):
+    """在独立的 python 进程中运行 process_subject.py（隔离模式）。"""
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "process_subject.py"),
+        subject_id,
+        side,
+        group_name,
+        "--baseline_path", str(baseline_path),
+        "--followup_path", str(followup_path),
+        "--subfield_file", str(subfield_file_path),
+        "--length_mode", length_mode,
+        "--direction_mode", direction_mode,
+        "--backend", backend,
+        "--num_workers", str(num_workers),
+        "--resolution", resolution,
+        "--target_reduction", str(target_reduction)
+    ]
+    if equalize_length:
+        command.append("--equalize_length")
+    if not resume:
+        command.append("--no_resume")
+    if validate_resolution:
+        command.append("--validate_resolution")
+    subprocess.run(command, check=True)
+
+
+def run_post_process_for_subject(subject_id: str, group_name: str, baseline_path: str, followup_path: str,
+                                 subfield_file_path: str, isolate: bool = False, length_mode: str = 'march',
+                                 direction_mode: str = 'loop', backend: str = 'mesh', num_workers: int = 1,
+                                 equalize_length: bool = False, resume: bool = True, resolution: str = 'single',
+                                 target_reduction: float = 0.75, validate_resolution: bool = False,
+                                 spokes: dict = None):
     """
-    对指定被试和组别运行 post-process（左右侧分别调用 process_subject.py）
+    对指定被试和组别运行 post-process，左右两侧在同一次调用中处理（num_workers > 1 时两侧的亚区放进同一个进程池）。
+    默认在当前进程内调用 process_subject，VTK 等模块和 subfield 表格只加载一次；
+    isolate=True 时启动一个 process_subject.py 子进程（side 为 Both）。
+    spokes 为 extract_spokes 的返回值时，基线 spokes 直接从内存传给 refine（融合模式，需在当前进程内运行）。
+    出错时记录日志后重新抛出异常，由调用方（run_HippoMetric）停止后续步骤。
     """
+    if isolate and spokes is not None:
+        raise ValueError("In-memory spokes cannot be passed to an isolated process_subject.py subprocess")
     sides = ["Left", "Right"]
-    for side in sides:
-        try:
-            logging.info(f"Starting post-process for subject: {subject_id}, side: {side}, group: {group_name}")
-            
-            command = [
-                "python", "process_subject.py",
-                subject_id,
-                side,
-                group_name,
-                "--baseline_path", baseline_path,
-                "--followup_path", followup_path,
-                "--subfield_file", subfield_file_path
-            ]
-
-            subprocess.run(command, check=True)
-            
-            logging.info(f"Finished post-process for subject: {subject_id}, side: {side}, group: {group_name}")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error for subject: {subject_id}, side: {side}, group: {group_name}")
-            logging.error(f"Command: {e.cmd}")
-            logging.error(f"Exit status: {e.returncode}")
+    try:
+        logging.info(f"Starting post-process for subject: {subject_id}, sides: {sides}, group: {group_name}")
+
+        if isolate:
+            _run_side_subprocess(subject_id, "Both", group_name, baseline_path, followup_path, subfield_file_path,
+                                 length_mode, direction_mode, backend, num_workers, equalize_length, resume,
+                                 resolution, target_reduction, validate_resolution)
+        else:
+            import process_subject
+            from template_index import template_dir_of
+            process_subject.process_subject_sides(
+                str(baseline_path), str(followup_path), load_subfield_list(subfield_file_path), subject_id, sides,
+                group_name, num_workers=num_workers, length_mode=length_mode, direction_mode=direction_mode,
+                backend=backend, equalize_length=equalize_length, resume=resume,
+                resolution=resolution, target_reduction=target_reduction,
+                validate_resolution=validate_resolution, spokes=spokes,
+                template_dir=template_dir_of(subfield_file_path)
+            )
+
+        logging.info(f"Finished post-process for subject: {subject_id}, sides: {sides}, group: {group_name}")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error for subject: {subject_id}, sides: {sides}, group: {group_name}")
+        logging.error(f"Command: {e.cmd}")
+        logging.error(f"Exit status: {e.returncode}")
+        raise
+    except Exception:
+        logging.exception(f"Error for subject: {subject_id}, sides: {sides}, group: {group_name}")
+        raise
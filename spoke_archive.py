@@ -0,0 +1,335 @@
+# spoke_archive.py
+import os
+import glob
+import json
+import hashlib
+import zipfile
+import argparse
+from contextlib import contextmanager
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+from mesh_io import read_mesh, read_points, write_mesh, resolve_mesh_path, MESH_FORMATS
+
+# 每个扫描文件夹一个归档文件，代替 {subfield}_pt.vtk、_ps.vtk、_pt_refined.vtk、_ps_refined.vtk
+# 和 Remesh_{subfield}_transformed.vtk 等几十个小文件。
+# 归档是未压缩的 NPZ：每个原文件对应一个成员，成员名就是原文件名去掉扩展名（如 CA1_pt_refined），
+# 值为 (N,3) 点坐标；网格另有 {stem}.polys 成员保存单元（[3, a, b, c, 3, ...] 格式）。
+# 按成员读取，读一个亚区不需要解析整个归档。
+# refine 的 *_metrics.json / *_manifest.json 也作为成员保存（成员名为文件名，值为 JSON 字符串）。
+# 新成员追加到归档末尾，只有替换已有成员时才重写整个归档。
+ARCHIVE_NAME = "spokes.npz"
+
+# 通过环境变量开启归档模式，子进程（如 step 9 的隔离模式、进程池）会继承
+ARCHIVE_ENV = "HIPPOMETRIC_SPOKE_ARCHIVE"
+
+_POLYS_SUFFIX = ".polys"
+_JSON_SUFFIX = ".json"
+
+# 已打开过的归档的成员列表，按 (路径, mtime, 大小) 缓存
+_member_lists = {}
+
+
+def archive_enabled():
+    """是否把 spokes / 网格写入每个扫描的归档文件（默认写单独的 VTK 文件）。"""
+    return os.environ.get(ARCHIVE_ENV, "0") not in ("", "0")
+
+
+def set_archive_mode(enabled):
+    """开启或关闭归档模式（写入环境变量，之后启动的子进程也使用该设置）。"""
+    os.environ[ARCHIVE_ENV] = "1" if enabled else "0"
+
+
+def archive_path(scan_dir):
+    return os.path.join(str(scan_dir), ARCHIVE_NAME)
+
+
+def split_entry(path):
+    """文件路径 -> (扫描文件夹, 成员名)，如 .../Scan01/CA1_pt.vtk -> (.../Scan01, 'CA1_pt')。"""
+    scan_dir, filename = os.path.split(str(path))
+    return scan_dir, os.path.splitext(filename)[0]
+
+
+@contextmanager
+def _locked(scan_dir, shared=False):
+    """
+    对扫描文件夹加锁：更新归档时加排他锁，同一归档的并发更新（多进程/多线程）依次进行；
+    读取时加共享锁，不会读到正在追加成员的归档。
+    """
+    import fcntl  # 仅 POSIX；模块本身在其他平台也要能导入
+    fd = os.open(scan_dir, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _archive_names(scan_dir):
+    """归档中的全部成员名（含 .polys 和 JSON），归档不存在时为空集合。"""
+    path = archive_path(scan_dir)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return set()
+    key = (path, st.st_mtime_ns, st.st_size)
+    names = _member_lists.get(path)
+    if names is None or names[0] != key:
+        with _locked(scan_dir, shared=True), np.load(path) as npz:
+            names = (key, set(npz.files))
+        _member_lists[path] = names
+    return names[1]
+
+
+def archive_members(scan_dir):
+    """归档中的 spokes / 网格成员名（不含 .polys 和 JSON），归档不存在时为空集合。"""
+    return {name for name in _archive_names(scan_dir)
+            if not name.endswith(_POLYS_SUFFIX) and not name.endswith(_JSON_SUFFIX)}
+
+
+def read_members(scan_dir, names):
+    """只读取归档中的指定成员，返回 {成员名: 数组}。"""
+    with _locked(scan_dir, shared=True), np.load(archive_path(scan_dir)) as npz:
+        return {name: npz[name] for name in names}
+
+
+def _append_members(path, members):
+    """
+    把新成员追加到已有归档末尾（与 np.savez 相同的未压缩 .npy 成员），已有成员不重写。
+    写入出错时截掉追加的数据并恢复原来的中央目录。
+    """
+    with open(path, 'r+b') as raw:
+        with zipfile.ZipFile(raw) as zf:
+            start_dir = zf.start_dir
+        raw.seek(start_dir)
+        central_dir = raw.read()
+        try:
+            with zipfile.ZipFile(raw, mode='a', allowZip64=True) as zf:
+                for name, array in members.items():
+                    with zf.open(name + '.npy', mode='w', force_zip64=True) as f:
+                        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+        except BaseException:
+            raw.seek(start_dir)
+            raw.truncate()
+            raw.write(central_dir)
+            raise
+
+
+def update_archive(scan_dir, members):
+    """
+    把 {成员名: 数组} 写入扫描的归档，已有的同名成员被替换。
+    都是新成员时在文件夹锁内追加到归档末尾（一个扫描的各亚区依次写入时总 I/O 与归档大小成正比）；
+    需要替换已有成员时重写整个归档到临时文件再改名。
+    """
+    scan_dir = str(scan_dir)
+    path = archive_path(scan_dir)
+    with _locked(scan_dir):
+        arrays = {}
+        if os.path.exists(path):
+            with np.load(path) as npz:
+                if not set(members) & set(npz.files):
+                    arrays = None
+                else:
+                    arrays = {name: npz[name] for name in npz.files if name not in members}
+        if arrays is None:
+            _append_members(path, members)
+            return path
+        arrays.update(members)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    return path
+
+
+def _polydata_members(stem, polydata):
+    points = polydata.GetPoints()
+    members = {stem: vtk_to_numpy(points.GetData()) if points is not None else np.zeros((0, 3), dtype=np.float32)}
+    if polydata.GetNumberOfPolys() > 0:
+        legacy = vtk.vtkIdTypeArray()
+        polydata.GetPolys().ExportLegacyFormat(legacy)
+        members[stem + _POLYS_SUFFIX] = vtk_to_numpy(legacy).copy()
+    return members
+
+
+def _members_polydata(points, polys=None):
+    # 延迟导入：registration_module 也会用到本模块
+    from registration_module import points_to_polydata
+    return points_to_polydata(np.ascontiguousarray(points), polys)
+
+
+def in_archive(path):
+    scan_dir, stem = split_entry(path)
+    return stem in archive_members(scan_dir)
+
+
+def _use_archive(path):
+    """读取时优先用归档还是文件：归档模式下归档优先，否则磁盘上没有文件时才读归档。"""
+    if archive_enabled():
+        return in_archive(path)
+    return not os.path.exists(resolve_mesh_path(path)) and in_archive(path)
+
+
+def entry_exists(path):
+    """该文件存在于磁盘（.vtk 或 .vtp）或扫描的归档中。"""
+    return in_archive(path) or os.path.exists(resolve_mesh_path(path))
+
+
+def read_entry_points(path):
+    """读取点坐标 (N,3)：来自归档成员或 VTK 文件（legacy VTK 直接解析，见 mesh_io.read_points）。"""
+    if _use_archive(path):
+        scan_dir, stem = split_entry(path)
+        return read_members(scan_dir, [stem])[stem]
+    return read_points(path)
+
+
+def read_entry(path):
+    """读取为 vtkPolyData（点和三角形单元）：来自归档成员或网格文件。"""
+    if not _use_archive(path):
+        return read_mesh(path)
+    scan_dir, stem = split_entry(path)
+    with _locked(scan_dir, shared=True), np.load(archive_path(scan_dir)) as npz:
+        points = npz[stem]
+        polys = npz[stem + _POLYS_SUFFIX] if stem + _POLYS_SUFFIX in npz.files else None
+    return _members_polydata(points, polys)
+
+
+def write_entries(entries):
+    """
+    写出 {文件路径: vtkPolyData 或 (N,3) 数组}。归档模式下按扫描文件夹分组，每个文件夹只更新一次归档；
+    否则按 mesh_io 的格式逐个写出文件。返回实际写出的路径（归档模式下为归档路径）。
+    """
+    if not archive_enabled():
+        written = []
+        for path, data in entries.items():
+            if isinstance(data, np.ndarray):
+                data = _members_polydata(data)
+            written.append(write_mesh(data, path))
+        return written
+
+    by_scan = {}
+    for path, data in entries.items():
+        scan_dir, stem = split_entry(path)
+        members = {stem: data} if isinstance(data, np.ndarray) else _polydata_members(stem, data)
+        by_scan.setdefault(scan_dir, {}).update(members)
+    return [update_archive(scan_dir, members) for scan_dir, members in by_scan.items()]
+
+
+def write_json_entry(obj, path):
+    """
+    写出 JSON（refine 的 metrics / manifest）：归档模式下作为扫描归档的成员（成员名为文件名），
+    否则原子地写出文件（临时文件 + 改名）。返回实际写出的路径（归档模式下为归档路径）。
+    """
+    text = json.dumps(obj, indent=2)
+    if archive_enabled():
+        scan_dir, filename = os.path.split(str(path))
+        return update_archive(scan_dir, {filename: np.array(text)})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return str(path)
+
+
+def read_json_entry(path):
+    """读取 write_json_entry 写出的 JSON（归档成员或文件），都不存在时返回 None。"""
+    scan_dir, filename = os.path.split(str(path))
+    in_scan_archive = filename in _archive_names(scan_dir)
+    if in_scan_archive and (archive_enabled() or not os.path.exists(path)):
+        return json.loads(str(read_members(scan_dir, [filename])[filename]))
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def array_sha1(array):
+    """数组数据的 SHA-1（归档成员和内存中的 spokes 用同一种算法）。"""
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+def entry_sha1(path):
+    """内容的 SHA-1：文件按字节计算，归档成员按数组数据计算。"""
+    if _use_archive(path):
+        scan_dir, stem = split_entry(path)
+        return array_sha1(read_members(scan_dir, [stem])[stem])
+    digest = hashlib.sha1()
+    with open(resolve_mesh_path(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_size(path):
+    """文件大小，或归档成员的数据字节数。"""
+    if _use_archive(path):
+        scan_dir, stem = split_entry(path)
+        return int(read_members(scan_dir, [stem])[stem].nbytes)
+    return os.path.getsize(resolve_mesh_path(path))
+
+
+def export_legacy(scan_dir, fmt=None, names=None):
+    """
+    把归档展开为原来的逐文件布局（{成员名}.vtk，格式见 mesh_io；JSON 成员写回同名文件），用于 QC。
+    返回写出的文件列表。
+    """
+    scan_dir = str(scan_dir)
+    json_names = [] if names is not None else sorted(name for name in _archive_names(scan_dir)
+                                                     if name.endswith(_JSON_SUFFIX))
+    names = sorted(archive_members(scan_dir)) if names is None else names
+    written = []
+    with _locked(scan_dir, shared=True), np.load(archive_path(scan_dir)) as npz:
+        members = {name: (npz[name], npz[name + _POLYS_SUFFIX] if name + _POLYS_SUFFIX in npz.files else None)
+                   for name in names}
+        texts = {name: str(npz[name]) for name in json_names}
+    for stem, (points, polys) in members.items():
+        written.append(write_mesh(_members_polydata(points, polys), os.path.join(scan_dir, f"{stem}.vtk"), fmt))
+    for filename, text in texts.items():
+        with open(os.path.join(scan_dir, filename), 'w') as f:
+            f.write(text)
+        written.append(os.path.join(scan_dir, filename))
+    return written
+
+
+def import_legacy(scan_dir, patterns=("*_pt.vtk", "*_ps.vtk", "*_refined.vtk", "Remesh_*_transformed.vtk"),
+                  remove=False):
+    """
+    把扫描文件夹中已有的逐文件 spokes / 网格收进归档（Remesh_combined_label_transformed.vtk 除外，
+    Deformetrica 需要它保持为单独文件）。remove=True 时删除已收入的文件。返回收入的文件列表。
+    """
+    scan_dir = str(scan_dir)
+    paths = sorted({path for pattern in patterns
+                    for ext in ('.vtk', '.vtp')
+                    for path in glob.glob(os.path.join(scan_dir, pattern[:-4] + ext))})
+    paths = [path for path in paths if split_entry(path)[1] != 'Remesh_combined_label_transformed']
+    if not paths:
+        return []
+
+    members = {}
+    for path in paths:
+        members.update(_polydata_members(split_entry(path)[1], read_mesh(path)))
+    update_archive(scan_dir, members)
+    if remove:
+        for path in paths:
+            os.remove(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack per-scan spoke/mesh VTK files into spokes.npz or export them back.")
+    parser.add_argument('action', choices=['import', 'export', 'list'],
+                        help="import: VTK files -> archive; export: archive -> VTK files (QC); list: archive members")
+    parser.add_argument('scan_dirs', nargs='+', help="Scan folders")
+    parser.add_argument('--remove', action='store_true', help="import: delete the VTK files after packing them")
+    parser.add_argument('--mesh_format', choices=MESH_FORMATS, default=None, help="export: on-disk mesh format")
+    args = parser.parse_args()
+
+    for scan_dir in args.scan_dirs:
+        if args.action == 'import':
+            print(f"{scan_dir}: packed {len(import_legacy(scan_dir, remove=args.remove))} files into {ARCHIVE_NAME}")
+        elif args.action == 'export':
+            print(f"{scan_dir}: exported {len(export_legacy(scan_dir, args.mesh_format))} files")
+        else:
+            for stem in sorted(archive_members(scan_dir)):
+                print(f"{scan_dir}: {stem}")
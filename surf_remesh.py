@@ -3,6 +3,7 @@
 import os
 from pathlib import Path
 import vtk
+from mesh_io import read_mesh, write_mesh
 
 # 每个亚区的目标四边形数
 TARGET_QUAD_COUNTS = {
@@ -21,10 +22,7 @@ TARGET_QUAD_COUNTS = {
 
 def remesh_stl(input_path: Path, output_path: Path, target_quad_count: int):
     """对单个 STL 网格进行 remesh 并保存"""
-    reader = vtk.vtkSTLReader()
-    reader.SetFileName(str(input_path))
-    reader.Update()
-    mesh = reader.GetOutput()
+    mesh = read_mesh(str(input_path))
 
     connectivity = vtk.vtkConnectivityFilter()
     connectivity.SetInputData(mesh)
@@ -38,10 +36,7 @@ def remesh_stl(input_path: Path, output_path: Path, target_quad_count: int):
     decimate.SetTargetReduction(reduction)
     decimate.Update()
 
-    writer = vtk.vtkSTLWriter()
-    writer.SetFileName(str(output_path))
-    writer.SetInputData(decimate.GetOutput())
-    writer.Write()
+    write_mesh(decimate.GetOutput(), str(output_path))
 
 def remesh_subject_stl(hemi_input_dir: Path, hemi_output_dir: Path):
     os.makedirs(hemi_output_dir, exist_ok=True)
@@ -0,0 +1,162 @@
+# template_index.py
+import os
+import argparse
+import numpy as np
+
+# 模板表格的默认文件名（与 run_HippoMetric 的 work_dir 中一致）
+POINT_ORDER_NAME = "point_order_skeleton.mat"
+SUBFIELD_LIST_NAME = "subfield_list_00.xlsx"
+SUBFIELD_PYTHON_NAME = "subfield_list_python.xlsx"
+INDEX_NAME = "template_index.npz"
+
+# 每个进程已加载的模板索引，按索引文件路径缓存
+_template_indexes = {}
+
+
+def build_template_index(point_order_mat, subfield_list_path, subfield_python_path, output_path):
+    """
+    把 point_order_skeleton.mat、subfield_list_00.xlsx、subfield_list_python.xlsx
+    编译成一个 NumPy 索引文件（.npz），之后各模块直接读这个文件，不再解析 .mat/.xlsx。
+    """
+    import scipy.io
+    import pandas as pd
+
+    point_order = scipy.io.loadmat(point_order_mat)['point_order']
+
+    # crest 点及其邻点（MATLAB 中的第 9 和第 6 行，编号从 1 开始）
+    crest_order = point_order[8, :64]
+    crest_neighbor = point_order[5, :64]
+
+    # 骨架点顺序（FinalStep.Measure 计算宽度/长度时使用）
+    skeletonPt_order = np.zeros((17, 31), dtype=int)
+    skeletonPt_order[8:17, :] = point_order[:, 1:32]
+    for k in range(31):
+        skeletonPt_order[0:8, k] = point_order[1:9, 64-k]
+
+    # 亚区表格：名称, 曲面点数(1002 + pt/ps 点数), pt/ps 点数, spokes 数
+    subfield_info = pd.read_excel(subfield_list_path, header=None)
+    subfield_names = np.array([str(name) for name in subfield_info[0]])
+    surface_counts = subfield_info[1].astype(int).values
+    subfield_counts = subfield_info[2].astype(int).values
+    subfield_spokes = subfield_info[3].astype(int).values
+    # 每个亚区的 pt 在重构曲面点（去掉前 1002 个点）中的起始行，ps 紧接在 pt 之后
+    subfield_offsets = np.concatenate([[0], np.cumsum(subfield_counts)[:-1]])
+    surface_offset = int(surface_counts[0] - subfield_counts[0])
+
+    python_subfields = np.array([str(name) for name in pd.read_excel(subfield_python_path)['Subfield']])
+
+    # 上下配对（见 spoke_pairs）假定每个亚区的 spokes 前一半是上侧、后一半是对应的下侧，
+    # 表格中 pt/ps 行数须为 spokes 数的两倍、spokes 数须为偶数
+    bad = [str(name) for name, n, rows in zip(subfield_names, subfield_spokes, subfield_counts)
+           if n % 2 != 0 or rows != 2 * n]
+    if bad:
+        raise ValueError(f"{subfield_list_path}: subfields {bad} do not split into up/down spoke halves")
+
+    # combined_label 的 spokes 分区：[0, 549) 上侧, [549, 1098) 下侧, [1098, 1162) crest
+    n_combined = int(subfield_spokes[list(subfield_names).index('combined_label')])
+    partition_bounds = np.array([n_combined // 2, n_combined, n_combined + len(crest_order)])
+
+    # 先写临时文件再改名，避免并行进程读到写了一半的索引
+    tmp_path = output_path + f".{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        point_order=point_order,
+        crest_order=crest_order,
+        crest_neighbor=crest_neighbor,
+        skeletonPt_order=skeletonPt_order,
+        subfield_names=subfield_names,
+        subfield_counts=subfield_counts,
+        subfield_spokes=subfield_spokes,
+        subfield_offsets=subfield_offsets,
+        surface_offset=surface_offset,
+        python_subfields=python_subfields,
+        partition_bounds=partition_bounds,
+    )
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def get_template_index(template_dir=None):
+    """
+    读取 template_dir（默认本文件所在目录）下的模板索引，每个进程只加载一次。
+    索引文件不存在或比源文件旧时自动重新编译。
+    """
+    if template_dir is None:
+        template_dir = os.path.dirname(os.path.abspath(__file__))
+    template_dir = os.path.abspath(str(template_dir))
+    index_path = os.path.join(template_dir, INDEX_NAME)
+
+    index = _template_indexes.get(index_path)
+    if index is not None:
+        return index
+
+    sources = [os.path.join(template_dir, name) for name in (POINT_ORDER_NAME, SUBFIELD_LIST_NAME, SUBFIELD_PYTHON_NAME)]
+    if not os.path.exists(index_path) or \
+            any(os.path.getmtime(src) > os.path.getmtime(index_path) for src in sources if os.path.exists(src)):
+        build_template_index(*sources, index_path)
+
+    with np.load(index_path) as data:
+        index = {key: data[key] for key in data.files}
+    index['surface_offset'] = int(index['surface_offset'])
+    _template_indexes[index_path] = index
+    return index
+
+
+def template_dir_of(table_path):
+    """
+    亚区表格所在目录（其中有 point_order_skeleton.mat 时）即该次运行的模板目录；
+    否则返回 None，使用本文件所在目录的模板。
+    """
+    table_dir = os.path.dirname(os.path.abspath(str(table_path)))
+    return table_dir if os.path.exists(os.path.join(table_dir, POINT_ORDER_NAME)) else None
+
+
+def subfield_rows(index, subfield_name):
+    """返回亚区 pt、ps 在重构曲面点（去掉前 1002 个点）中的行范围 (pt_start, ps_start, n_spokes)。"""
+    i = list(index['subfield_names']).index(subfield_name)
+    pt_start = int(index['subfield_offsets'][i])
+    n_spokes = int(index['subfield_counts'][i]) // 2
+    return pt_start, pt_start + n_spokes, n_spokes
+
+
+def spoke_pairs(index, subfield_name):
+    """
+    亚区上下两侧成对的 spokes 下标 (up, down)。模板表格中没有逐个 spoke 的配对，
+    这里沿用原 EqualSpokeLength 的约定：前一半 spokes 与后一半按顺序一一对应
+    （combined_label 为 [0, 549) 与 [549, 1098)，crest spokes 不参与配对）；
+    build_template_index 检查每个亚区的 spokes 数能这样对半分。
+    """
+    i = list(index['subfield_names']).index(subfield_name)
+    half = int(index['subfield_spokes'][i]) // 2
+    up = np.arange(half)
+    return up, up + half
+
+
+def load_subfield_list(subfield_file_path):
+    """
+    读取 subfield_list_python.xlsx 中的亚区列表。文件是模板表格时直接用索引，
+    其他表格仍用 pandas 读取。
+    """
+    subfield_file_path = os.path.abspath(str(subfield_file_path))
+    if os.path.basename(subfield_file_path) == SUBFIELD_PYTHON_NAME and \
+            os.path.exists(os.path.join(os.path.dirname(subfield_file_path), POINT_ORDER_NAME)):
+        return get_template_index(os.path.dirname(subfield_file_path))['python_subfields'].tolist()
+    import pandas as pd
+    return list(pd.read_excel(subfield_file_path)['Subfield'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile the template tables into a NumPy index file.")
+    parser.add_argument('--template_dir', type=str, default=os.path.dirname(os.path.abspath(__file__)),
+                        help="Directory holding point_order_skeleton.mat and the subfield tables")
+    parser.add_argument('--output', type=str, default=None, help="Output .npz path (default: <template_dir>/template_index.npz)")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(args.template_dir, INDEX_NAME)
+    build_template_index(
+        os.path.join(args.template_dir, POINT_ORDER_NAME),
+        os.path.join(args.template_dir, SUBFIELD_LIST_NAME),
+        os.path.join(args.template_dir, SUBFIELD_PYTHON_NAME),
+        output
+    )
+    print(f"Saved: {output}")
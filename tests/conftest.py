@@ -0,0 +1,8 @@
+# conftest.py
+import os
+import sys
+
+# 测试直接导入仓库根目录下的模块
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,57 @@
+# test_mesh_io.py
+import os
+import numpy as np
+import pytest
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+import mesh_io
+import spoke_archive as sa
+from conftest import ROOT
+
+SURFACE_PATH = os.path.join(ROOT, 'data', 'left_hippo.vtk')
+
+
+def vtk_reader_points(path):
+    """VTK reader 读出的点坐标，作为对照。"""
+    reader = vtk.vtkXMLPolyDataReader() if str(path).endswith('.vtp') else vtk.vtkPolyDataReader()
+    reader.SetFileName(str(path))
+    reader.Update()
+    return vtk_to_numpy(reader.GetOutput().GetPoints().GetData())
+
+
+@pytest.mark.parametrize('fmt', mesh_io.MESH_FORMATS)
+def test_read_points_matches_vtk_reader(tmp_path, fmt):
+    surface = mesh_io.read_mesh(SURFACE_PATH)
+    path = mesh_io.write_mesh(surface, tmp_path / 'surface.vtk', fmt=fmt)
+    points = mesh_io.read_points(path)
+    expected = vtk_reader_points(path)
+    assert points.dtype == expected.dtype
+    np.testing.assert_array_equal(points, expected)
+
+
+@pytest.mark.parametrize('fmt', mesh_io.MESH_FORMATS)
+def test_archive_points_match_loose_files(tmp_path, monkeypatch, fmt):
+    rng = np.random.default_rng(0)
+    points = {f"CA{i}_pt": rng.random((30 + i, 3)).astype(np.float32) for i in range(3)}
+    loose, archived = tmp_path / 'loose', tmp_path / 'archived'
+    loose.mkdir()
+    archived.mkdir()
+
+    monkeypatch.setenv(mesh_io.MESH_FORMAT_ENV, fmt)
+    monkeypatch.setenv(sa.ARCHIVE_ENV, "0")
+    sa.write_entries({str(loose / f"{stem}.vtk"): array for stem, array in points.items()})
+    monkeypatch.setenv(sa.ARCHIVE_ENV, "1")
+    sa.write_entries({str(archived / f"{stem}.vtk"): array for stem, array in points.items()})
+
+    assert not any(archived.glob('*.vt?'))
+    for stem, array in points.items():
+        from_file = sa.read_entry_points(str(loose / f"{stem}.vtk"))
+        from_archive = sa.read_entry_points(str(archived / f"{stem}.vtk"))
+        assert from_file.dtype == from_archive.dtype == np.float32
+        np.testing.assert_array_equal(from_archive, array)
+        if fmt == 'ascii':
+            # ASCII legacy VTK 只写 6 位有效数字，归档保存完整的 float32
+            np.testing.assert_allclose(from_file, array, rtol=1e-5)
+        else:
+            np.testing.assert_array_equal(from_file, array)
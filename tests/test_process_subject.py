@@ -0,0 +1,385 @@
+# test_process_subject.py
+import os
+import numpy as np
+import pytest
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+import process_subject as ps_mod
+import spoke_archive
+from conftest import ROOT
+
+SURFACE_PATH = os.path.join(ROOT, 'data', 'left_hippo.vtk')
+
+
+def old_intersection_number(pt, ps, surf_vtk):
+    """原来逐步 marching 的 IntersectionNumber（每 0.05 判断一次 inside），作为对照。"""
+    pt = np.array(pt, dtype=float)
+    ps = np.array(ps, dtype=float)
+    lamda = 0.05
+    spoke = pt - ps
+    spoke_length = np.linalg.norm(spoke)
+    if spoke_length < 1e-6:
+        return 0
+    spoke_dir = spoke / spoke_length
+    spoke_dir_new = spoke_dir
+    status = 0
+    last_inside = ps_mod.IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+    while np.dot(spoke_dir_new, spoke_dir) > 0:
+        spoke = pt - ps
+        spoke_length = np.linalg.norm(spoke)
+        if spoke_length < 1e-3:
+            break
+        spoke_dir = spoke / spoke_length
+        pt = pt - lamda * spoke_dir
+        spoke = pt - ps
+        spoke_length_new = np.linalg.norm(spoke)
+        if spoke_length_new < 1e-3:
+            break
+        spoke_dir_new = spoke / spoke_length_new
+        inside = ps_mod.IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+        if inside != last_inside:
+            status += 1
+        last_inside = inside
+    return status
+
+
+@pytest.fixture(scope='module')
+def surface():
+    surf = ps_mod.read_polydata(SURFACE_PATH)
+    yield surf
+    ps_mod.release_surface_geometry()
+
+
+def points_on_surface(surf_vtk, num, seed=0):
+    """曲面三角形内的随机点（恰好在曲面上，同 RepairSkeleton 把骨架点拉到曲面上的情况）。"""
+    rng = np.random.default_rng(seed)
+    points = vtk_to_numpy(surf_vtk.GetPoints().GetData()).astype(float)
+    tris = vtk_to_numpy(surf_vtk.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    cells = rng.choice(tris.shape[0], num, replace=False)
+    weights = rng.dirichlet([1.0, 1.0, 1.0], num)
+    return np.einsum('ij,ijk->ik', weights, points[tris[cells]])
+
+
+def random_spokes(start, seed=0, min_length=0.3, max_length=4.0):
+    rng = np.random.default_rng(seed)
+    direction = rng.normal(size=start.shape)
+    direction /= np.linalg.norm(direction, axis=1)[:, None]
+    return start + direction * rng.uniform(min_length, max_length, (start.shape[0], 1))
+
+
+def old_is_inside(pt, surf_vtk):
+    """原来的 IsInsideCheck：每个点新建一个 vtkSelectEnclosedPoints。"""
+    select = vtk.vtkSelectEnclosedPoints()
+    select.SetSurfaceData(surf_vtk)
+    select.SetTolerance(1e-4)
+    pts = vtk.vtkPoints()
+    pts.InsertNextPoint(*pt)
+    pts_pd = vtk.vtkPolyData()
+    pts_pd.SetPoints(pts)
+    select.SetInputData(pts_pd)
+    select.Update()
+    return select.IsInside(0)
+
+
+def test_inside_oracle_matches_per_point_select_enclosed_points(surface):
+    # 包围盒内的随机点、恰好在曲面上的点和离曲面很近的点
+    rng = np.random.default_rng(11)
+    bounds = np.array(surface.GetBounds()).reshape(3, 2)
+    on_surface = points_on_surface(surface, 50, seed=12)
+    points = np.concatenate([rng.uniform(bounds[:, 0] - 1, bounds[:, 1] + 1, (150, 3)), on_surface,
+                             on_surface + rng.normal(scale=0.01, size=on_surface.shape)])
+    old = [old_is_inside(p, surface) for p in points]
+    oracle = ps_mod.get_inside_oracle(surface)
+    assert oracle.classify(points).tolist() == old
+    assert [oracle.is_inside(p) for p in points] == old
+    assert 0 < sum(old) < len(old)
+
+
+def test_spoke_set_partition_scatter_round_trip():
+    rng = np.random.default_rng(15)
+    skeleton = rng.random((40, 3))
+    tips = skeleton + rng.random((40, 3))
+    spokes = ps_mod.SpokeSet(skeleton, tips, inside=rng.random(40) < 0.6)
+    original = spokes.copy()
+
+    inside, outside, inside_indices, outside_indices = spokes.partition()
+    assert len(inside) + len(outside) == len(spokes)
+    np.testing.assert_array_equal(np.sort(np.concatenate([inside_indices, outside_indices])), np.arange(40))
+    np.testing.assert_array_equal(inside.tips, original.tips[original.inside])
+    np.testing.assert_array_equal(outside.skeleton, original.skeleton[~original.inside])
+
+    # 原样写回不改变任何 spoke；修改后写回只影响对应下标，顺序不变
+    spokes.scatter(inside_indices, inside)
+    spokes.scatter(outside_indices, outside)
+    np.testing.assert_array_equal(spokes.tips, original.tips)
+    np.testing.assert_array_equal(spokes.skeleton, original.skeleton)
+    outside.tips += 1
+    spokes.scatter(outside_indices, outside)
+    np.testing.assert_array_equal(spokes.tips[outside_indices], original.tips[outside_indices] + 1)
+    np.testing.assert_array_equal(spokes.tips[inside_indices], original.tips[inside_indices])
+
+    # 与 vtkPolyData 之间零拷贝转换
+    pt_vtk, ps_vtk = spokes.tips_polydata(), spokes.skeleton_polydata()
+    assert np.shares_memory(ps_mod.points_of(pt_vtk), spokes.tips)
+    back = ps_mod.SpokeSet.from_polydata(ps_vtk, pt_vtk)
+    assert np.shares_memory(back.skeleton, spokes.skeleton)
+
+
+def test_marching_end_matches_old_sampling():
+    ps = np.zeros((4, 3))
+    pt = np.array([[0.12, 0, 0], [0.1005, 0, 0], [0.0995, 0, 0], [0.0005, 0, 0]])
+    end = ps_mod.marching_end(pt, ps)
+    # 0.12 -> 0.07, 0.02, -0.03；0.1005 -> 0.0505, 0.0005（不判断）；0.0995 -> 0.0495, -0.0005（不判断）
+    np.testing.assert_allclose(end[:, 0], [-0.03, 0.0505, 0.0495, 0.0005], atol=1e-12)
+
+
+def test_intersection_number_skeleton_on_surface(surface):
+    # ps 在曲面上（修复后的骨架点），原 marching 会在越过 ps 的采样点上判断一次
+    ps = points_on_surface(surface, 60, seed=1)
+    pt = random_spokes(ps, seed=2)
+    old = [old_intersection_number(a, b, surface) for a, b in zip(pt, ps)]
+    new = [ps_mod.IntersectionNumber(a, b, surface) for a, b in zip(pt, ps)]
+    batch, _ = ps_mod.IntersectionNumberBatch(pt, ps, surface)
+    assert new == old
+    assert batch.tolist() == old
+
+
+def test_intersection_number_tip_on_surface(surface):
+    # pt 在曲面上（长度 refine 后的 tip），原 marching 直接在 pt 上判断 inside
+    pt = points_on_surface(surface, 60, seed=3)
+    ps = random_spokes(pt, seed=4)
+    old = [old_intersection_number(a, b, surface) for a, b in zip(pt, ps)]
+    new = [ps_mod.IntersectionNumber(a, b, surface) for a, b in zip(pt, ps)]
+    assert new == old
+
+
+def points_inside(surf_vtk, num, seed=0):
+    """曲面包围盒内被判为 inside 的随机点。"""
+    rng = np.random.default_rng(seed)
+    bounds = np.array(surf_vtk.GetBounds()).reshape(3, 2)
+    oracle = ps_mod.get_inside_oracle(surf_vtk)
+    found = []
+    while sum(len(f) for f in found) < num:
+        candidates = rng.uniform(bounds[:, 0], bounds[:, 1], (4 * num, 3))
+        found.append(candidates[oracle.classify(candidates) == 1])
+    return np.concatenate(found)[:num]
+
+
+def old_length_march(monkeypatch, surf_vtk, pt_vtk, ps_vtk, eps_s):
+    """原来的逐步长度 refine：交点个数改用逐步 marching 计数。"""
+    def old_batch(pt_array, ps_array, surf):
+        nums = [old_intersection_number(a, b, surf) for a, b in zip(pt_array, ps_array)]
+        return np.array(nums, dtype=int), None
+    with monkeypatch.context() as patch:
+        patch.setattr(ps_mod, 'IntersectionNumber', old_intersection_number)
+        patch.setattr(ps_mod, 'IntersectionNumberBatch', old_batch)
+        return ps_mod.points_of(ps_mod.RefineSpokeLength(surf_vtk, pt_vtk, ps_vtk, eps_s, 'test', mode='march'))
+
+
+def test_direct_length_matches_old_march_combined_label(surface, monkeypatch):
+    # combined_label 的情况：一部分骨架点被 RepairSkeleton 拉到曲面上，其余在内部
+    eps_s = 0.1
+    ps = np.concatenate([points_on_surface(surface, 40, seed=5), points_inside(surface, 40, seed=6)])
+    pt = random_spokes(ps, seed=7, min_length=0.5, max_length=6.0)
+    pt_vtk = ps_mod.numpy_to_vtk_polydata(pt)
+    ps_vtk = ps_mod.numpy_to_vtk_polydata(ps)
+
+    old = old_length_march(monkeypatch, surface, pt_vtk, ps_vtk, eps_s)
+    march = ps_mod.points_of(ps_mod.RefineSpokeLength(surface, pt_vtk, ps_vtk, eps_s, 'test', mode='march'))
+    direct = ps_mod.points_of(ps_mod.RefineSpokeLength(surface, pt_vtk, ps_vtk, eps_s, 'test', mode='direct'))
+
+    np.testing.assert_array_equal(march, old)
+    # 逐步移动停在交点外（或内）一个步长以内，直接求交停在交点上
+    deviation = np.linalg.norm(old.astype(float) - direct.astype(float), axis=1)
+    assert deviation.max() <= eps_s + 1e-5
+
+
+def test_batch_march_matches_loop_march(surface):
+    # 所有 spokes 同步移动的逐步 refine（sdf 后端使用）与逐个处理的结果和迭代次数相同
+    eps_s = 0.1
+    ps = np.concatenate([points_on_surface(surface, 40, seed=8), points_inside(surface, 40, seed=9)])
+    pt = random_spokes(ps, seed=10, min_length=0.5, max_length=6.0)
+    pt_vtk = ps_mod.numpy_to_vtk_polydata(pt)
+    ps_vtk = ps_mod.numpy_to_vtk_polydata(ps)
+
+    loop_metrics, batch_metrics = {}, {}
+    loop = ps_mod.RefineSpokeLength(surface, pt_vtk, ps_vtk, eps_s, 'test', mode='march', metrics=loop_metrics)
+    batch = ps_mod.RefineSpokeLengthMarchBatch(surface, pt_vtk, ps_vtk, eps_s, 'test', metrics=batch_metrics)
+    np.testing.assert_array_equal(ps_mod.points_of(batch), ps_mod.points_of(loop))
+    assert batch_metrics == loop_metrics
+    assert loop_metrics['length']['iterations_max'] > 0
+    np.testing.assert_array_equal(ps_mod.points_of(pt_vtk), pt.astype(np.float32))
+
+
+@pytest.mark.parametrize('eps_d', [1e-2, 1e-4])
+def test_batch_direction_matches_loop_direction(surface, eps_d):
+    # 批量方向 refine 与逐根迭代用同一个法向量公式，tips 和每根 spoke 的迭代次数一致
+    ps = points_inside(surface, 120, seed=13)
+    pt = random_spokes(ps, seed=14, min_length=0.5, max_length=4.0)
+    pt[0] = ps[0]  # 长度为 0 的 spoke 不动
+    pt_vtk = ps_mod.numpy_to_vtk_polydata(pt)
+    ps_vtk = ps_mod.numpy_to_vtk_polydata(ps)
+
+    loop_metrics, batch_metrics = {}, {}
+    loop = ps_mod.RefineSpokeDirection(surface, pt_vtk, ps_vtk, eps_d, 'test', mode='loop', metrics=loop_metrics)
+    batch, iter_counts = ps_mod.RefineSpokeDirectionBatch(surface, pt_vtk, ps_vtk, eps_d, 'test', metrics=batch_metrics)
+    for key in ('iterations_histogram', 'iterations_max', 'capped', 'spokes'):
+        assert batch_metrics['direction'][key] == loop_metrics['direction'][key]
+    assert loop_metrics['direction']['iterations_max'] > 1
+    # 达到 50 次仍未收敛的 spokes 在两个法向量之间来回摆动，末位舍入不同就会停在不同位置
+    converged = iter_counts < 50
+    np.testing.assert_allclose(ps_mod.points_of(batch)[converged], ps_mod.points_of(loop)[converged], atol=1e-5)
+
+
+def test_multi_resolution_direction_warm_starts_from_capped_coarse_stage(surface):
+    eps_d = 0.1
+    ps = points_inside(surface, 80, seed=8)
+    pt = random_spokes(ps, seed=9, min_length=0.5, max_length=3.0)
+    pt_vtk = ps_mod.numpy_to_vtk_polydata(pt)
+    ps_vtk = ps_mod.numpy_to_vtk_polydata(ps)
+
+    for mode in ('loop', 'batch'):
+        metrics = {}
+        multi = ps_mod.points_of(ps_mod.RefineSpokeDirection(surface, pt_vtk, ps_vtk, eps_d, 'test', mode=mode,
+                                                             metrics=metrics, resolution='multi', coarse_iter=2))
+        # 抽稀曲面上最多 coarse_iter 轮，之后从抽稀结果出发在原曲面上收敛（不重新开始）
+        assert metrics['direction_coarse']['iterations_max'] <= 2
+        coarse = ps_mod.RefineSpokeDirection(ps_mod.coarse_surface(surface), pt_vtk, ps_vtk, eps_d, 'test',
+                                             mode=mode, max_iter=2)
+        fine = ps_mod.points_of(ps_mod.RefineSpokeDirection(surface, coarse, ps_vtk, eps_d, 'test', mode=mode))
+        np.testing.assert_array_equal(multi, fine)
+        assert metrics['direction']['capped'] == 0
+        assert 'length_coarse' not in metrics
+
+def old_intersection_number1(pt, ps, surf_vtk):
+    """原来逐步 marching 的 IntersectionNumber1：记录越过边界后的第一个采样点，最多数到第 3 个。"""
+    pt = np.array(pt, dtype=float)
+    lamda = 0.05
+    spoke = pt - ps
+    spoke_length = np.linalg.norm(spoke)
+    if spoke_length < 1e-3:
+        return [], 0
+    spoke_dir = spoke / spoke_length
+    status = 0
+    intersections = []
+    last_inside = ps_mod.IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+    while spoke_length > 1e-3:
+        pt -= lamda * spoke_dir
+        spoke = pt - ps
+        spoke_length = np.linalg.norm(spoke)
+        if spoke_length < 1e-3:
+            break
+        spoke_dir = spoke / spoke_length
+        inside = ps_mod.IsInsideCheck(pt[0], pt[1], pt[2], surf_vtk)
+        if inside != last_inside:
+            status += 1
+            intersections.append(pt.copy())
+        last_inside = inside
+        if status > 2:
+            break
+    return (intersections[-2:] if status > 2 else intersections), status
+
+
+def old_generate_outside(surf_vtk, pt, ps):
+    """原来逐根 spoke 的 GenerateOutside_pts，返回 (tips, skeleton)。"""
+    pt_array = np.array(pt, dtype=float)
+    ps_array = np.array(ps, dtype=float)
+    for i in range(ps_array.shape[0]):
+        if np.array_equal(pt_array[i], ps_array[i]):
+            continue
+        spoke = pt_array[i] - ps_array[i]
+        stretched = ps_array[i] + spoke / np.linalg.norm(spoke) * 10.0
+        intersections, q = old_intersection_number1(stretched, ps_array[i], surf_vtk)
+        if q >= 2:
+            pt_array[i], ps_array[i] = intersections[0], intersections[1]
+        else:
+            pt_array[i] = ps_array[i]
+    return pt_array, ps_array
+
+
+def test_outside_repair_matches_old_march(surface):
+    # 骨架点在曲面外且贴近曲面（包括恰好在曲面上）的 spokes
+    rng = np.random.default_rng(10)
+    on_surface = points_on_surface(surface, 100, seed=11)
+    ps = on_surface + rng.normal(scale=0.3, size=on_surface.shape)
+    ps[:20] = on_surface[:20]
+    ps = ps[ps_mod.get_inside_oracle(surface).classify(ps) == 0]
+    pt = random_spokes(ps, seed=12, min_length=0.5, max_length=4.0)
+
+    old_pt, old_ps = old_generate_outside(surface, pt, ps)
+    new_ps_vtk, new_pt_vtk = ps_mod.GenerateOutside_pts(surface, ps_mod.numpy_to_vtk_polydata(pt),
+                                                        ps_mod.numpy_to_vtk_polydata(ps))
+    new_pt = ps_mod.points_of(new_pt_vtk).astype(float)
+    new_ps = ps_mod.points_of(new_ps_vtk).astype(float)
+
+    # 有效性（交点是否足够 2 个）与原来一致；原来记录越过边界后的采样点，与精确交点相差不到一个步长
+    old_valid = np.any(old_pt != old_ps, axis=1)
+    new_valid = np.any(new_pt != new_ps, axis=1)
+    np.testing.assert_array_equal(new_valid, old_valid)
+    assert np.abs(new_pt - old_pt).max() <= 0.05 + 1e-5
+    assert np.abs(new_ps - old_ps).max() <= 0.05 + 1e-5
+
+
+def test_sdf_outside_repair_without_outside_spokes(surface):
+    # 亚区没有 outside spokes 时 GenerateOutside_pts 以空数组调用 crossings_batch
+    sdf = ps_mod.get_surface_backend(surface, 'sdf', 0.1)
+    assert sdf.crossings_batch(np.zeros((0, 3)), np.zeros((0, 3))) == []
+    empty = ps_mod.numpy_to_vtk_polydata(np.zeros((0, 3)))
+    metrics = {}
+    ps_vtk, pt_vtk = ps_mod.GenerateOutside_pts(sdf, empty, empty, metrics=metrics)
+    assert ps_vtk.GetNumberOfPoints() == 0 and pt_vtk.GetNumberOfPoints() == 0
+    assert metrics['outside']['spokes'] == 0
+
+
+def test_resume_invalidated_by_code_version(tmp_path):
+    unit = {key: str(tmp_path / f"{key}.vtk") for key in
+            ('pt_path', 'ps_path', 'surf_path', 'output_path1', 'output_path2')}
+    for path in unit.values():
+        with open(path, 'w') as f:
+            f.write(path)
+    options = dict(length_mode='march')
+    ps_mod.write_unit_manifest(unit, options, code='a')
+    assert ps_mod.unit_is_up_to_date(unit, options, code='a')
+    assert not ps_mod.unit_is_up_to_date(unit, options, code='b')
+    assert not ps_mod.unit_is_up_to_date(unit, options)
+    assert ps_mod.code_version() == ps_mod.code_version(ROOT)
+
+
+@pytest.mark.parametrize('module', ['mesh_io', 'spoke_archive', 'template_index'])
+def test_code_version_covers_helper_modules(tmp_path, monkeypatch, module):
+    module = __import__(module)
+    monkeypatch.setattr(ps_mod, '_code_versions', {})
+    before = ps_mod.code_version()
+    edited = tmp_path / os.path.basename(module.__file__)
+    with open(module.__file__, 'rb') as f:
+        edited.write_bytes(f.read() + b"\n# edited\n")
+    monkeypatch.setattr(module, '__file__', str(edited))
+    monkeypatch.setattr(ps_mod, '_code_versions', {})
+    assert ps_mod.code_version() != before
+
+
+def test_resume_ignores_later_appends_to_input_archive(tmp_path, monkeypatch):
+    monkeypatch.setenv(spoke_archive.ARCHIVE_ENV, "1")
+    base, follow_up = tmp_path / "base", tmp_path / "follow_up"
+    base.mkdir()
+    follow_up.mkdir()
+    rng = np.random.default_rng(0)
+    unit = {'pt_path': str(base / "CA1_pt.vtk"), 'ps_path': str(base / "CA1_ps.vtk"),
+            'surf_path': str(base / "Remesh_CA1_transformed.vtk"),
+            'output_path1': str(follow_up / "CA1_pt_refined.vtk"), 'output_path2': str(follow_up / "CA1_ps_refined.vtk")}
+    spoke_archive.write_entries({path: rng.random((20, 3)) for path in unit.values()})
+    options = dict(length_mode='march')
+    ps_mod.write_unit_manifest(unit, options)
+    assert ps_mod.unit_is_up_to_date(unit, options)
+
+    # 之后往基线归档追加 metrics 等成员，归档的修改时间变新，但输入内容没变
+    spoke_archive.write_json_entry({'n': 1}, str(base / "CA1_pt_refined_metrics.json"))
+    later = os.path.getmtime(spoke_archive.archive_path(follow_up)) + 10
+    os.utime(spoke_archive.archive_path(base), (later, later))
+    assert ps_mod.unit_is_up_to_date(unit, options)
+
+    # 输出内容改变时重新处理
+    spoke_archive.write_entries({unit['output_path2']: rng.random((20, 3))})
+    assert not ps_mod.unit_is_up_to_date(unit, options)
+
@@ -0,0 +1,42 @@
+# test_registration_module.py
+import os
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+import registration_module as rm
+from conftest import ROOT
+
+SURFACE_PATH = os.path.join(ROOT, 'data', 'left_hippo.vtk')
+
+
+def write_legacy(polydata, path):
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetFileName(str(path))
+    writer.SetInputData(polydata)
+    writer.Write()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def numpy_reference(array):
+    """numpy_to_vtk 保存的 numpy 引用（新版 VTK 存在 buffer 上，旧版存在数组上）。"""
+    holder = array.GetBuffer() if hasattr(array, 'GetBuffer') else array
+    return holder._numpy_reference
+
+
+def test_cells_to_vtk_shares_memory_and_matches_insert_next_cell(tmp_path):
+    points, cells = rm.read_vtk(SURFACE_PATH)
+    vtk_cells = rm.cells_to_vtk(cells)
+
+    # SetData 直接使用 numpy 数组（不转换），VTK 数组持有其引用
+    for array in (vtk_cells.GetOffsetsArray(), vtk_cells.GetConnectivityArray()):
+        assert np.shares_memory(vtk_to_numpy(array), numpy_reference(array))
+
+    reference = vtk.vtkCellArray()
+    for tri in cells.reshape(-1, 4)[:, 1:]:
+        reference.InsertNextCell(3, [int(i) for i in tri])
+    expected = rm.points_to_polydata(points)
+    expected.SetPolys(reference)
+    assert write_legacy(rm.points_to_polydata(points, cells), tmp_path / 'a.vtk') == \
+        write_legacy(expected, tmp_path / 'b.vtk')
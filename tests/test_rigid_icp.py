@@ -0,0 +1,31 @@
+# test_rigid_icp.py
+import numpy as np
+
+import rigid_icp
+
+
+def rotation_z(angle_deg, translation):
+    angle = np.radians(angle_deg)
+    M = np.eye(4)
+    M[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    M[:3, 3] = translation
+    return M
+
+
+def test_icp_without_iterations_returns_prealignment():
+    rng = np.random.default_rng(0)
+    target = rng.normal(size=(300, 3)) * [10.0, 5.0, 3.0]
+    source = target + [1.0, -2.0, 0.5]
+    M, info = rigid_icp.icp(source, target, max_iter=0)
+    assert info['iterations'] == [0, 0]
+    # 只有质心对齐
+    np.testing.assert_allclose(M, rigid_icp.to_matrix(np.eye(3), target.mean(axis=0) - source.mean(axis=0)))
+
+
+def test_icp_recovers_small_rigid_motion():
+    rng = np.random.default_rng(1)
+    target = rng.normal(size=(500, 3)) * [10.0, 5.0, 3.0]
+    source = rigid_icp.transform_points(target, rotation_z(3.0, [0.5, -0.3, 0.2]))
+    M, info = rigid_icp.icp(source, target)
+    assert all(1 <= n <= 30 for n in info['iterations'])
+    assert info['rms'] < 1e-3
@@ -0,0 +1,77 @@
+# test_seperate_spokes.py
+import os
+import numpy as np
+import pytest
+import vtk
+
+import mesh_io
+import spoke_archive as sa
+import template_index as ti
+from SeperateSpokes import extract_spokes, SURFACE_NAME
+from conftest import ROOT
+
+SUBFIELD_LIST_PATH = os.path.join(ROOT, ti.SUBFIELD_LIST_NAME)
+
+
+def write_reconstruction(scan_dir, points):
+    """写一个 Deformetrica 重构曲面（只有点），与原来的 vtkPolyDataWriter 输出相同。"""
+    os.makedirs(os.path.join(scan_dir, 'output'))
+    vtk_points = vtk.vtkPoints()
+    for p in points:
+        vtk_points.InsertNextPoint(p)
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_points)
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetFileName(os.path.join(scan_dir, 'output', SURFACE_NAME))
+    writer.SetInputData(polydata)
+    writer.Write()
+
+
+def old_extract_spokes(surface_path, subfield_list_path):
+    """原来的逐点提取：按亚区表格的累计行数切出 pt、ps。"""
+    import pandas as pd
+    subfield_info = pd.read_excel(subfield_list_path, header=None)
+    num_vector = subfield_info[2].astype(int).values
+    N_whole = num_vector.sum()
+
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(surface_path)
+    reader.Update()
+    points = reader.GetOutput().GetPoints()
+    raw_pts = np.array([points.GetPoint(i) for i in range(points.GetNumberOfPoints())])[1002:, :]
+
+    spokes = {}
+    for iw, subfield_name in enumerate(subfield_info[0].values):
+        tmp_num = num_vector[iw]
+        pt_start_row = N_whole - num_vector[iw:].sum() + 1
+        pt_end_row = pt_start_row - 1 + tmp_num // 2
+        ps_start_row = pt_end_row + 1
+        ps_end_row = ps_start_row - 1 + tmp_num // 2
+        spokes[str(subfield_name)] = (raw_pts[pt_start_row-1:pt_end_row, :], raw_pts[ps_start_row-1:ps_end_row, :])
+    return spokes
+
+
+@pytest.mark.parametrize('archive', [False, True])
+def test_extract_spokes_matches_old_extraction(tmp_path, monkeypatch, archive):
+    pytest.importorskip('pandas')
+    index = ti.get_template_index(ROOT)
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-30, 30, (index['surface_offset'] + int(index['subfield_counts'].sum()), 3))
+    scan_dir = str(tmp_path / 'scan')
+    write_reconstruction(scan_dir, points)
+    old = old_extract_spokes(os.path.join(scan_dir, 'output', SURFACE_NAME), SUBFIELD_LIST_PATH)
+
+    monkeypatch.setenv(mesh_io.MESH_FORMAT_ENV, 'binary')
+    monkeypatch.setenv(sa.ARCHIVE_ENV, "1" if archive else "0")
+    spokes = extract_spokes(scan_dir, SUBFIELD_LIST_PATH)[scan_dir]
+
+    assert list(spokes) == list(old)
+    for name, (old_pt, old_ps) in old.items():
+        pt, ps = spokes[name]
+        # 重构曲面是 float 的 vtkPoints，原来读出的 double 就是 float32 的值
+        np.testing.assert_array_equal(pt, old_pt.astype(np.float32))
+        np.testing.assert_array_equal(ps, old_ps.astype(np.float32))
+        np.testing.assert_array_equal(sa.read_entry_points(os.path.join(scan_dir, f"{name}_pt.vtk")), pt)
+        np.testing.assert_array_equal(sa.read_entry_points(os.path.join(scan_dir, f"{name}_ps.vtk")), ps)
+    assert os.path.exists(sa.archive_path(scan_dir)) == archive
+    assert os.path.exists(os.path.join(scan_dir, "CA1_pt.vtk")) != archive
@@ -0,0 +1,60 @@
+# test_spoke_archive.py
+import os
+import zipfile
+import numpy as np
+import pytest
+
+import spoke_archive as sa
+
+
+@pytest.fixture
+def archive_mode(monkeypatch):
+    monkeypatch.setenv(sa.ARCHIVE_ENV, "1")
+
+
+def member_offsets(path):
+    with zipfile.ZipFile(path) as zf:
+        return {info.filename: info.header_offset for info in zf.infolist()}
+
+
+def test_new_members_are_appended(tmp_path, archive_mode):
+    rng = np.random.default_rng(0)
+    first = {str(tmp_path / f"CA{i}_pt_refined.vtk"): rng.random((50, 3)).astype(np.float32) for i in range(3)}
+    sa.write_entries(first)
+    offsets = member_offsets(sa.archive_path(tmp_path))
+
+    # 另一个亚区的结果追加到归档末尾，已有成员的位置不变（没有重写归档）
+    sa.write_entries({str(tmp_path / "sub_pt_refined.vtk"): rng.random((20, 3)).astype(np.float32)})
+    appended = member_offsets(sa.archive_path(tmp_path))
+    assert {name: appended[name] for name in offsets} == offsets
+    assert sa.archive_members(tmp_path) == {"CA0_pt_refined", "CA1_pt_refined", "CA2_pt_refined", "sub_pt_refined"}
+    for path, points in first.items():
+        np.testing.assert_array_equal(sa.read_entry_points(path), points)
+
+    # 替换已有成员时重写归档，读到新值
+    replaced = rng.random((50, 3)).astype(np.float32)
+    sa.write_entries({str(tmp_path / "CA1_pt_refined.vtk"): replaced})
+    np.testing.assert_array_equal(sa.read_entry_points(str(tmp_path / "CA1_pt_refined.vtk")), replaced)
+    with zipfile.ZipFile(sa.archive_path(tmp_path)) as zf:
+        assert len(zf.namelist()) == len(set(zf.namelist())) == 4
+
+
+def test_json_sidecars_are_archive_members(tmp_path, archive_mode):
+    sa.write_entries({str(tmp_path / "CA1_pt_refined.vtk"): np.zeros((4, 3), dtype=np.float32)})
+    path = str(tmp_path / "CA1_pt_refined_manifest.json")
+    sa.write_json_entry({'options': {'length_mode': 'march'}, 'code': 'abc'}, path)
+
+    assert os.listdir(tmp_path) == [sa.ARCHIVE_NAME]
+    assert sa.read_json_entry(path) == {'options': {'length_mode': 'march'}, 'code': 'abc'}
+    assert sa.read_json_entry(str(tmp_path / "CA3_pt_refined_manifest.json")) is None
+    assert sa.archive_members(tmp_path) == {"CA1_pt_refined"}
+
+    exported = sa.export_legacy(tmp_path, fmt='ascii')
+    assert sorted(os.path.basename(p) for p in exported) == ["CA1_pt_refined.vtk", "CA1_pt_refined_manifest.json"]
+
+
+def test_json_entry_without_archive_is_a_file(tmp_path):
+    path = str(tmp_path / "CA1_pt_refined_metrics.json")
+    sa.write_json_entry({'spokes': 3}, path)
+    assert os.listdir(tmp_path) == ["CA1_pt_refined_metrics.json"]
+    assert sa.read_json_entry(path) == {'spokes': 3}
@@ -0,0 +1,32 @@
+# test_template_index.py
+import os
+import shutil
+import numpy as np
+import pytest
+
+import template_index as ti
+from conftest import ROOT
+
+
+def test_spoke_pairs_split_each_subfield_in_half():
+    index = ti.get_template_index(ROOT)
+    for name, n in zip(index['subfield_names'], index['subfield_spokes']):
+        up, down = ti.spoke_pairs(index, name)
+        assert up.size == down.size == n // 2
+        assert np.array_equal(np.sort(np.concatenate([up, down])), np.arange(n))
+    up, down = ti.spoke_pairs(index, 'combined_label')
+    assert (up[0], up[-1], down[0], down[-1]) == (0, 548, 549, 1097)
+
+
+def test_build_rejects_subfields_without_up_down_halves(tmp_path):
+    pd = pytest.importorskip('pandas')
+    pytest.importorskip('openpyxl')
+    for name in (ti.POINT_ORDER_NAME, ti.SUBFIELD_PYTHON_NAME):
+        shutil.copy(os.path.join(ROOT, name), tmp_path / name)
+    table = pd.read_excel(os.path.join(ROOT, ti.SUBFIELD_LIST_NAME), header=None)
+    table.loc[1, 3] += 1
+    table.to_excel(tmp_path / ti.SUBFIELD_LIST_NAME, header=False, index=False)
+    with pytest.raises(ValueError, match="CA1"):
+        ti.build_template_index(*(str(tmp_path / name) for name in
+                                  (ti.POINT_ORDER_NAME, ti.SUBFIELD_LIST_NAME, ti.SUBFIELD_PYTHON_NAME)),
+                                str(tmp_path / ti.INDEX_NAME))